@@ -4,38 +4,68 @@
 from constants import *
 from util.commands.mav_movement import set_movement_power, set_target_depth
 from util.tasks.ping_handlers import run_ping360_service
+from util.comms.ping360_protocol import Ping360Request, Ping360Response, FLAG_LOGGING, INTEGRATION_MEDIAN, STATUS_OK
 import socket
-import struct
-import pickle as pk
 import numpy as np
 
 serverAddressPort = ("192.168.2.2", 42069)
 bufferSize = 2048
 
+replyTimeout = 5.0 # [s] A lost reply must not stall the control loop; the first request also waits for the head to turn
+maxAttempts = 3 # Requests sent before giving up; the vehicle is then disarmed
+
 UDPClientSocket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+UDPClientSocket.settimeout(replyTimeout)
 
 # Configuration of sonar
 
 range_value = 5
 
-toserver = {
-    'Number of samples' : 10,
-    'Angle' : 300, #300 Starboard 100 port
-    "Enable Logging" : False,
-    "Range" : 5, # Range SONAR should scan [m]
-    "Readings": 1200 # Number of readings Ping360 should take
-}
+toserver = Ping360Request(
+    n_samples=10,
+    angle=300, #300 Starboard 100 port
+    range=range_value, # Range SONAR should scan [m]
+    readings=1200, # Number of readings Ping360 should take
+    flags=FLAG_LOGGING,
+    integration=INTEGRATION_MEDIAN, # One multipath ping must not drag the distance off the wall
+    max_std=0.02 # Stop pinging once the distance is known within 2 cm [m]
+)
+
+def drain_replies():
+    # Discard the late replies to earlier requests, so that they are not read as the answer to the next one
+    UDPClientSocket.setblocking(False)
+    try:
+        while True:
+            UDPClientSocket.recv(bufferSize)
+    except BlockingIOError:
+        pass
+    finally:
+        UDPClientSocket.settimeout(replyTimeout)
 
 def run_ping_service():
-    # Sending sonar configuration to server
-    UDPClientSocket.sendto(pk.dumps(toserver), serverAddressPort)
+    # Ask again until the server returns a distance, at most maxAttempts times
+    for attempt in range(maxAttempts):
+        drain_replies()
+
+        # Sending sonar configuration to server
+        UDPClientSocket.sendto(toserver.pack(), serverAddressPort)
+
+        # Loading the data sent by the server
+        try:
+            msgFromServer = Ping360Response.unpack(UDPClientSocket.recv(bufferSize))
+        except socket.timeout:
+            print("No reply from the sonar service, retrying")
+            continue
+
+        # The server could not serve the request (or took no ping): no estimate in this response
+        if msgFromServer.status != STATUS_OK or msgFromServer.estimate is None or np.isnan(msgFromServer.estimate['distance']):
+            print("No distance from the sonar service (status {}), retrying".format(msgFromServer.status))
+            continue
 
-    # Loading the data sent by the server
-    msgFromServer = pk.loads(UDPClientSocket.recv(bufferSize))
+        # Reading the response sent by the server
+        return float(msgFromServer.estimate['distance'])
 
-    # Reading the dictionary sent by the server
-    distance = msgFromServer[0]
-    return np.mean(distance)
+    raise RuntimeError("No distance from the sonar service after {} attempts".format(maxAttempts))
 
 def Maintain_wall(Difference, Target = 2.0):
 
@@ -73,14 +103,8 @@ try:
     #set_movement_power(500, 250, 500, 0, 4) # Submerge
 
     Target = 2.0
-    # Sending sonar configuration to server
-    UDPClientSocket.sendto(pk.dumps(toserver), serverAddressPort)
-
-    # Loading the data sent by the server
-    msgFromServer = pk.loads(UDPClientSocket.recv(bufferSize))
-
-    # Reading the dictionary sent by the server
-    Distance = np.mean(msgFromServer[0])
+    # Reading the distance sent by the server
+    Distance = run_ping_service()
 
     #Distance = run_ping360_service()
     Difference = Target - Distance
@@ -89,14 +113,8 @@ try:
         # Controlling distance off-wall
         Maintain_wall(Difference)
 
-        # Sending sonar configuration to server
-        UDPClientSocket.sendto(pk.dumps(toserver), serverAddressPort)
-
-        # Loading the data sent by the server
-        msgFromServer = pk.loads(UDPClientSocket.recv(bufferSize))
-
-        # Reading the dictionary sent by the server
-        Distance = np.mean(msgFromServer[0])
+        # Reading the distance sent by the server
+        Distance = run_ping_service()
 
         #Distance = run_ping360_service()
         Difference = Target - Distance
@@ -0,0 +1,186 @@
+"""
+Benchmark of the Ping Viewer log decoders of examples/Binary_log.py.
+
+Writes a large synthetic Ping Viewer log (Ping360 device_data and auto_device_data, Ping1D profiles, other messages in between, and a few damaged records: bad checksums, stray bytes, frames cut across two records and an oversized record that needs recovery), then decodes it with the byte-by-byte PingViewerLogReader.parser(), the bulk PingViewerLogReader.bulk_parser() and PingViewerLogReader.profiles(). The bulk decoders are checked to return exactly the messages of parser(). The sidecar index is then built, loaded back and used to read a time range and the messages of one id, which must match the same selection of parser()'s messages. Run from the root of the repository:
+    python3 -m benchmarks.bench_binary_log --messages 20000
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Added the indexed random-access reads
+ - Version 1.2.0: Added the corruption report of the recovery
+ - Version 1.2.1: The recovery of the mapped log is PingViewerLogReader.recover_at()
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.2.1"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from brping import PingMessage, definitions
+from examples.Binary_log import PingViewerLogReader, parse_timestamp, INDEX_SUFFIX
+import numpy as np
+import os
+import struct
+import tempfile
+import time
+
+UINT = struct.Struct('>I')
+INT = struct.Struct('>i')
+
+
+def pack_string(text: str):
+    return UINT.pack(len(text)) + text.encode('UTF-8')
+
+
+def pack_array(data: bytes):
+    return UINT.pack(len(data)) + bytes(data)
+
+
+def make_message(message_id: int, rng: np.random.Generator, number_of_samples: int=1200, angle: int=0):
+    """
+    Returns the bytes of a Ping360 device_data/auto_device_data or Ping1D profile message with a random profile, or a protocol_version message
+    """
+    _message = PingMessage(message_id)
+    if message_id in (definitions.PING360_DEVICE_DATA, definitions.PING360_AUTO_DEVICE_DATA):
+        _message.mode, _message.gain_setting, _message.angle = 1, 1, angle
+        _message.transmit_duration, _message.sample_period, _message.transmit_frequency = 32, 225, 740
+        _message.number_of_samples = _message.data_length = number_of_samples
+        _message.data = bytearray(rng.integers(0, 256, number_of_samples, dtype=np.uint8).tobytes())
+        if message_id == definitions.PING360_AUTO_DEVICE_DATA:
+            _message.start_angle, _message.stop_angle, _message.num_steps = 0, 399, 1
+    elif message_id == definitions.PING1D_PROFILE:
+        _message.distance, _message.confidence, _message.transmit_duration = int(rng.integers(500, 30000)), 100, 200
+        _message.ping_number, _message.scan_start, _message.scan_length, _message.gain_setting = angle, 0, 30000, 2
+        _message.profile_data_length = 200
+        _message.profile_data = bytearray(rng.integers(0, 256, 200, dtype=np.uint8).tobytes())
+    else:
+        _message.version_major, _message.version_minor = 1, 0
+    return bytes(_message.pack_msg_data())
+
+
+def write_synthetic_log(path: str, n_messages: int, seed: int=0, damaged: bool=True):
+    """
+    Writes a Ping Viewer log of 'n_messages' records. With 'damaged', about 1% of the records are damaged in the ways parser() tolerates.
+    """
+    _rng = np.random.default_rng(seed)
+    _ids = (definitions.PING360_DEVICE_DATA, definitions.PING360_AUTO_DEVICE_DATA, definitions.PING1D_PROFILE, definitions.COMMON_PROTOCOL_VERSION)
+    with open(path, 'wb') as file:
+        file.write(pack_string("Ping Viewer sensor log") + INT.pack(1))
+        for info in ("0123abc", "2022-10-21", "v2.3.1", "linux", "5.15"):
+            file.write(pack_string(info))
+        file.write(INT.pack(2) + INT.pack(1)) # Sensor family and type
+
+        _cut = None # second half of a frame cut across two records
+        for index in range(n_messages):
+            _timestamp = "{:02d}:{:02d}:{:02d}.{:03d}".format(index // 3600000 % 24, index // 60000 % 60, index // 1000 % 60, index % 1000)
+            _message = make_message(_ids[int(_rng.choice(4, p=(0.6, 0.2, 0.15, 0.05)))], _rng, angle=index % 400)
+            _damage = _rng.random() if damaged else 1.0
+            if _cut is not None:
+                _message, _cut = _cut + _message, None
+            elif _damage < 0.002:
+                _message = _message[:-1] + bytes([(_message[-1] + 1) % 256]) # Bad checksum
+            elif _damage < 0.004:
+                _message = b'\x00\x07BxB' + _message # Stray bytes, 'B' not followed by 'R'
+            elif _damage < 0.006:
+                _message, _cut = _message[:len(_message) // 2], _message[len(_message) // 2:] # Cut across two records
+            elif _damage < 0.007:
+                # Oversized record: garbage size, then the next timestamp and message are found by recovery
+                file.write(pack_string(_timestamp) + UINT.pack(0xFFFFFF) + b'\xAA' * 100)
+            file.write(pack_string(_timestamp) + pack_array(_message))
+
+
+def same_messages(expected, actual):
+    """
+    Returns True if two lists of (timestamp, PingMessage) pairs hold the same messages
+    """
+    if len(expected) != len(actual):
+        return False
+    for (timestamp, message), (other_timestamp, other) in zip(expected, actual):
+        if timestamp != other_timestamp or bytes(message.msg_data) != bytes(other.msg_data) or message.message_id != other.message_id:
+            return False
+        for name in message.payload_field_names:
+            if getattr(message, name) != getattr(other, name):
+                return False
+    return True
+
+
+def benchmark(path: str):
+    _size = os.path.getsize(path)
+    _start = time.perf_counter()
+    _parser = PingViewerLogReader(path)
+    _expected = list(_parser.parser())
+    _parser_time = time.perf_counter() - _start
+
+    _start = time.perf_counter()
+    _bulk = list(PingViewerLogReader(path).bulk_parser())
+    _bulk_time = time.perf_counter() - _start
+
+    _start = time.perf_counter()
+    _profiles = PingViewerLogReader(path).profiles()
+    _profiles_time = time.perf_counter() - _start
+
+    _identical = same_messages(_expected, _bulk)
+    _by_id = {}
+    for timestamp, message in _expected:
+        _by_id.setdefault(message.message_id, []).append((timestamp, message))
+    for message_id, arrays in _profiles.items():
+        _messages = _by_id.get(message_id, [])
+        _data_field = _messages[0][1].payload_field_names[-1] if _messages else None
+        _identical &= len(_messages) == len(arrays.timestamps) and all(
+            timestamp == arrays.timestamps[i] and bytes(getattr(message, _data_field)) == arrays.data[i].tobytes() and
+            all(getattr(message, name) == arrays.fields[name][i] for name in arrays.fields.dtype.names)
+            for i, (timestamp, message) in enumerate(_messages))
+
+    # Indexed reads: build (and cache) the index, load it back, read 10% of the log by time and one message id
+    if os.path.exists(path + INDEX_SUFFIX):
+        os.remove(path + INDEX_SUFFIX)
+    _reader = PingViewerLogReader(path)
+    _start = time.perf_counter()
+    _index = _reader.index()
+    _build_time = time.perf_counter() - _start
+    _start = time.perf_counter()
+    _index = PingViewerLogReader(path).index()
+    _load_time = time.perf_counter() - _start
+    _times = [parse_timestamp(timestamp) for timestamp, _ in _expected]
+    _first, _last = (_times[len(_times) * 45 // 100], _times[len(_times) * 55 // 100]) if _times else (0, 0)
+    _start = time.perf_counter()
+    _range = list(_reader.read(_index, _index.select(_first, _last)))
+    _range_time = time.perf_counter() - _start
+    _identical &= same_messages([pair for pair, seconds in zip(_expected, _times) if _first <= seconds < _last], _range)
+    _identical &= same_messages([(timestamp, message) for timestamp, message in _expected if message.message_id == definitions.PING360_DEVICE_DATA],
+                                list(_reader.read(_index, _index.select(message_id=definitions.PING360_DEVICE_DATA))))
+    _reader.close()
+
+    print("{}: {:.1f} MB, {} profile messages".format(path, _size / 1e6, len(_expected)))
+    print("  parser():      {:8.2f} s ({:6.1f} MB/s)".format(_parser_time, _size / 1e6 / _parser_time))
+    print("  bulk_parser(): {:8.2f} s ({:6.1f} MB/s, {:.0f}x)".format(_bulk_time, _size / 1e6 / _bulk_time, _parser_time / _bulk_time))
+    print("  profiles():    {:8.2f} s ({:6.1f} MB/s, {:.0f}x)".format(_profiles_time, _size / 1e6 / _profiles_time, _parser_time / _profiles_time))
+    print("  index() build: {:8.2f} s, cached load {:.1f} ms ({} entries)".format(_build_time, _load_time * 1e3, len(_index)))
+    print("  read() of 10%: {:8.3f} s ({} messages)".format(_range_time, len(_range)))
+    print("  recover_at():  {} damaged parts, {} bytes skipped".format(len(_parser.corruption), sum(damage.skipped for damage in _parser.corruption)))
+    print("  Bulk and indexed results identical to parser(): {}".format(_identical))
+    return _identical
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Benchmark of the Ping Viewer log decoders")
+    parser.add_argument("--messages", type=int, default=20000, help="Number of records of the synthetic log")
+    parser.add_argument("--log", default=None, help="Benchmark this Ping Viewer log instead of a synthetic one")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic log")
+    args = parser.parse_args()
+
+    if args.log is not None:
+        identical = benchmark(args.log)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "synthetic.bin")
+            write_synthetic_log(path, args.messages, args.seed)
+            identical = benchmark(path)
+    if not identical:
+        raise SystemExit("The bulk or indexed decoders differ from parser()")
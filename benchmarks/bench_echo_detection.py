@@ -0,0 +1,129 @@
+"""
+Benchmark of the CFAR echo detector on the recorded Ping360 profiles.
+
+Loads the pool test profiles of data/102122 (service .pk logs) and data/100622 (Intensities*.csv exports), runs both detectors over them and compares the detector throughput with the fastest ping rate the Ping360 can reach at the recorded range (one ping has to travel to the end of the range and back before the next). The recordings mix device configurations (data/102122 has records at two sample periods), so every configuration is benchmarked on its own.
+
+Before timing anything, the detector is checked against recorded wall profiles (WALL_PROFILES): the best echo must be the wall, not the reverb behind it. Run from the root of the repository:
+    python3 -m benchmarks.bench_echo_detection --echoes 3
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Group the records by sample period instead of applying the last one to all; added the recorded wall profile check
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.1.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from sensors.Ping360.ping_processing import PingProcessor
+from sensors.Ping360.sonar_log import load_pickle_records, pickle_record_arrays
+import glob
+import numpy as np
+import os
+import timeit
+
+# Recorded profiles with a single pool wall: (file in the data directory, range [m] of the wall's leading edge)
+WALL_PROFILES = (
+    ("100622/Intensities4.csv", 1.70),
+    ("100622/Intensities5.csv", 1.54),
+    ("100622/Intensities9.csv", 1.44),
+)
+
+
+def load_102122(data_dir_path: str):
+    """
+    Returns the {sample_period: intensities} of the .pk logs in 'data_dir_path', one entry per device configuration
+    """
+    _profiles = {}
+    for path in sorted(glob.glob(os.path.join(data_dir_path, "*.pk"))):
+        for record in load_pickle_records(path):
+            _distances, _intensities = pickle_record_arrays(record)
+            if _intensities.dtype != np.uint8:
+                _intensities = _intensities[:, 22:-2] # Whole Ping message per ping (see sonar_log.py)
+            _sample_period = int(round((_distances[0, 1] - _distances[0, 0]) / (1480 * 12.5e-9)))
+            _profiles.setdefault(_sample_period, []).append(_intensities.astype(np.uint8))
+    return {sample_period: np.concatenate(profiles) for sample_period, profiles in _profiles.items()}
+
+
+def load_100622(data_dir_path: str, number_of_samples: int=1200):
+    """
+    Returns the {sample_period: intensities} of the Intensities*.csv exports in 'data_dir_path' (one "distance,intensity" ping per file, whole Ping message)
+    """
+    _profiles = {}
+    for path in sorted(glob.glob(os.path.join(data_dir_path, "Intensities*.csv"))):
+        _csv = np.loadtxt(path, delimiter=",")
+        if len(_csv) != number_of_samples + 24:
+            continue # Cropped export
+        _sample_period = int(round((_csv[1, 0] - _csv[0, 0]) / (1480 * 12.5e-9)))
+        _profiles.setdefault(_sample_period, []).append(_csv[22:-2, 1].astype(np.uint8))
+    return {sample_period: np.stack(profiles) for sample_period, profiles in _profiles.items()}
+
+
+def check_wall_profiles(processor: PingProcessor, data_dir_path: str, echoes: int, tolerance: float=0.05):
+    """
+    Checks that the best echo of every WALL_PROFILES profile is its wall
+
+    Raises:
+        SystemExit: if the detector misses a wall
+    """
+    _failed = []
+    for name, wall in WALL_PROFILES:
+        _csv = np.loadtxt(os.path.join(data_dir_path, name), delimiter=",")
+        processor.configure(int(round((_csv[1, 0] - _csv[0, 0]) / (1480 * 12.5e-9))), len(_csv) - 24)
+        _best = processor.process(_csv[22:-2, 1].astype(np.uint8), echoes).echoes.distance[0, 0]
+        print("{}: best echo at {:.2f} m, wall at {:.2f} m".format(name, _best, wall))
+        if not abs(_best - wall) <= tolerance:
+            _failed.append(name)
+    if _failed:
+        raise SystemExit("The detector missed the wall of {}".format(", ".join(_failed)))
+
+
+def benchmark(name: str, processor: PingProcessor, sample_period: int, intensities: np.ndarray, echoes: int, pings: int, repeat: int):
+    processor.configure(sample_period, intensities.shape[1])
+    _batches = [intensities[start:start + pings] for start in range(0, len(intensities), pings)]
+
+    def _run(k):
+        for batch in _batches:
+            processor.process(batch, k)
+
+    _number = 10
+    _argmax_time = min(timeit.repeat(lambda: _run(0), number=_number, repeat=repeat)) / _number / len(intensities)
+    _cfar_time = min(timeit.repeat(lambda: _run(echoes), number=_number, repeat=repeat)) / _number / len(intensities)
+
+    _result = processor.process(intensities, echoes)
+    _argmax = processor.process(intensities)
+    _detected = _result.echoes.count > 0
+    _range = processor.distances[-1]
+    _ping_rate = 1480 / (2 * _range) # [Hz] acoustic limit: one round trip to the end of the range per ping
+
+    print("{}: {} pings x {} samples, {:.2f} m range".format(name, *intensities.shape, _range))
+    print("  Strongest return: {:8.1f} us/ping".format(_argmax_time * 1e6))
+    print("  CFAR, {} echoes:   {:8.1f} us/ping ({:.0f} pings/s, {:.0f}x the {:.0f} Hz maximum ping rate)".format(
+        echoes, _cfar_time * 1e6, 1 / _cfar_time, 1 / (_cfar_time * _ping_rate), _ping_rate))
+    print("  Pings with an echo: {:.0%}, mean echoes per ping: {:.2f}, median SNR of the best echo: {:.1f} dB".format(
+        _detected.mean(), _result.echoes.count.mean(), np.nanmedian(_result.echoes.snr[:, 0]) if _detected.any() else np.nan))
+    print("  Best echo differs from the strongest return by more than 0.1 m in {:.0%} of the pings".format(
+        np.mean(np.abs(_result.likely_distance - _argmax.likely_distance) > 0.1)))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--data-dir", default="data", help="Data directory holding the 102122 and 100622 recordings")
+    parser.add_argument("--echoes", type=int, default=3, help="Echoes per ping (k)")
+    parser.add_argument("--pings", type=int, default=10, help="Pings per batch (N_samples)")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing repetitions")
+    args = parser.parse_args()
+
+    processor = PingProcessor()
+    check_wall_profiles(processor, args.data_dir, args.echoes)
+    for session, loader in (("102122", load_102122), ("100622", load_100622)):
+        for sample_period, intensities in loader(os.path.join(args.data_dir, session)).items():
+            benchmark("data/{} (sample period {})".format(session, sample_period), processor, sample_period, intensities,
+                      args.echoes, args.pings, args.repeat)
@@ -0,0 +1,272 @@
+"""
+Load test and latency benchmark of the Ping360 UDP service.
+
+Starts the Ping360 emulator (sensors/Ping360/ping360_emulator.py) and the service as subprocesses, then drives the service with an increasing number of concurrent clients. Every client sends requests taken in turn from the request mix and waits for each reply before sending the next, like the mission scripts do. For every number of clients, the benchmark records the end-to-end latency percentiles, the request and ping throughput, the lost requests and the CPU time the service spent per request.
+
+The results are written as JSON (with the commit they were measured on, and the per-stage latency statistics the service reports at the end of the run) so that runs can be compared across commits:
+    python3 -m benchmarks.bench_ping360_service --clients 1 4 16 --duration 10 --output results.json
+
+A request mix is a list of comma-separated request fields; 'angles' takes '+'-separated angles:
+    python3 -m benchmarks.bench_ping360_service --mix angle=300,n_samples=10 angles=100+300,n_samples=5,range=3
+
+An already running service (e.g. on the vehicle) can be benchmarked with --service HOST:PORT; its CPU time is only measured if --service-pid is given and it runs on this machine.
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Added the service's per-stage latency statistics to the results
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.1.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from util.comms.ping360_protocol import Ping360Request, Ping360Response, ProtocolError, FLAG_LOGGING, MAX_DATAGRAM_SIZE
+from util.tasks.ping_handlers import receive_angles_response, request_ping360_stats
+import dataclasses
+import json
+import numpy as np
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_MIX = (
+    "angle=300,n_samples=10",                           # project1.py: starboard wall
+    "angle=100,n_samples=10",                           # port, forces the head around
+    "angles=100+300,n_samples=5",                       # both sides in one request
+    "angle=300,n_samples=10,range=2,readings=600",      # short range
+)
+
+REQUEST_FIELDS = {"angle": int, "n_samples": int, "range": float, "readings": int, "echoes": int, "integration": int, "max_std": float,
+                  "min_pings": int}
+
+
+def parse_mix(spec: str):
+    """
+    Returns the Ping360Request described by "field=value,..." (see REQUEST_FIELDS; 'angles' takes '+'-separated angles)
+    """
+    _fields = {"n_samples": 10, "angle": 300, "range": 5, "readings": 1200}
+    _angles = None
+    for item in spec.split(","):
+        _key, _value = item.split("=")
+        if _key == "angles":
+            _angles = [int(angle) for angle in _value.split("+")]
+        elif _key in REQUEST_FIELDS:
+            _fields[_key] = REQUEST_FIELDS[_key](_value)
+        else:
+            raise ValueError("Unknown request field '{}'".format(_key))
+    if _angles is not None:
+        del _fields["angle"]
+        return Ping360Request.for_angles(_angles, **_fields)
+    return Ping360Request(**_fields)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as _socket:
+        _socket.bind(("127.0.0.1", 0))
+        return _socket.getsockname()[1]
+
+
+def process_cpu_time(pid: int):
+    """
+    Returns the CPU time [s] (user + system) used by a process so far, or None if it cannot be read (Linux only)
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as file:
+            _fields = file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(_fields[11]) + int(_fields[12])) / os.sysconf("SC_CLK_TCK") # utime and stime, in clock ticks
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def send_request(client_socket, address: tuple, request: Ping360Request):
+    """
+    Sends a request and waits for its whole reply
+
+    Returns:
+        The number of pings received
+    """
+    client_socket.sendto(request.pack(), address)
+    if request.angles:
+        return len(receive_angles_response(client_socket, request, MAX_DATAGRAM_SIZE).records)
+    return len(Ping360Response.unpack(client_socket.recv(MAX_DATAGRAM_SIZE)).records)
+
+
+def wait_for_service(address: tuple, timeout: float=30.0):
+    """
+    Waits until the service answers a request; the first acquisition also waits for the head to reach the angle
+    """
+    _request = Ping360Request(n_samples=1, angle=300, range=5, readings=1200)
+    _deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as _socket:
+        _socket.settimeout(2.0)
+        while time.monotonic() < _deadline:
+            try:
+                send_request(_socket, address, _request)
+                return
+            except (socket.timeout, ConnectionRefusedError):
+                time.sleep(0.2)
+    raise TimeoutError("The Ping360 service at {}:{} did not answer".format(*address))
+
+
+def run_clients(address: tuple, requests: list, n_clients: int, duration: float, timeout: float=5.0, service_pid: int=None):
+    """
+    Runs 'n_clients' concurrent clients for 'duration' seconds
+
+    Returns:
+        A dictionary of the scenario's results
+    """
+    _latencies = [[] for _ in range(n_clients)]
+    _pings = [0] * n_clients
+    _errors = [0] * n_clients
+    _start = threading.Barrier(n_clients + 1)
+
+    def _client(index):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as _socket:
+            _socket.settimeout(timeout)
+            _next = index # Clients start at different points of the mix
+            _start.wait()
+            _stop = time.monotonic() + duration
+            while time.monotonic() < _stop:
+                _request = requests[_next % len(requests)]
+                _next += 1
+                _sent = time.perf_counter()
+                try:
+                    _pings[index] += send_request(_socket, address, _request)
+                except (socket.timeout, ConnectionRefusedError):
+                    _errors[index] += 1
+                    continue
+                _latencies[index].append(time.perf_counter() - _sent)
+
+    _threads = [threading.Thread(target=_client, args=(index,), daemon=True) for index in range(n_clients)]
+    for thread in _threads:
+        thread.start()
+    _cpu_start = process_cpu_time(service_pid) if service_pid else None
+    _start.wait()
+    _wall_start = time.perf_counter()
+    for thread in _threads:
+        thread.join()
+    _elapsed = time.perf_counter() - _wall_start
+    _cpu_end = process_cpu_time(service_pid) if service_pid else None
+
+    _all = np.concatenate([np.asarray(latencies) for latencies in _latencies]) * 1e3 # [ms]
+    _requests = len(_all)
+    _p50, _p95, _p99 = np.percentile(_all, (50, 95, 99)) if _requests else (np.nan,) * 3
+    return {
+        "clients": n_clients,
+        "duration_s": _elapsed,
+        "requests": _requests,
+        "errors": sum(_errors),
+        "latency_ms": {"p50": _p50, "p95": _p95, "p99": _p99, "mean": float(_all.mean()) if _requests else np.nan,
+                       "max": float(_all.max()) if _requests else np.nan},
+        "requests_per_second": _requests / _elapsed,
+        "pings_per_second": sum(_pings) / _elapsed,
+        "cpu_ms_per_request": (_cpu_end - _cpu_start) * 1e3 / _requests if _requests and _cpu_start is not None and _cpu_end is not None else None,
+    }
+
+
+def start_processes(args, data_dir_path: str):
+    """
+    Starts the emulator and the service; returns (service address, service process, [processes])
+    """
+    _emulator_port, _service_port = free_port(), free_port()
+    _emulator = [sys.executable, "-m", "sensors.Ping360.ping360_emulator", "--port", str(_emulator_port), "--latency", str(args.latency),
+                 "--jitter", str(args.jitter), "--head-speed", str(args.head_speed), "--seed", "0"]
+    if args.replay is not None:
+        _emulator += ["--replay", args.replay]
+    _service = [sys.executable, "-m", "sensors.Ping360.ping360_service", "--udp", "127.0.0.1:{}".format(_emulator_port),
+                "--port", str(_service_port), "--data-dir", data_dir_path] + args.service_args
+
+    _processes = [subprocess.Popen(_emulator, stdout=subprocess.DEVNULL)]
+    time.sleep(1.0) # The service exits if the device does not answer its initialize()
+    _processes.append(subprocess.Popen(_service, stdout=subprocess.DEVNULL))
+    return ("127.0.0.1", _service_port), _processes[-1], _processes
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, REMAINDER
+
+    parser = ArgumentParser(description="Load test and latency benchmark of the Ping360 UDP service")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8], help="Numbers of concurrent clients to run, one scenario each")
+    parser.add_argument("--duration", type=float, default=10, help="Duration [s] of each scenario")
+    parser.add_argument("--mix", nargs="+", default=list(DEFAULT_MIX), help="Request mix, e.g. angle=300,n_samples=10 angles=100+300")
+    parser.add_argument("--no-logging", action="store_true", help="Ask the service not to log the acquisitions")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Time [s] after which a request is counted as lost")
+    parser.add_argument("--latency", type=float, default=0.002, help="Emulator: time [s] added to every device reply")
+    parser.add_argument("--jitter", type=float, default=0.001, help="Emulator: maximum random time [s] added to the latency")
+    parser.add_argument("--head-speed", type=float, default=100, help="Emulator: head slew rate [grad/s]")
+    parser.add_argument("--replay", default=None, metavar="DIR", help="Emulator: replay the .pk logs of this directory")
+    parser.add_argument("--service", default=None, metavar="HOST:PORT", help="Benchmark a running service instead of starting one")
+    parser.add_argument("--service-pid", type=int, default=None, help="PID of the running service, to measure its CPU time")
+    parser.add_argument("--output", default=None, help="JSON file to write the results to (default: standard output)")
+    parser.add_argument("service_args", nargs=REMAINDER, help="Arguments passed to the service after '--', e.g. -- --coalesce-window 0.05")
+    args = parser.parse_args()
+    args.service_args = [arg for arg in args.service_args if arg != "--"]
+
+    requests = [parse_mix(spec) for spec in args.mix]
+    if not args.no_logging:
+        requests = [dataclasses.replace(_request, flags=_request.flags | FLAG_LOGGING) for _request in requests]
+
+    processes = []
+    with tempfile.TemporaryDirectory() as data_dir_path:
+        try:
+            if args.service is not None:
+                (host, port) = args.service.split(':')
+                address, service_pid = (host, int(port)), args.service_pid
+            else:
+                address, service, processes = start_processes(args, data_dir_path)
+                service_pid = service.pid
+            wait_for_service(address)
+
+            results = []
+            for n_clients in args.clients:
+                results.append(run_clients(address, requests, n_clients, args.duration, args.timeout, service_pid))
+                _result = results[-1]
+                print("{:3d} clients: {:6.1f} req/s, {:7.1f} pings/s, latency p50 {:7.1f} ms, p95 {:7.1f} ms, p99 {:7.1f} ms, {} lost, {} CPU ms/req".format(
+                    n_clients, _result["requests_per_second"], _result["pings_per_second"], _result["latency_ms"]["p50"],
+                    _result["latency_ms"]["p95"], _result["latency_ms"]["p99"], _result["errors"],
+                    "{:.2f}".format(_result["cpu_ms_per_request"]) if _result["cpu_ms_per_request"] is not None else "n/a"), file=sys.stderr)
+
+            try:
+                stats = request_ping360_stats(*address)
+                stage_stats = {"time_span_s": stats.time_span, "stages_ms": {
+                    _stage["stage"]: {key: value * 1e3 if key != "count" else value for key, value in _stage.items() if key != "stage"}
+                    for _stage in map(stats.stage, (record.decode() for record in stats.records['stage']))}}
+            except (OSError, ProtocolError):
+                stage_stats = None # A service without the stats request
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    report = {
+        "benchmark": "ping360_service",
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"mix": args.mix, "logging": not args.no_logging, "duration_s": args.duration, "emulator_latency_s": args.latency,
+                   "emulator_jitter_s": args.jitter, "head_speed": args.head_speed, "replay": args.replay, "service": args.service,
+                   "service_args": args.service_args},
+        "results": results,
+        "service_stats": stage_stats,
+    }
+    _json = json.dumps(report, indent=2, default=float)
+    if args.output is None:
+        print(_json)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(_json + "\n")
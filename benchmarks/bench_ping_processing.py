@@ -0,0 +1,117 @@
+"""
+Benchmark of the Ping360 processing engine against the original per-sample service loop.
+
+Both implementations process the same batch of synthetic Ping360 device_data messages. Run from the root of the repository:
+    python3 -m benchmarks.bench_ping_processing --pings 10 --samples 1200
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from brping import PingMessage, definitions
+from sensors.Ping360.ping_processing import PingProcessor
+import numpy as np
+import timeit
+
+
+def make_device_data(number_of_samples: int=1200, sample_period: int=225, seed: int=0):
+    """
+    Returns a received-like Ping360 device_data message with a noisy profile and a single strong echo at half the range
+    """
+    _rng = np.random.default_rng(seed)
+    _profile = _rng.integers(0, 100, number_of_samples, dtype=np.uint8)
+    _profile[number_of_samples // 2] = 255
+
+    _message = PingMessage(definitions.PING360_DEVICE_DATA)
+    _message.sample_period = sample_period
+    _message.number_of_samples = number_of_samples
+    _message.data_length = number_of_samples
+    _message.data = bytearray(_profile.tobytes())
+    _message.pack_msg_data()
+    return PingMessage(msg_data=bytearray(_message.msg_data))
+
+
+def legacy_loop(ping_messages, v_sound=1480, limit_low=0.8, limit_high=5.0):
+    """
+    The processing loop of ping360_service.py version 1.0.0, kept as the benchmark baseline
+    """
+    N_samples = len(ping_messages)
+    mps = v_sound * ping_messages[0].sample_period * 12.5e-9
+
+    Array_Distances = np.zeros((N_samples, len(ping_messages[0].msg_data)))
+    Array_Intensity = np.zeros((N_samples, len(ping_messages[0].msg_data)))
+    index_max = np.zeros(N_samples)
+    Intensity_max_return = np.zeros(N_samples)
+    Distance_max_return = np.zeros(N_samples)
+
+    for n in range(N_samples):
+        ping_data = ping_messages[n]
+        for i in range(len(ping_data.msg_data)):
+            Array_Distances[n, i] = i * mps
+            Array_Intensity[n, i] = ping_data.msg_data[i]
+
+        low_cutoff_index = int(limit_low/mps)
+        high_cutoff_index = int(limit_high/mps)
+
+        Array_int = Array_Intensity[n, :]
+        for i in range(low_cutoff_index):
+            Array_int[i] = 0.0
+        for i in range(len(Array_int) - high_cutoff_index):
+            Array_int[high_cutoff_index + i] = 0.0
+
+        index_max[n] = Array_int.argmax()
+        Intensity_max_return[n] = Array_Intensity[n, int(index_max[n])]
+        Distance_max_return[n] = Array_Distances[n, int(index_max[n])]
+
+    return Distance_max_return, Intensity_max_return
+
+
+def engine(processor: PingProcessor, ping_messages):
+    """
+    The same batch through the vectorized processing engine
+    """
+    processor.configure_from_message(ping_messages[0])
+    _intensities = processor.allocate(len(ping_messages))
+    for n, _message in enumerate(ping_messages):
+        _intensities[n] = processor.decode(_message)
+    _result = processor.process(_intensities)
+    return _result.likely_distance, _result.intensity_likely_distance
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--pings", type=int, default=10, help="Pings per request (N_samples)")
+    parser.add_argument("--samples", type=int, default=1200, help="Samples per ping (Readings)")
+    parser.add_argument("--sample-period", type=int, default=225, help="Sample period [25 ns]")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing repetitions")
+    args = parser.parse_args()
+
+    messages = [make_device_data(args.samples, args.sample_period, seed) for seed in range(args.pings)]
+    processor = PingProcessor()
+
+    # Both implementations must find the same echo
+    # (the legacy loop also counts the 22 message header bytes as samples, which shifts its distances)
+    _legacy_distance, _legacy_intensity = legacy_loop(messages)
+    _engine_distance, _engine_intensity = engine(processor, messages)
+    print("Same echo intensities:", np.array_equal(_legacy_intensity, _engine_intensity))
+    print("Echo distance [m]: legacy {:.3f}, engine {:.3f}".format(_legacy_distance[0], _engine_distance[0]))
+
+    legacy_time = min(timeit.repeat(lambda: legacy_loop(messages), number=1, repeat=args.repeat))
+    engine_number = 100
+    engine_time = min(timeit.repeat(lambda: engine(processor, messages), number=engine_number, repeat=args.repeat)) / engine_number
+
+    print("{} pings x {} samples".format(args.pings, args.samples))
+    print("Legacy loop:       {:10.3f} ms/request".format(legacy_time * 1e3))
+    print("Processing engine: {:10.3f} ms/request".format(engine_time * 1e3))
+    print("Speedup:           {:10.1f}x".format(legacy_time / engine_time))
@@ -0,0 +1,101 @@
+"""
+Target detection report of every recording of test sessions.
+
+All the pings of all the recordings are stacked into one array per device configuration and run through the service's PingProcessor in a single batch: range gating, strongest return and the CFAR echo detector. The detections are then summarized per recording (median over its pings) into <session>/detection_report.csv:
+
+    file, pings, angle [grad], range [m], intensity [ADC counts], snr [dB], strongest_range [m], second_range [m], second_intensity, second_snr [dB], detection_rate
+
+'range' is the likely distance of the service (the strongest CFAR echo, or the strongest in-range return if no echo stands out), 'strongest_range' the strongest in-range return whether it is an echo or not, 'second_*' the next echo of the same pings. Where 'range' and 'strongest_range' differ, the CFAR detector picked something other than the brightest target: check which one is the wall. Rerun the report whenever the detector changes; nothing is picked by hand.
+
+Run from the root of the repository:
+    python3 -m data.detection_report data/100622 data/102122
+"""
+
+from sensors.Ping360.ping_processing import PingProcessor
+from sensors.Ping360.sonar_dataset import load_session
+from sensors.Ping360.sonar_log import ANGLE_UNKNOWN
+import csv
+import numpy as np
+import os
+import warnings
+
+REPORT = "detection_report.csv"
+COLUMNS = ("file", "pings", "angle", "range", "intensity", "snr", "strongest_range", "second_range", "second_intensity", "second_snr", "detection_rate")
+
+
+def detect_session(recordings: dict, processor: PingProcessor, echoes: int=3):
+    """
+    Runs the detector on every ping of 'recordings' ({file name: SonarRecording}), one batch per device configuration.
+    Returns {file name: (PingBatchResult of the stacked batch, strongest in-range return [m] of its pings, slice of the recording's pings in it)}.
+    """
+    _groups = {}
+    for name, recording in recordings.items():
+        _groups.setdefault((recording.settings.sample_period, recording.settings.number_of_samples), []).append(name)
+
+    _detections = {}
+    for (sample_period, number_of_samples), names in _groups.items():
+        _stack = np.concatenate([recordings[name].intensities for name in names])
+        processor.configure(sample_period, number_of_samples)
+        _result = processor.process(_stack, echoes)
+        _strongest = processor.process(_stack).likely_distance
+        _bounds = np.cumsum([0] + [len(recordings[name]) for name in names])
+        for name, start, stop in zip(names, _bounds[:-1], _bounds[1:]):
+            _detections[name] = (_result, _strongest, slice(start, stop))
+    return _detections
+
+
+def summarize(recording, result, strongest: np.ndarray, pings: slice):
+    """
+    Returns the report row of a recording from its pings' detections
+    """
+    _echoes = result.echoes
+    _best = _echoes.index[pings, 0] >= 0
+    _second = _echoes.index[pings, 1] >= 0 if _echoes.index.shape[1] > 1 else np.zeros(pings.stop - pings.start, dtype=bool)
+    _angles = recording.angles[recording.angles != ANGLE_UNKNOWN]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # all-NaN medians of recordings without echoes
+        return (len(recording), int(np.median(_angles)) if len(_angles) else "",
+                float(np.median(result.likely_distance[pings])), float(np.median(result.intensity_likely_distance[pings])),
+                float(np.nanmedian(_echoes.snr[pings, 0])), float(np.median(strongest[pings])),
+                float(np.median(_echoes.distance[pings, 1][_second])) if _second.any() else np.nan,
+                float(np.median(_echoes.intensity[pings, 1][_second])) if _second.any() else np.nan,
+                float(np.nanmedian(_echoes.snr[pings, 1])) if _second.any() else np.nan,
+                float(_best.mean()))
+
+
+def session_report(session_dir: str, processor: PingProcessor, echoes: int=3, output: str=None):
+    """
+    Writes the detection report of a session directory (default: <session_dir>/detection_report.csv). Returns its rows.
+    """
+    _recordings = load_session(session_dir)
+    _detections = detect_session(_recordings, processor, echoes)
+    _rows = [(name,) + summarize(_recordings[name], *_detections[name]) for name in _recordings]
+    with open(output or os.path.join(session_dir, REPORT), "w", newline="") as file:
+        _writer = csv.writer(file)
+        _writer.writerow(COLUMNS)
+        _writer.writerows([[value if isinstance(value, (str, int)) else "{:.4f}".format(value) for value in row] for row in _rows])
+    return _rows
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Detect the targets of every recording of test sessions and write a per-file report")
+    parser.add_argument("sessions", nargs="*", default=[os.path.join(os.path.dirname(__file__), "100622")],
+                        help="Session directories (default: data/100622)")
+    parser.add_argument("--echoes", type=int, default=3, help="Echoes detected per ping (at least 2 for the second echo)")
+    parser.add_argument("--limit-low", type=float, default=0.8, help="Returns closer than this range [m] are rejected")
+    parser.add_argument("--limit-high", type=float, default=5.0, help="Returns at or beyond this range [m] are rejected")
+    parser.add_argument("--cfar-threshold", type=float, default=9.5, help="SNR [dB] above which the CFAR detector reports an echo")
+    parser.add_argument("--v-sound", type=float, default=1480, help="Speed of sound [m/s]")
+    args = parser.parse_args()
+
+    processor = PingProcessor(v_sound=args.v_sound, limit_low=args.limit_low, limit_high=args.limit_high, cfar_threshold=args.cfar_threshold)
+    for session_dir in args.sessions:
+        rows = session_report(session_dir, processor, max(args.echoes, 1))
+        print("{} -> {}".format(session_dir, os.path.join(session_dir, REPORT)))
+        print("  {:<24} {:>5} {:>5} {:>8} {:>6} {:>7} {:>9} {:>8} {:>7} {:>5}".format(
+            "file", "pings", "angle", "range", "int.", "SNR", "strongest", "2nd rng", "2nd SNR", "det."))
+        for name, pings, angle, distance, intensity, snr, strongest, second_range, _, second_snr, rate in rows:
+            print("  {:<24} {:>5} {:>5} {:8.3f} {:6.0f} {:7.1f} {:9.3f} {:8.3f} {:7.1f} {:5.0%}".format(
+                name, pings, angle, distance, intensity, snr, strongest, second_range, second_snr, rate))
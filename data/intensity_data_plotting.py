@@ -1,22 +1,143 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-
-dir = "data/100622 - Pool Testing/"
-
-for i in range(1, 14):
-    file = "Intensities" + str(i) + ".csv"
-    df = pd.read_csv(dir+file,names=["Range", "Acoustic Intensity"])
-    print (df)
-
-    x = df['Range']
-    y = df['Acoustic Intensity']
-
-    # plot
-    plt.scatter(x,y)
-    plt.title(file)
-    plt.xlabel("Range from Sensor [m]")
-    plt.ylabel("Acoustic Intensity [ADC Counts]")
-    plt.axvline(x=0.75, color="red", linestyle="-.")
-    # plt.show()
-    plt.savefig(fname=dir+"plots/"+"intensity_" + str(i) + "_100622.png")
-    plt.clf()
\ No newline at end of file
+"""
+Plots the acoustic intensity against range of every recording of a test session (see sensors/Ping360/sonar_dataset.py for the formats).
+
+The plots are rendered headless (Agg backend) in a process pool, into the plots/ directory of the session. plots/manifest.json keeps the hash of the inputs of every plot (the recording's content and the plot parameters); only the plots whose inputs changed, or that are missing, are rendered again. The manifest also keeps the size and modification time of every recording (see sonar_dataset.file_stamp()) with its digest, so a recording is only read and hashed again once its stamp changed.
+
+Run from the root of the repository:
+    python3 -m data.intensity_data_plotting data/100622 data/102122 --jobs 4
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sensors.Ping360.sonar_dataset import file_digest, file_stamp, load_recording, session_paths
+import hashlib
+import json
+import os
+import re
+
+PLOT_VERSION = 1 # bump when render_plot() changes
+PLOT_PARAMETERS = {
+    "deadzone": 0.75,       # [m] range drawn as the deadzone cutoff
+    "figsize": (6.4, 4.8),  # [in]
+    "dpi": 100,
+    "marker_size": 4,
+}
+MANIFEST = "manifest.json"
+
+
+def plot_name(path: str, session: str):
+    """
+    Returns the file name of the plot of a recording: intensity_<number>_<session>.png for Intensities<number>.csv, intensity_<file name>_<session>.png otherwise
+    """
+    _stem = os.path.splitext(os.path.basename(path))[0]
+    return "intensity_{}_{}.png".format(re.sub(r"^Intensities(?=.)", "", _stem), session)
+
+
+def plot_key(digest: str, parameters: dict):
+    """
+    Returns the hash of everything a plot depends on, from the (hex) digest of its recording and the plot parameters
+    """
+    _inputs = json.dumps([PLOT_VERSION, parameters, digest], sort_keys=True)
+    return hashlib.blake2b(_inputs.encode(), digest_size=16).hexdigest()
+
+
+def render_plot(path: str, png_path: str, parameters: dict):
+    """
+    Renders the plot of a recording, every ping of it overlaid. Runs in the worker processes.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    recording = load_recording(path)
+    fig, ax = plt.subplots(figsize=parameters["figsize"])
+    for profile in recording.intensities:
+        ax.scatter(recording.distances, profile, s=parameters["marker_size"], alpha=1 if len(recording) == 1 else 0.3)
+    ax.set_title(os.path.basename(path))
+    ax.set_xlabel("Range from Sensor [m]")
+    ax.set_ylabel("Acoustic Intensity [ADC Counts]")
+    ax.axvline(x=parameters["deadzone"], color="red", linestyle="-.")
+    _temporary = png_path + ".part.png"
+    fig.savefig(_temporary, dpi=parameters["dpi"])
+    plt.close(fig)
+    os.replace(_temporary, png_path)
+    return png_path
+
+
+def plot_session(session_dir: str, parameters: dict=PLOT_PARAMETERS, jobs: int=None, force: bool=False):
+    """
+    Renders the out-of-date plots of a session directory.
+    Returns the ({rendered png: None or the exception raised}, number of plots up to date).
+    """
+    _session = os.path.basename(os.path.normpath(session_dir))
+    _plots_dir = os.path.join(session_dir, "plots")
+    _manifest_path = os.path.join(_plots_dir, MANIFEST)
+    os.makedirs(_plots_dir, exist_ok=True)
+    try:
+        with open(_manifest_path) as file:
+            _manifest = json.load(file)
+    except (OSError, ValueError):
+        _manifest = {}
+
+    _paths = session_paths(session_dir)
+    _pending = {}
+    _refreshed = False
+    for path in _paths:
+        _name = plot_name(path, _session)
+        _entry = _manifest.get(_name)
+        _entry = _entry if isinstance(_entry, dict) else {}
+        _stamp = file_stamp(path).tolist()
+        # Only hash the recordings that changed size or modification time since the last run
+        _digest = _entry["digest"] if _entry.get("stamp") == _stamp else file_digest(path).hex()
+        _current = {"key": plot_key(_digest, parameters), "stamp": _stamp, "digest": _digest}
+        if force or _entry.get("key") != _current["key"] or not os.path.exists(os.path.join(_plots_dir, _name)):
+            _pending[_name] = (path, _current)
+        elif _entry != _current:
+            _manifest[_name] = _current # Same content with a new modification time, e.g. after a git checkout
+            _refreshed = True
+
+    _results = {}
+    if _pending:
+        with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, len(_pending))) as executor:
+            _futures = {executor.submit(render_plot, path, os.path.join(_plots_dir, name), parameters): name
+                        for name, (path, _) in _pending.items()}
+            for future in as_completed(_futures):
+                _name = _futures[future]
+                try:
+                    future.result()
+                    _manifest[_name] = _pending[_name][1]
+                    _results[_name] = None
+                except Exception as error: # one bad recording must not stop the session
+                    _manifest.pop(_name, None)
+                    _results[_name] = error
+
+    if _pending or _refreshed:
+        _temporary = _manifest_path + ".part"
+        with open(_temporary, "w") as file:
+            json.dump(_manifest, file, indent=1, sort_keys=True)
+        os.replace(_temporary, _manifest_path)
+    return _results, len(_paths) - len(_pending)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import time
+
+    parser = ArgumentParser(description="Plot the intensity against range of the recordings of test sessions")
+    parser.add_argument("sessions", nargs="*", default=[os.path.join(os.path.dirname(__file__), "100622")],
+                        help="Session directories (default: data/100622)")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes (default: the number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="Render every plot, even if up to date")
+    args = parser.parse_args()
+
+    failed = 0
+    for session_dir in args.sessions:
+        start = time.perf_counter()
+        results, up_to_date = plot_session(session_dir, jobs=args.jobs, force=args.force)
+        for name, error in sorted(results.items()):
+            print("  {}: {}".format(name, "rendered" if error is None else "failed ({}: {})".format(type(error).__name__, error)))
+        _failed = sum(error is not None for error in results.values())
+        print("{}: {} plots rendered, {} failed, {} up to date in {:.1f} s".format(
+            session_dir, len(results) - _failed, _failed, up_to_date, time.perf_counter() - start))
+        failed += _failed
+    if failed:
+        raise SystemExit("{} plots failed to render".format(failed))
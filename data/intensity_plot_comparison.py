@@ -1,18 +1,24 @@
-import pandas as pd
+# Run from the root of the repository: python3 -m data.intensity_plot_comparison
+from data.detection_report import detect_session
+from sensors.Ping360.ping_processing import PingProcessor
+from sensors.Ping360.sonar_dataset import load_recording
 import matplotlib.pyplot as plt
+import os
 
-dir = "data/100622 - Pool Testing/"
+dir = os.path.join(os.path.dirname(__file__), "100622") + os.sep
 
-df1 = pd.read_csv(dir+"Intensities1.csv",names=["Range", "Acoustic Intensity"])
-df7 = pd.read_csv(dir+"Intensities7.csv",names=["Range", "Acoustic Intensity"])
+recording1 = load_recording(dir+"Intensities1.csv")
+recording7 = load_recording(dir+"Intensities7.csv")
 
-x1 = df1['Range']
-y1 = df1['Acoustic Intensity']
-x7 = df7['Range']
-y7 = df7['Acoustic Intensity']
+x1 = recording1.distances
+y1 = recording1.intensities[0]
+x7 = recording7.distances
+y7 = recording7.intensities[0]
 
-print("Distance to wall:" + str(x1[y1[100:].argmax()+100]))
-print("Distance to barrel: " + str(x7[y7[150:].argmax()+150]))
+# same detector as the service and data/detection_report.py, no hand-picked bins
+detections = detect_session({"wall": recording1, "barrel": recording7}, PingProcessor(v_sound=1480, limit_low=0.8, limit_high=5.0))
+for target, (result, pings) in detections.items():
+    print("Distance to " + target + ": " + str(result.likely_distance[pings][0]))
 
 # plot
 plt.scatter(x1,y1)
@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 
-import struct, sys, re
+import mmap, os, struct, sys, re
 
 # 3.7 for dataclasses, 3.8 for walrus (:=) in recovery
 assert (sys.version_info.major >= 3 and sys.version_info.minor >= 8), \
     "Python version should be at least 3.8."
 
-from brping import PingParser, PingMessage
-from dataclasses import dataclass
-from typing import IO, Any, Set
+import numpy as np
+from brping import PingParser, PingMessage, definitions
+from dataclasses import dataclass, field
+from typing import IO, Any, Dict, List, Set, Tuple
 
 
 def indent(obj, by=' '*4):
@@ -62,6 +63,143 @@ class Header:
     """
 
 
+# Ping protocol frame header and checksum (see FRAME_LENGTH_OFFSET)
+FRAME_HEADER = struct.Struct('<2sHHBB')
+FRAME_CHECKSUM = struct.Struct('<H')
+
+
+def payload_dtype(message_id: int):
+    ''' Returns the NumPy dtype of the fixed-size fields of a message payload
+        (everything before the trailing variable-length 'data' field).
+    '''
+    _payload = definitions.payload_dict_all[message_id]
+    return np.dtype([(name, '<' + code) for name, code in
+                     zip(_payload['field_names'], _payload['format'])])
+
+
+@dataclass
+class ProfileArrays:
+    ''' The decoded profile messages of one message id.
+        'fields' is a structured array of the fixed payload fields of every
+        message, 'data' the profile samples of every message as uint8 views
+        into the log buffer (nothing copied).
+    '''
+    message_id: int
+    timestamps: List[str] = field(default_factory=list)
+    fields: np.ndarray = None
+    data: List[np.ndarray] = field(default_factory=list)
+
+    def samples(self):
+        ''' Returns the profiles as one (n_messages, n_samples) uint8 array.
+            Raises ValueError if the profiles have different lengths.
+        '''
+        if len({len(profile) for profile in self.data}) > 1:
+            raise ValueError('Profiles have different numbers of samples')
+        return np.stack(self.data) if self.data else \
+            np.empty((0, 0), dtype=np.uint8)
+
+
+# one entry of a LogIndex, per indexed frame
+INDEX_RECORD = np.dtype([
+    ('timestamp', '<f8'),   # seconds since midnight, unwrapped past midnight
+    ('message_id', '<u2'),
+    ('offset', '<u8'),      # frame position in the log (in overflow if cut)
+    ('length', '<u4'),      # frame length, header to checksum
+    ('cut', '?'),           # frame cut across two records
+    ('text', '<u8'),        # timestamp string position in the log
+    ('text_length', '<u2'),
+])
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index.npz' # sidecar file, next to the log
+
+
+def parse_timestamp(timestamp) -> float:
+    ''' Returns the seconds since midnight of a 'hh:mm:ss.xxx' timestamp
+        (str or bytes, with or without the Windows null bytes).
+    '''
+    if isinstance(timestamp, (bytes, bytearray)):
+        timestamp = timestamp.decode('UTF-8')
+    hours, minutes, seconds = timestamp.replace('\x00', '').split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+@dataclass
+class LogIndex:
+    ''' Sorted (timestamp, message_id, offset) entries of the frames of a
+        log, for random access through PingViewerLogReader.read().
+        'size' and 'mtime_ns' are the log's when it was indexed.
+    '''
+    entries: np.ndarray
+    overflow: bytes = b'' # frames cut across two records
+    size: int = 0
+    mtime_ns: int = 0
+    message_ids: Tuple[int, ...] = ()
+
+    def __post_init__(self):
+        self.ordered = bool(np.all(np.diff(self.entries['timestamp']) >= 0))
+        # positions of the entries of every message id, in log order
+        order = np.argsort(self.entries['message_id'], kind='stable')
+        ids, starts = np.unique(self.entries['message_id'][order],
+                                return_index=True)
+        self._by_id = dict(zip(ids.tolist(),
+                               np.split(order, starts[1:]) if len(ids) else []))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def matches(self, filename: str, message_ids: Set[int]):
+        ''' Whether this index is still valid for the log 'filename'. '''
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns) == (self.size, self.mtime_ns) \
+            and tuple(sorted(message_ids)) == self.message_ids
+
+    def select(self, start=None, stop=None, message_id: int = None):
+        ''' Returns the positions of the entries with
+            start <= timestamp < stop (seconds or 'hh:mm:ss.xxx' strings),
+            of one message id or all, found by binary search.
+        '''
+        if message_id is None:
+            positions = np.arange(len(self.entries))
+        else:
+            positions = self._by_id.get(message_id, np.empty(0, dtype=np.intp))
+        times = self.entries['timestamp'][positions]
+        start = -np.inf if start is None else \
+            parse_timestamp(start) if isinstance(start, str) else start
+        stop = np.inf if stop is None else \
+            parse_timestamp(stop) if isinstance(stop, str) else stop
+        if not self.ordered: # clock stepped back while logging
+            return positions[(times >= start) & (times < stop)]
+        return positions[np.searchsorted(times, start, 'left'):
+                         np.searchsorted(times, stop, 'left')]
+
+    def save(self, path: str):
+        with open(path, 'wb') as file: # np.savez would append '.npz'
+            np.savez(file, entries=self.entries,
+                     overflow=np.frombuffer(self.overflow, dtype=np.uint8),
+                     meta=np.array([INDEX_VERSION, self.size, self.mtime_ns],
+                                   dtype=np.int64),
+                     message_ids=np.array(self.message_ids, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path: str):
+        ''' Raises ValueError if the file is from another index version. '''
+        with np.load(path) as archive:
+            version, size, mtime_ns = archive['meta'].tolist()
+            if version != INDEX_VERSION or \
+                    archive['entries'].dtype != INDEX_RECORD:
+                raise ValueError(f'{path}: unsupported index version')
+            return cls(archive['entries'], archive['overflow'].tobytes(),
+                       size, mtime_ns,
+                       tuple(archive['message_ids'].tolist()))
+
+
+@dataclass
+class Corruption:
+    ''' A damaged part of a log, skipped by PingViewerLogReader.recover_at(). '''
+    offset: int  # of the bad size that was read
+    skipped: int # bytes skipped to the next readable record
+
+
 class PingViewerLogReader:
     ''' Structured as a big-endian sequence of
         size: uint32, data: byte_array[size].
@@ -87,6 +225,9 @@ class PingViewerLogReader:
         self.filename = filename
         self.header = Header()
         self.messages = []
+        self.frame_errors = 0 # frames with a bad checksum in bulk parsing
+        self._buffer = None # read-only mmap of the log, see open_buffer()
+        self.corruption: List[Corruption] = [] # damage skipped by recover_at()
 
     @classmethod
     def unpack_int(cls, file: IO[Any]):
@@ -112,6 +253,10 @@ class PingViewerLogReader:
 
     @classmethod
     def unpack_message(cls, file: IO[Any]):
+        ''' Returns the (timestamp, message) record at the position of 'file'.
+        Kept for compatibility: records() and parser() read the mapped log
+        directly.
+        '''
         timestamp = cls.unpack_string(file)
         message = cls.unpack_array(file)
         if message is None:
@@ -120,37 +265,47 @@ class PingViewerLogReader:
 
     @classmethod
     def recover(cls, file: IO[Any]):
+        ''' Attempt to recover 'file' from a failed read of the size in the
+        last cls.UINT.size bytes, see recover_at().
+        Returns the next readable (timestamp, message) record and leaves
+        'file' after it. Kept for compatibility with the file-based reader.
+        '''
+        file.seek(base := (file.tell() - cls.UINT.size))
+        data = file.read()
+        if (found := cls(getattr(file, 'name', '')).recover_at(data, 0)) \
+                is None:
+            raise EOFError('No timestamp match found in recovery attempt')
+        text_start, text_stop, start, stop = found
+        file.seek(base + stop)
+        return data[text_start:text_stop].decode('UTF-8'), data[start:stop]
+
+    def recover_at(self, data, pos: int):
         """ Attempt to recover from a failed read.
-        Assumed that a bad number has been read from the last cls.UINT.size
-        set of bytes -> try to recover by seeking 'file' back to there, then
-        read until the next timestamp, and continue as normal from there.
+        Assumed that a bad number has been read from the cls.UINT.size bytes
+        at 'pos' of the mapped log 'data' -> try to recover by searching the
+        rest of the log for the next timestamp followed by a valid message
+        size, and continue as normal from there.
+        Returns (timestamp_start, timestamp_stop, start, stop) offsets of the
+        recovered record, or None if the rest of the log is unreadable.
+        The bytes skipped are added to self.corruption.
         """
-        file.seek(current_pos := (file.tell() - cls.UINT.size))
-        prev_ = next_ = b''
-        start = amount_read = 0
-        while not (match := cls.TIMESTAMP_FORMAT.search(
-                roi := (prev_ + next_), start)):
-            prev_ = next_
-            next_ = file.read(cls.MAX_ARRAY_LENGTH)
-            if not next_:
+        bad_pos = pos
+        # one search over the mapped remainder, resumed after every timestamp
+        #  not followed by a valid size -> each byte is scanned only once
+        while match := self.TIMESTAMP_FORMAT.search(data, pos):
+            text_start, text_stop = match.span()
+            if text_stop + self.UINT.size > len(data):
                 break # run out of file
-            amount_read += cls.MAX_ARRAY_LENGTH
-            if start == 0 and prev_:
-                # onto the second read
-                # -> match on potential overlap + new region, not the
-                #    already-checked (impossible) region
-                start = cls.MAX_ARRAY_LENGTH - cls.MAX_TIMESTAMP_LENGTH
-        else:
-            # match was found
-            end = match.end()
-            timestamp = roi[match.start():end].decode('UTF-8')
-            # return the file pointer to the end of this timestamp
-            file.seek(current_pos + amount_read - (len(roi) - end))
-            # attempt to extract the corresponding message, or recover anew
-            if (message := cls.unpack_array(file)) is None:
-                return cls.recover(file)
-            return (timestamp, message)
-        raise EOFError('No timestamp match found in recovery attempt')
+            size = self.UINT.unpack_from(data, text_stop)[0]
+            if size <= self.MAX_ARRAY_LENGTH:
+                self.corruption.append(
+                    Corruption(bad_pos, text_start - bad_pos))
+                start = text_stop + self.UINT.size
+                return text_start, text_stop, start, \
+                    min(start + size, len(data))
+            pos = text_stop # bad size after this timestamp too
+        self.corruption.append(Corruption(bad_pos, len(data) - bad_pos))
+        return None
 
     def unpack_header(self, file: IO[Any]):
         self.header.string = self.unpack_string(file)
@@ -171,13 +326,9 @@ class PingViewerLogReader:
         """ Creates an iterator for efficient reading of self.filename.
         Yields (timestamp, message) pairs for decoding.
         """
-        with open(self.filename, "rb") as file:
-            self.unpack_header(file)
-            while "data available":
-                try:
-                    yield self.unpack_message(file)
-                except struct.error:
-                    break # reading complete
+        data = self.open_buffer()
+        for text_start, text_stop, start, stop in self.records():
+            yield data[text_start:text_stop].decode('UTF-8'), data[start:stop]
 
     def parser(self, message_ids: Set[int] = {1300, 2300, 2301}):
         """ Returns a generator that parses and decodes this log's messages.
@@ -186,6 +337,7 @@ class PingViewerLogReader:
             Default value is {1300, 2300, 2301} -> {Ping1D.profile,
                                                     Ping360.device_data,
                                                     Ping360.auto_device_data}
+        Byte by byte, and slow on long logs -> see bulk_parser() and profiles()
         """
         self._parser = PingParser()
 
@@ -201,6 +353,264 @@ class PingViewerLogReader:
                         break # this message is (should be?) over, get next one
                 # else message is still being parsed
 
+    def open_buffer(self):
+        """ Maps the log file into memory (read-only) on first use.
+        Returns the mmap (b'' for an empty file), shared by all the bulk and
+        indexed reads of this reader.
+        """
+        if self._buffer is None:
+            with open(self.filename, 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    self._buffer = b''
+                else:
+                    self._buffer = mmap.mmap(file.fileno(), 0,
+                                             access=mmap.ACCESS_READ)
+        return self._buffer
+
+    def close(self):
+        """ Releases the memory map. Arrays returned by profiles() keep it
+        mapped until they are freed.
+        """
+        if isinstance(self._buffer, mmap.mmap):
+            try:
+                self._buffer.close()
+            except BufferError:
+                pass # still exported to NumPy views, unmapped with them
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def records(self):
+        """ Walks the records of the mapped log without copying them.
+        Yields (timestamp_start, timestamp_stop, start, stop) offsets of the
+        timestamp string and of the message of every record.
+        Damaged records are skipped with recover_at(), and listed in
+        self.corruption (reset on every walk).
+        """
+        data = self.open_buffer()
+        self.corruption = []
+        with open(self.filename, 'rb') as file:
+            self.unpack_header(file) # file only read for the header
+            pos = file.tell()
+        end = len(data)
+        while pos + self.UINT.size <= end:
+            size = self.UINT.unpack_from(data, pos)[0]
+            if size > self.MAX_ARRAY_LENGTH: # bad timestamp size
+                record = self.recover_at(data, pos)
+            else:
+                text_start = pos + self.UINT.size
+                text_stop = text_start + size
+                if text_stop + self.UINT.size > end:
+                    return # reading complete
+                size = self.UINT.unpack_from(data, text_stop)[0]
+                if size > self.MAX_ARRAY_LENGTH: # bad message size
+                    record = self.recover_at(data, text_stop)
+                else:
+                    start = text_stop + self.UINT.size
+                    record = text_start, text_stop, start, \
+                        min(start + size, end)
+            if record is None:
+                return # nothing readable left
+            yield record
+            pos = record[3]
+
+    def _frames(self, message_ids: Set[int]):
+        """ Finds the frames of the log, see frames().
+        Yields (timestamp_start, timestamp_stop, message_id, frame, offset),
+        'offset' being the position of the frame in the file, or None if the
+        frame was cut across two records (and 'frame' is a copy).
+        """
+        data = self.open_buffer()
+        view = memoryview(data)
+        # parser() only accepts the messages brping can decode
+        wanted = set(message_ids) & set(definitions.payload_dict_all)
+        partial = bytearray() # start of a frame cut at the end of a message
+
+        for text_start, text_stop, pos, end in self.records():
+            while pos < end:
+                if partial:
+                    if len(partial) == 1 and data[pos] != ord('R'):
+                        partial.clear()
+                        pos += 1
+                        continue
+                    # header first, then the rest of the frame
+                    length = _frame_length(partial) or FRAME_LENGTH_OFFSET
+                    take = min(length - len(partial), end - pos)
+                    partial += view[pos:pos + take]
+                    pos += take
+                    if len(partial) < length or length == FRAME_LENGTH_OFFSET:
+                        continue
+                    frame, offset = memoryview(bytes(partial)), None
+                    partial.clear()
+                else:
+                    start = data.find(b'B', pos, end)
+                    if start < 0:
+                        break
+                    if start + 1 < end and data[start + 1] != ord('R'):
+                        pos = start + 2
+                        continue
+                    length = _frame_length(view[start:end])
+                    if length is None or start + length > end:
+                        partial += view[start:end]
+                        break
+                    frame, offset = view[start:start + length], start
+                    pos = start + length
+
+                message_id = FRAME_HEADER.unpack_from(frame)[2]
+                if not _checksum_ok(frame):
+                    self.frame_errors += 1
+                elif message_id in wanted:
+                    yield text_start, text_stop, message_id, frame, offset
+                    break # this message is (should be?) over, get next one
+
+    def frames(self, message_ids: Set[int] = {1300, 2300, 2301}):
+        """ Returns a generator of the Ping protocol frames of this log, found
+        in bulk (mmap.find, struct and NumPy) rather than byte by byte.
+        Yields (timestamp, message_id, frame) triplets, 'frame' being the
+        whole frame (header to checksum) as a memoryview of the mapped log.
+
+        Frames are found exactly like parser() finds them: the search for
+        'BR' resumes after every complete frame (valid or not), a 'B' not
+        followed by 'R' is skipped with the byte after it, a frame cut at the
+        end of a message is completed with the next message, and the rest of
+        a message is skipped once a frame in 'message_ids' was found in it.
+        """
+        data = self.open_buffer()
+        for text_start, text_stop, message_id, frame, _ in \
+                self._frames(message_ids):
+            yield data[text_start:text_stop].decode('UTF-8'), message_id, frame
+
+    def bulk_parser(self, message_ids: Set[int] = {1300, 2300, 2301}):
+        """ Drop-in replacement for parser(), yielding the same (timestamp,
+        message) pairs with 'message' decoded as a PingMessage, without
+        feeding the log through PingParser byte by byte.
+        """
+        for timestamp, _, frame in self.frames(message_ids):
+            yield timestamp, PingMessage(msg_data=bytearray(frame))
+
+    def profiles(self, message_ids: Set[int] = {1300, 2300, 2301}):
+        """ Decodes the profile messages of this log straight into NumPy
+        arrays, without creating a PingMessage per message.
+        Returns a {message_id: ProfileArrays} dictionary.
+        """
+        decoded: Dict[int, ProfileArrays] = {}
+        fixed: Dict[int, List[bytes]] = {}
+        for timestamp, message_id, frame in self.frames(message_ids):
+            dtype = payload_dtype(message_id)
+            if message_id not in decoded:
+                decoded[message_id] = ProfileArrays(message_id)
+                fixed[message_id] = []
+            arrays = decoded[message_id]
+            arrays.timestamps.append(timestamp)
+            payload_end = len(frame) - FRAME_CHECKSUM.size
+            fixed[message_id].append(
+                frame[FRAME_HEADER.size:FRAME_HEADER.size + dtype.itemsize])
+            arrays.data.append(np.frombuffer(
+                frame, dtype=np.uint8, offset=FRAME_HEADER.size + dtype.itemsize,
+                count=max(payload_end - FRAME_HEADER.size - dtype.itemsize, 0)))
+        for message_id, arrays in decoded.items():
+            # one decode of the fixed fields of all the messages at once
+            arrays.fields = np.frombuffer(b''.join(fixed[message_id]),
+                                          dtype=payload_dtype(message_id))
+        return decoded
+
+    def build_index(self, message_ids: Set[int] = {1300, 2300, 2301}):
+        """ Indexes the frames of this log in one pass, see index(). """
+        data = self.open_buffer()
+        entries, overflow = [], bytearray()
+        day = previous = 0.0
+        for text_start, text_stop, message_id, frame, offset in \
+                self._frames(message_ids):
+            seconds = parse_timestamp(data[text_start:text_stop])
+            if seconds + day < previous - 12 * 3600:
+                day += 24 * 3600 # the log went past midnight
+            previous = seconds + day
+            cut = offset is None
+            if cut: # not contiguous in the log, kept in the index itself
+                offset = len(overflow)
+                overflow += frame
+            entries.append((previous, message_id, offset, len(frame), cut,
+                            text_start, text_stop - text_start))
+        stat = os.stat(self.filename)
+        return LogIndex(np.array(entries, dtype=INDEX_RECORD), bytes(overflow),
+                        stat.st_size, stat.st_mtime_ns, tuple(sorted(message_ids)))
+
+    def index(self, message_ids: Set[int] = {1300, 2300, 2301},
+              rebuild: bool = False):
+        """ Returns the LogIndex of this log's frames, loaded from the sidecar
+        file next to the log (filename + INDEX_SUFFIX) if it is still valid,
+        otherwise built in one pass and cached there.
+        The sidecar is invalid once the log's size or modification time
+        changed, or if it indexed other message ids.
+        """
+        path = self.filename + INDEX_SUFFIX
+        if not rebuild:
+            try:
+                log_index = LogIndex.load(path)
+                if log_index.matches(self.filename, message_ids):
+                    return log_index
+            except (OSError, ValueError, KeyError):
+                pass # missing, stale or from another version -> rebuild
+        log_index = self.build_index(message_ids)
+        try:
+            log_index.save(path)
+        except OSError:
+            pass # read-only log directory, use the index from memory
+        return log_index
+
+    def read(self, log_index: 'LogIndex', positions=None):
+        """ Reads indexed frames straight from the mapped log.
+        Yields the same (timestamp, message) pairs as parser() for the
+        entries at 'positions' of 'log_index' (all of them by default), e.g.
+            reader.read(log_index, log_index.select('12:00:00.000',
+                                                    '12:05:00.000', 2300))
+        """
+        data = self.open_buffer()
+        view = memoryview(data)
+        entries = log_index.entries if positions is None else \
+            log_index.entries[positions]
+        for entry in entries:
+            offset, length = int(entry['offset']), int(entry['length'])
+            frame = log_index.overflow[offset:offset + length] if entry['cut'] \
+                else view[offset:offset + length]
+            text = int(entry['text'])
+            timestamp = data[text:text + int(entry['text_length'])]
+            yield timestamp.decode('UTF-8'), PingMessage(msg_data=bytearray(frame))
+
+    def between(self, start=None, stop=None, message_id: int = None):
+        """ Returns a generator of the (timestamp, message) pairs with
+        start <= timestamp < stop (seconds or 'hh:mm:ss.xxx' strings),
+        optionally of one message id only, using the cached index.
+        """
+        log_index = self.index()
+        return self.read(log_index, log_index.select(start, stop, message_id))
+
+
+# Ping protocol frame: 'BR', payload_length: uint16, message_id: uint16,
+#  src_device_id: uint8, dst_device_id: uint8, payload, checksum: uint16
+FRAME_LENGTH_OFFSET = 4 # payload_length is known after 4 bytes
+
+
+def _frame_length(frame):
+    """ Returns the total length of a frame from its first bytes, or None if
+    they do not hold the payload length yet.
+    """
+    if len(frame) < FRAME_LENGTH_OFFSET:
+        return None
+    return FRAME_HEADER.size + (frame[2] | frame[3] << 8) + FRAME_CHECKSUM.size
+
+
+def _checksum_ok(frame):
+    """ Checks a whole frame like PingMessage.verify_checksum() does. """
+    body = np.frombuffer(frame, dtype=np.uint8,
+                         count=len(frame) - FRAME_CHECKSUM.size)
+    checksum = FRAME_CHECKSUM.unpack_from(frame, len(body))[0]
+    return checksum == int(body.sum()) & 0xffff
+
 
 @dataclass(init=False, order=True)
 class Ping1DSettings:
@@ -263,12 +673,23 @@ if __name__ == "__main__":
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("file",
                         help="File that contains PingViewer sensor log file.")
+    parser.add_argument("--start", default=None,
+                        help="Only messages from this time (hh:mm:ss.xxx),"
+                             " read through the sidecar index.")
+    parser.add_argument("--stop", default=None,
+                        help="Only messages before this time (hh:mm:ss.xxx).")
+    parser.add_argument("--id", type=int, default=None,
+                        help="Only messages with this message id.")
     args = parser.parse_args()
 
     # Open log and begin processing
     log = PingViewerLogReader(args.file)
+    if args.start is None and args.stop is None and args.id is None:
+        messages = log.bulk_parser()
+    else:
+        messages = log.between(args.start, args.stop, args.id)
 
-    for index, (timestamp, decoded_message) in enumerate(log.parser()):
+    for index, (timestamp, decoded_message) in enumerate(messages):
         if index == 0:
             # Get header information from log
             # (parser has to do first yield before header info is available)
@@ -283,4 +704,8 @@ if __name__ == "__main__":
         print(decoded_message)
         # uncomment to confirm continuing after each message is printed
         out = input('q to quit, enter to continue: ')
-        if out.lower() == 'q': break
\ No newline at end of file
+        if out.lower() == 'q': break
+    # damage skipped while reading (only known for the records walked)
+    for damage in log.corruption:
+        print(f'recovered: {damage.skipped} bytes skipped'
+              f' from offset {damage.offset}')
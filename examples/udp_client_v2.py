@@ -1,6 +1,5 @@
 import socket
-import struct
-import pickle as pk
+from util.comms.ping360_protocol import Ping360Request, Ping360Response, FLAG_LOGGING
 
 serverAddressPort = ("192.168.2.2", 42069)
 bufferSize = 2048
@@ -8,23 +7,23 @@ bufferSize = 2048
 UDPClientSocket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
 
 # Configuration of sonar
-toserver = {
-    'Number of samples' : 10,
-    'Angle' : 300, #300 Starboard 100 port
-    "Enable Logging" : False,
-    "Range" : 5, # Range SONAR should scan [m]
-    "Readings": 1200 # Number of readings Ping360 should take
-}
+toserver = Ping360Request(
+    n_samples=10,
+    angle=300, #300 Starboard 100 port
+    range=5, # Range SONAR should scan [m]
+    readings=1200, # Number of readings Ping360 should take
+    flags=FLAG_LOGGING
+)
 
 # Sending sonar configuration to server
-UDPClientSocket.sendto(pk.dumps(toserver), serverAddressPort)
+UDPClientSocket.sendto(toserver.pack(), serverAddressPort)
 
 # Loading the data sent by the server
-msgFromServer = pk.loads(UDPClientSocket.recv(bufferSize))
+msgFromServer = Ping360Response.unpack(UDPClientSocket.recv(bufferSize))
 
-# Reading the dictionary sent by the server
-distance = msgFromServer[0]
-intensity = msgFromServer[1]
+# Reading the response sent by the server
+distance = msgFromServer.likely_distance
+intensity = msgFromServer.intensity_likely_distance
 
 print(distance)
-print(intensity)
\ No newline at end of file
+print(intensity)
@@ -6,13 +6,14 @@ CONOPS: The ROV will start from one edge of the pool and be placed about two met
 CHANGELOG:
  - Version 1.0.0: Initial release
  - Version 1.1.0: Refactored to clean up code and test new project directory layout
+ - Version 1.2.0: Fused the SONAR readings of every step into an occupancy grid of the pool, saved at the end of the run
 """
 
 __author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
 __copyright__   = "Copyright 2022"
 __credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
 __license__     = "MIT"
-__version__     = "1.1.0"
+__version__     = "1.2.0"
 __maintainer__  = "Braidan Duffy"
 __email__       = "bduffy2018@my.fit.edu"
 __status__      = "Prototype"
@@ -20,6 +21,21 @@ __status__      = "Prototype"
 from constants import *
 from util.commands.mav_movement import set_movement_power, set_target_depth
 from util.tasks.ping_handlers import run_ping360_service
+from util.mapping.occupancy_grid import OccupancyGrid
+import math
+
+STEP_LENGTH = 1.0 # [m] dead-reckoned distance covered by each forward step
+MAP_PATH = "data/project1_map.npz"
+
+def get_yaw(default: float=0.0):
+    """
+    Returns the latest vehicle yaw [rad] reported by the autopilot, or 'default' if no ATTITUDE message arrives
+    """
+    _attitude = master.recv_match(type='ATTITUDE', blocking=True, timeout=1)
+    return default if _attitude is None else _attitude.yaw
+
+grid = OccupancyGrid()
+north, east = 0.0, 0.0 # [m] dead-reckoned position from the start of the run
 
 try:
     # Wait a heartbeat before sending commands
@@ -50,7 +66,12 @@ try:
     for i in range (0, 7): # Take a certain number of steps (samples)
         set_movement_power(350, 0, 500, 0, 4) # Move forward at 1/3 speed
         set_movement_power(0, 0, 500, 0, 1) # Stop all movement
-        run_ping360_service() # Have the Ping360 collect readings
+        yaw = get_yaw()
+        north += STEP_LENGTH * math.cos(yaw)
+        east += STEP_LENGTH * math.sin(yaw)
+        response = run_ping360_service() # Have the Ping360 collect readings
+        grid.update_batch(north, east, yaw, [300] * len(response.likely_distance), response.likely_distance) # Default starboard angle and 5 m range
+        print(grid)
         # time.sleep(0.5) # Simulate taking readings
 
     set_target_depth(-0.0) # Set target depth to the surface
@@ -59,6 +80,7 @@ try:
     # Safe ROV after operation completes
     master.arducopter_disarm()
     master.motors_disarmed_wait()
+    grid.save(MAP_PATH)
 
 except KeyboardInterrupt:
     # Safe ROV after key board interrupt (Ctrl+C) is called in the terminal
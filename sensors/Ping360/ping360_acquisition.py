@@ -0,0 +1,310 @@
+"""
+Continuous background acquisition for the Ping360 service.
+
+A producer thread pings the configured angle(s) continuously and stores every profile in a bounded ring buffer. Readers get the freshest pings of an angle immediately, or wait for pings newer than a given timestamp, so the latency seen by a control loop is bounded by the processing time instead of the acquisition time.
+
+SweepAcquisition does the same for a whole sector using the auto-transmit mode of the Ping 360 (firmware 3.3.3+): the device sweeps from the start to the stop angle on its own and streams an auto_device_data message per ping, instead of the one transmitAngle() request/response round trip per angle. Every ping is decoded into the ring buffer as it arrives, and every few pings the newest ones are processed as one batch and handed to a callback (e.g. the service publishing sector updates).
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.0.1: Configure the Ping 360 through Ping360Config
+ - Version 1.1.0: Added the auto-transmit SweepAcquisition
+ - Version 1.1.1: Keep the last ping message, whose settings the service logs the buffered pings with
+ - Version 1.1.2: A full-circle sweep ends when the head crosses the start angle, a sector sweep when the head turns back
+ - Version 1.1.3: A sweep sector may wrap through 0 (e.g. 350 -> 50)
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.1.3"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from brping import Ping360, definitions
+from sensors.Ping360.ping360_config import Ping360Config
+from sensors.Ping360.ping_processing import PingProcessor
+import numpy as np
+import threading
+import time
+
+
+class PingRingBuffer:
+    """
+    Fixed-size, thread-safe ring buffer of raw Ping360 profiles with their timestamp and angle. The oldest ping is overwritten once the buffer is full.
+
+    Arguments:
+        capacity: the number of pings kept
+        number_of_samples: the number of samples per ping
+    """
+
+    def __init__(self, capacity: int, number_of_samples: int):
+        self.capacity = capacity
+        self.timestamps = np.full(capacity, -np.inf)     # [s] since EPOCH, -inf marks an empty slot
+        self.angles = np.full(capacity, -1, dtype=np.int16) # [grad]
+        self.intensities = np.zeros((capacity, number_of_samples), dtype=np.uint8)
+        self.count = 0 # total number of pings ever appended
+
+        self._condition = threading.Condition()
+
+    def append(self, timestamp: float, angle: int, profile: np.ndarray):
+        """
+        Stores a ping, overwriting the oldest one if the buffer is full, and wakes up any waiting reader
+        """
+        with self._condition:
+            _slot = self.count % self.capacity
+            self.timestamps[_slot] = timestamp
+            self.angles[_slot] = angle
+            self.intensities[_slot] = profile
+            self.count += 1
+            self._condition.notify_all()
+
+    def latest(self, angle: int, n: int=1, newer_than: float=None):
+        """
+        Returns copies of the (up to) 'n' most recent pings of 'angle', oldest first.
+
+        Arguments:
+            angle: the transmission angle [grad] of the pings
+            n: the maximum number of pings returned
+            newer_than: only return pings with a timestamp strictly greater than this [s]
+
+        Returns:
+            (timestamps, intensities) arrays of shape (k,) and (k, number_of_samples), k <= n
+        """
+        with self._condition:
+            _mask = self.angles == angle
+            if newer_than is not None:
+                _mask &= self.timestamps > newer_than
+            _slots = np.flatnonzero(_mask)
+            _slots = _slots[np.argsort(self.timestamps[_slots])][-n:]
+            return self.timestamps[_slots], self.intensities[_slots]
+
+    def wait_newer(self, angle: int, newer_than: float, timeout: float=None):
+        """
+        Blocks until a ping of 'angle' newer than 'newer_than' is available, or until 'timeout' [s] passes.
+
+        Returns:
+            True if such a ping is available, False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: bool(np.any((self.angles == angle) & (self.timestamps > newer_than))),
+                timeout)
+
+
+class ContinuousAcquisition(threading.Thread):
+    """
+    Producer thread that pings the configured angles in turn, forever, into a PingRingBuffer.
+    While it runs, this thread is the only user of the Ping 360.
+
+    Arguments:
+        ping360: an initialized Ping360 object
+        processor: the processing engine used to decode the pings and, later, by the readers
+        angles: the transmission angles [grad] to ping, in order
+        range: the range [m] the SONAR should scan
+        readings: the number of samples per ping
+        capacity: the number of pings kept in the ring buffer (default: 256)
+        config: the configuration cache of 'ping360' (default: a new Ping360Config)
+    """
+
+    def __init__(self, ping360: Ping360, processor: PingProcessor, angles, range: float=5, readings: int=1200, capacity: int=256,
+                 config: Ping360Config=None):
+        super().__init__(name="ping360-continuous", daemon=True)
+        self.ping360 = ping360
+        self.processor = processor
+        self.angles = [int(angle) for angle in angles]
+        self.range = range
+        self.readings = readings
+        self.buffer = PingRingBuffer(capacity, readings)
+        self.config = config or Ping360Config(ping360, processor.v_sound)
+        self.last_message = None # the last ping message received; holds the device settings of the buffered pings
+
+        self._stop_event = threading.Event()
+
+    def configure(self):
+        """
+        Applies the range and number of samples to the Ping 360 and the processing engine
+        """
+        self.config.apply(number_of_samples=self.readings, range=self.range)
+        _ping_data = self.ping360.transmitAngle(self.angles[0]) # Rotate the head to the first angle
+        self.processor.configure_from_message(_ping_data)
+        self.last_message = _ping_data
+
+    def run(self):
+        self.configure()
+        while not self._stop_event.is_set():
+            for angle in self.angles:
+                ping_data = self.ping360.transmitAngle(angle)
+                if ping_data is None:
+                    continue # No reply from the device in time, try the next angle
+                self.buffer.append(time.time(), angle, self.processor.decode(ping_data))
+                self.last_message = ping_data
+
+    def stop(self):
+        """
+        Asks the producer to stop after the current sweep of the angles
+        """
+        self._stop_event.set()
+
+    def read(self, angle: int, n: int=1, newer_than: float=None, timeout: float=None):
+        """
+        Returns the freshest processed pings of an angle without touching the Ping 360.
+
+        Arguments:
+            angle: the transmission angle [grad]; must be one of the configured angles
+            n: the maximum number of pings to process and return (default: 1)
+            newer_than: if given, wait (up to 'timeout' [s]) until pings newer than this timestamp [s] are available and only return those
+            timeout: the maximum time to wait for new pings [s] (default: no limit)
+
+        Returns:
+            (timestamps, PingBatchResult) for the returned pings, oldest first. May be empty.
+        """
+        if angle not in self.angles:
+            raise ValueError("Angle {} is not acquired continuously (angles: {})".format(angle, self.angles))
+
+        if newer_than is not None:
+            self.buffer.wait_newer(angle, newer_than, timeout)
+        timestamps, intensities = self.buffer.latest(angle, n, newer_than)
+        return timestamps, self.processor.process(intensities)
+
+
+class SweepAcquisition(ContinuousAcquisition):
+    """
+    Producer thread that sweeps a sector with the auto-transmit mode of the Ping 360 into a PingRingBuffer.
+    While it runs, this thread is the only user of the Ping 360.
+
+    Arguments:
+        ping360: an initialized Ping360 object
+        processor: the processing engine used to decode and process the pings
+        start_angle: the first angle [grad] of the sweep (default: 0)
+        stop_angle: the last angle [grad] of the sweep, clockwise from 'start_angle'; the sector may wrap through 0 (default: 399)
+        num_steps: the number of gradians between two pings (default: 1)
+        range: the range [m] the SONAR should scan
+        readings: the number of samples per ping
+        capacity: the number of pings kept in the ring buffer (default: 512)
+        config: the configuration cache of 'ping360' (default: a new Ping360Config)
+        sector_size: the number of pings processed and handed to 'on_sector' at once; the end of a sweep (the head crossing the start angle of a full circle, or turning back in a smaller sector) also ends a sector (default: 10)
+        delay: the pause between two pings [ms] (default: 0)
+        on_sector: called from this thread with (timestamps, angles, PingBatchResult) for every sector (default: None)
+        timeout: the time [s] without a ping after which auto-transmit is commanded again (default: 1.0)
+    """
+
+    def __init__(self, ping360: Ping360, processor: PingProcessor, start_angle: int=0, stop_angle: int=399, num_steps: int=1,
+                 range: float=5, readings: int=1200, capacity: int=512, config: Ping360Config=None, sector_size: int=10,
+                 delay: int=0, on_sector=None, timeout: float=1.0):
+        _span = (stop_angle - start_angle) % 400 # sectors may wrap around 0
+        super().__init__(ping360, processor, (start_angle + np.arange(0, _span + 1, num_steps)) % 400, range, readings, capacity, config)
+        self.name = "ping360-sweep"
+        self.start_angle = start_angle
+        self.stop_angle = stop_angle
+        self.num_steps = num_steps
+        self.sector_size = sector_size
+        self.delay = delay
+        self.on_sector = on_sector
+        self.timeout = timeout
+
+        # Metrics
+        self.pings = 0          # pings received
+        self.sweeps = 0         # sweeps completed
+        self.restarts = 0       # times auto-transmit was commanded again after a timeout
+        self._started_at = None
+
+    def configure(self):
+        """
+        Applies the range and number of samples to the Ping 360, then starts auto-transmit with them
+        """
+        self.config.apply(number_of_samples=self.readings, range=self.range)
+
+        def _setting(name):
+            _value = self.config.applied[name]
+            return getattr(self.ping360, "_" + name) if _value is None else _value
+
+        self.ping360.control_auto_transmit(
+            1, # mode, 1 for Ping360
+            _setting("gain_setting"),
+            _setting("transmit_duration"),
+            _setting("sample_period"),
+            _setting("transmit_frequency"),
+            _setting("number_of_samples"),
+            self.start_angle,
+            self.stop_angle,
+            self.num_steps,
+            self.delay
+        )
+
+    @property
+    def full_circle(self):
+        """
+        Whether the sweep covers the whole circle, which the head keeps turning the same way; a smaller sector is swept back and forth
+        """
+        return (self.stop_angle - self.start_angle) % 400 + 1 + self.num_steps > 400
+
+    def _publish(self, timestamps, angles, profiles):
+        if self.on_sector is None or not profiles:
+            return
+        self.on_sector(np.array(timestamps), np.array(angles), self.processor.process(np.stack(profiles)))
+
+    def run(self):
+        self.configure()
+        self._started_at = time.monotonic()
+        _timestamps, _angles, _profiles = [], [], []
+        _previous_angle, _previous_clockwise = None, None
+        try:
+            while not self._stop_event.is_set():
+                ping_data = self.ping360.wait_message([definitions.PING360_AUTO_DEVICE_DATA], self.timeout)
+                if ping_data is None:
+                    # No ping in time, e.g. the device reset: restart the sweep
+                    self.restarts += 1
+                    self.configure()
+                    _previous_angle, _previous_clockwise = None, None
+                    continue
+
+                # The profile view stays valid: the parser allocates a new buffer for every message
+                _timestamp = time.time()
+                _profile = self.processor.decode(ping_data)
+                self.buffer.append(_timestamp, ping_data.angle, _profile)
+                self.last_message = ping_data
+                self.pings += 1
+
+                if _previous_angle is not None:
+                    _step = (ping_data.angle - _previous_angle) % 400 # clockwise travel
+                    if self.full_circle:
+                        # The sweep ends when the head crosses the start angle, even if it steps over it
+                        _end = 0 < (self.start_angle - _previous_angle) % 400 <= _step
+                    else:
+                        _clockwise = _previous_clockwise if _step == 0 else _step < 200
+                        _end = _previous_clockwise is not None and _clockwise != _previous_clockwise
+                        _previous_clockwise = _clockwise
+                    if _end:
+                        self._publish(_timestamps, _angles, _profiles)
+                        _timestamps, _angles, _profiles = [], [], []
+                        self.sweeps += 1
+                _previous_angle = ping_data.angle
+
+                _timestamps.append(_timestamp)
+                _angles.append(ping_data.angle)
+                _profiles.append(_profile)
+                if len(_profiles) >= self.sector_size:
+                    self._publish(_timestamps, _angles, _profiles)
+                    _timestamps, _angles, _profiles = [], [], []
+        finally:
+            # Any other command stops auto-transmit; this one also releases the motor
+            self.ping360.control_motor_off()
+
+    def stop(self):
+        """
+        Asks the producer to stop auto-transmit after the current ping
+        """
+        self._stop_event.set()
+
+    @property
+    def pings_per_second(self):
+        if self._started_at is None or self.pings == 0:
+            return 0.0
+        return self.pings / (time.monotonic() - self._started_at)
+
+    def __str__(self):
+        return "SweepAcquisition: {} pings, {} sweeps, {:.1f} pings/s, {} restarts".format(
+            self.pings, self.sweeps, self.pings_per_second, self.restarts)
@@ -0,0 +1,126 @@
+"""
+Functions for configuring the Ping360 settings shared by the service and its acquisition modes
+
+Every Ping360 set_* call is a blocking round trip to the device. Ping360Config remembers the settings last applied to the device and only sends the ones that changed, counting the writes it skipped. A range is converted with the number of samples it already knows, so the get_device_data query of set_ping360_range() is not needed either; those queries are counted separately.
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Added the Ping360Config configuration cache
+ - Version 1.1.1: Count the get_device_data queries avoided apart from the skipped writes
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.1.1"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from brping import Ping360, definitions
+
+
+def sample_period_for_range(range: float, number_of_samples: int, v_sound: float=1480):
+    """
+    Returns the sample period, in 25 ns increments, for 'number_of_samples' samples to cover 'range' meters
+    """
+    return int(range/(v_sound * number_of_samples * 12.5e-9))
+
+
+def set_ping360_range(ping360: Ping360, range=2, v_sound=1480):
+    """
+    Sets the sample period of the Ping360 such that the current number of samples covers 'range' meters
+    """
+    _sample_period = sample_period_for_range(range, ping360.get_device_data()["number_of_samples"], v_sound)
+    return ping360.set_sample_period(_sample_period)
+
+
+class Ping360Config:
+    """
+    Configuration-state layer around a Ping360 object. Tracks the settings last applied to the device and only writes the ones that changed.
+
+    Arguments:
+        ping360: an initialized Ping360 object; its last reported settings seed the cache
+        v_sound: the operating speed of sound [m/s] used to convert ranges into sample periods (default: 1480)
+    """
+
+    # Settings tracked by the cache, in the order they are applied
+    SETTINGS = ("number_of_samples", "sample_period", "transmit_duration", "transmit_frequency", "gain_setting")
+
+    def __init__(self, ping360: Ping360, v_sound: float=1480):
+        self.ping360 = ping360
+        self.v_sound = v_sound
+
+        # Settings reported by the device during initialize(), None if unknown
+        self.applied = {setting: getattr(ping360, "_" + setting, None) for setting in self.SETTINGS}
+        self.round_trips = 0        # device writes sent
+        self.round_trips_saved = 0  # device writes skipped because the setting had not changed
+        self.queries_saved = 0      # get_device_data queries set_ping360_range() would have sent for a range
+
+    def set(self, setting: str, value: int):
+        """
+        Writes a single setting to the device, unless it already has that value
+
+        Returns:
+            True if the device was written to
+        """
+        value = int(value)
+        if self.applied[setting] == value:
+            self.round_trips_saved += 1
+            return False
+
+        self.round_trips += 1
+        _reply = getattr(self.ping360, "set_" + setting)(value)
+        if _reply is None or _reply.message_id != definitions.PING360_DEVICE_DATA:
+            self.applied[setting] = None # Unknown device state, write it again next time
+        else:
+            self.applied[setting] = getattr(_reply, setting)
+        return True
+
+    def apply(self, number_of_samples: int=None, range: float=None, **settings):
+        """
+        Applies the given settings to the device, skipping the ones that did not change.
+
+        Arguments:
+            number_of_samples: the number of samples per ping
+            range: the range [m] to scan; converted into a sample period for the number of samples
+            settings: other settings from SETTINGS (e.g. gain_setting=1)
+
+        Returns:
+            (sample_period, number_of_samples) as last reported by the device
+        """
+        if number_of_samples is not None:
+            self.set("number_of_samples", number_of_samples)
+        if range is not None:
+            # The number of samples is usually known here, no need to ask the device for it (set_ping360_range does)
+            _number_of_samples = self.applied["number_of_samples"] or number_of_samples
+            if _number_of_samples is None:
+                _number_of_samples = self.ping360.get_device_data()["number_of_samples"]
+            else:
+                self.queries_saved += 1
+            self.set("sample_period", sample_period_for_range(range, _number_of_samples, self.v_sound))
+        for setting, value in settings.items():
+            self.set(setting, value)
+        return self.applied["sample_period"], self.applied["number_of_samples"]
+
+    @property
+    def meters_per_sample(self):
+        """
+        The distance [m] covered by each sample with the applied sample period, or None if unknown
+        """
+        if self.applied["sample_period"] is None:
+            return None
+        # sample_period is in 25ns increments
+        # time of flight includes there and back, so divide by 2
+        return self.v_sound * self.applied["sample_period"] * 12.5e-9
+
+    def invalidate(self):
+        """
+        Forgets the applied settings, e.g. after another program (Ping Viewer) used the device
+        """
+        self.applied = dict.fromkeys(self.SETTINGS)
+
+    def __str__(self):
+        return "Ping360Config: {} device writes, {} saved, {} device data queries saved".format(
+            self.round_trips, self.round_trips_saved, self.queries_saved)
@@ -0,0 +1,399 @@
+"""
+Ping360 emulator: a local UDP device that speaks enough of the Ping protocol for brping.Ping360, so the service and the examples can be run, tested and benchmarked off the vehicle.
+
+The emulator answers the general requests sent by initialize() (protocol version, device information, device data), applies the settings of every transducer command and answers it with a device_data message, and runs the auto-transmit sweep (auto_transmit/motor_off) like the real head. The profiles are either synthesized from a Scene of walls and barrels around the head, or replayed from the service logs of a pool test (data/102122).
+
+The replies are timed like the device: the head slews to the angle of every ping at 'head_speed', the ping itself takes the time for the samples to come back, and 'latency' (+ up to 'jitter') is added for the link and the device firmware. Commands are handled one at a time in the order they arrive, like the device's serial link.
+
+Run from the root of the repository, then point the service at it:
+    python3 -m sensors.Ping360.ping360_emulator --port 12345 --latency 0.002
+    python3 -m sensors.Ping360.ping360_service --udp 127.0.0.1:12345
+
+    python3 -m sensors.Ping360.ping360_emulator --replay data/102122
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.0.1: ReplayScene keeps the sample spacing of every recorded profile, so sessions that mix sample periods replay at the right scale
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.1"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from brping import definitions, pingmessage, PingMessage, PingParser
+from sensors.Ping360.ping360_scheduler import head_travel
+from sensors.Ping360.sonar_log import load_pickle_records, pickle_record_arrays
+import asyncio
+import glob
+import numpy as np
+import os
+import random
+import struct
+
+DEVICE_TYPE_PING360 = 2
+PROTOCOL_VERSION = (1, 0, 0)
+FIRMWARE_VERSION = (3, 3, 0)
+
+MIN_SAMPLES = 200
+MAX_SAMPLES = 1200
+
+
+def pack_message(message: PingMessage):
+    """
+    Returns the bytes of a message. brping cannot pack a variable-length message whose data is empty (e.g. the device_data reply to a setting change), so those are packed here.
+    """
+    _fields = message.payload_dict[message.message_id]["field_names"]
+    if message.message_id not in pingmessage.variable_msgs or len(getattr(message, _fields[-1])):
+        return bytes(message.pack_msg_data())
+
+    message.update_payload_length()
+    _data = struct.pack(PingMessage.endianess + PingMessage.header_format, PingMessage.start_1, PingMessage.start_2, message.payload_length,
+                        message.message_id, message.src_device_id, message.dst_device_id)
+    _data += struct.pack(PingMessage.endianess + message.get_payload_format(), *(getattr(message, field) for field in _fields[:-1]))
+    return _data + struct.pack(PingMessage.endianess + PingMessage.checksum_format, sum(_data) & 0xffff)
+
+
+# =============
+# === SCENE ===
+# =============
+
+
+class Scene:
+    """
+    Synthetic surroundings of the SONAR head. Positions are in the frame of the head: x forward, y starboard [m]; head angle 200 points forward and angles increase clockwise (300 is starboard).
+
+    Arguments:
+        walls: ((x1, y1), (x2, y2)) segments (default: the project 1 pool, a wall 2 m to starboard and 10 m to port)
+        barrels: ((x, y), radius) cylinders (default: a barrel 0.5 m ahead against the starboard wall)
+        target_strength: the intensity [ADC counts] of an echo 1 m away with the normal gain (default: 200)
+        noise: the scale [ADC counts] of the Rayleigh background noise (default: 6)
+        ringdown: the intensity [ADC counts] of the transducer ringing at the head, decaying over ~0.15 m (default: 255)
+        beam_width: the beam width [rad] over which a surface still echoes (default: 2 degrees)
+        seed: the seed of the noise generator (default: None)
+    """
+
+    def __init__(self, walls=(((-20, 2), (20, 2)), ((-20, -10), (20, -10))), barrels=(((0.5, 1.6), 0.3),), target_strength: float=200,
+                 noise: float=6, ringdown: float=255, beam_width: float=np.radians(2), seed: int=None):
+        self.walls = np.asarray(walls, dtype=float).reshape(-1, 2, 2)
+        self.barrels = list(barrels)
+        self.target_strength = target_strength
+        self.noise = noise
+        self.ringdown = ringdown
+        self.beam_width = beam_width
+        self.rng = np.random.default_rng(seed)
+
+    def ranges(self, angle: int):
+        """
+        Returns the ranges [m] of the surfaces hit along the axis of the beam at a head angle [grad], nearest first
+        """
+        _bearing = (angle - 200) * np.pi / 200
+        _direction = np.array([np.cos(_bearing), np.sin(_bearing)])
+        _hits = []
+
+        # Ray-segment intersections, all walls at once
+        _start, _segment = self.walls[:, 0], self.walls[:, 1] - self.walls[:, 0]
+        _cross = _direction[0] * _segment[:, 1] - _direction[1] * _segment[:, 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            _t = (_start[:, 0] * _segment[:, 1] - _start[:, 1] * _segment[:, 0]) / _cross                   # along the ray
+            _u = (_start[:, 0] * _direction[1] - _start[:, 1] * _direction[0]) / _cross                     # along the wall
+        _hits.extend(_t[(_cross != 0) & (_t > 0) & (_u >= 0) & (_u <= 1)])
+
+        for (x, y), radius in self.barrels:
+            # Nearest intersection of the ray with the circle, widened by the beam width
+            _along = x * _direction[0] + y * _direction[1]
+            _across = abs(x * _direction[1] - y * _direction[0])
+            if _along > 0 and _across <= radius + _along * self.beam_width / 2:
+                _hits.append(_along - np.sqrt(max(radius ** 2 - _across ** 2, 0)))
+        return np.sort(_hits)
+
+    def profile(self, angle: int, number_of_samples: int, meters_per_sample: float, transmit_duration: int=32, gain_setting: int=1):
+        """
+        Returns the synthesized (number_of_samples,) uint8 profile of a ping
+        """
+        _distances = np.arange(number_of_samples) * meters_per_sample
+        _intensity = self.rng.rayleigh(self.noise, number_of_samples) + self.ringdown * np.exp(-_distances / 0.15)
+        # Echo as long as the transmitted pulse, and at least a few samples
+        _width = max(1480 * transmit_duration * 1e-6 / 2, 2 * meters_per_sample)
+        _shadow = 1.0
+        for distance in self.ranges(angle):
+            _intensity += _shadow * self.target_strength / max(distance, 1) * np.exp(-0.5 * ((_distances - distance) / _width) ** 2)
+            _shadow *= 0.3 # Surfaces behind a target only get part of the sound
+        _intensity *= (0.5, 1.0, 2.0)[min(gain_setting, 2)]
+        return np.clip(_intensity, 0, 255).astype(np.uint8)
+
+
+class ReplayScene:
+    """
+    Replays the recorded profiles of service .pk logs (e.g. data/102122) in order, looping at the end, whatever the head angle. Every profile is resampled from its own recorded sample spacing (a session may mix sample periods) to the requested range and number of samples; samples beyond the recorded range are background noise.
+
+    Arguments:
+        paths: the .pk logs
+        noise: the scale [ADC counts] of the Rayleigh noise beyond the recorded range (default: 6)
+    """
+
+    def __init__(self, paths, noise: float=6):
+        _profiles, _spacings = [], []
+        for path in paths:
+            for record in load_pickle_records(path):
+                _distances, _intensities = pickle_record_arrays(record)
+                if _intensities.dtype != np.uint8:
+                    _intensities = _intensities[:, 22:-2] # Whole Ping message per ping (see sonar_log.py)
+                _profiles.append(_intensities.astype(np.uint8))
+                _spacings.append(np.full(len(_intensities), float(_distances[0, 1] - _distances[0, 0])))
+        if not _profiles:
+            raise ValueError("No recorded pings to replay")
+        if len({profiles.shape[1] for profiles in _profiles}) > 1:
+            raise ValueError("The logs mix numbers of samples")
+
+        self.profiles = np.concatenate(_profiles)
+        self.meters_per_sample = np.concatenate(_spacings) # [m] sample spacing of every recorded profile
+        self.noise = noise
+        self.rng = np.random.default_rng()
+        self.next = 0
+
+    @classmethod
+    def from_dir(cls, data_dir_path: str, **kwargs):
+        return cls(sorted(glob.glob(os.path.join(data_dir_path, "*.pk"))), **kwargs)
+
+    def profile(self, angle: int, number_of_samples: int, meters_per_sample: float, transmit_duration: int=32, gain_setting: int=1):
+        _recorded, _recorded_spacing = self.profiles[self.next], self.meters_per_sample[self.next]
+        self.next = (self.next + 1) % len(self.profiles)
+        if number_of_samples == len(_recorded) and np.isclose(meters_per_sample, _recorded_spacing):
+            return _recorded.copy()
+
+        _distances = np.arange(number_of_samples) * meters_per_sample
+        _recorded_distances = np.arange(len(_recorded)) * _recorded_spacing
+        _intensity = np.interp(_distances, _recorded_distances, _recorded)
+        _beyond = _distances > _recorded_distances[-1]
+        _intensity[_beyond] = self.rng.rayleigh(self.noise, int(_beyond.sum()))
+        return np.clip(_intensity, 0, 255).astype(np.uint8)
+
+
+# ================
+# === EMULATOR ===
+# ================
+
+
+class Ping360Emulator(asyncio.DatagramProtocol):
+    """
+    Emulated Ping360 on a UDP port. Replies go to the address the last command came from.
+
+    Arguments:
+        scene: the Scene or ReplayScene the profiles are taken from
+        latency: the time [s] added to every reply for the link and the device firmware (default: 0.0)
+        jitter: the maximum random time [s] added to 'latency' (default: 0.0)
+        head_speed: the slew rate [grad/s] of the head (default: 100, as assumed by the scheduler)
+        v_sound: the speed of sound [m/s] used to convert sample periods into distances (default: 1480)
+    """
+
+    def __init__(self, scene, latency: float=0.0, jitter: float=0.0, head_speed: float=100, v_sound: float=1480):
+        self.scene = scene
+        self.latency = latency
+        self.jitter = jitter
+        self.head_speed = head_speed
+        self.v_sound = v_sound
+
+        # Device state, as reported in device_data
+        self.settings = {"mode": 1, "gain_setting": 0, "angle": 0, "transmit_duration": 32, "sample_period": 80,
+                         "transmit_frequency": 740, "number_of_samples": 1200}
+        self.head_angle = 0
+
+        self.transport = None
+        self._parsers = {}              # address -> PingParser
+        self._commands = asyncio.Queue()
+        self._worker = None
+        self._auto_transmit = None      # task of the running sweep
+
+        # Metrics
+        self.commands = 0
+        self.pings = 0
+        self.nacks = 0
+
+    # === Protocol ===
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._worker = asyncio.ensure_future(self._handle_commands())
+
+    def datagram_received(self, data, addr):
+        _parser = self._parsers.setdefault(addr, PingParser())
+        for byte in data:
+            if _parser.parse_byte(byte) == PingParser.NEW_MESSAGE:
+                self._commands.put_nowait((_parser.rx_msg, addr))
+
+    def send(self, message: PingMessage, addr):
+        self.transport.sendto(pack_message(message), addr)
+
+    # === Device ===
+
+    async def _delay(self, seconds: float=0.0):
+        await asyncio.sleep(seconds + self.latency + random.uniform(0, self.jitter))
+
+    def ping_time(self):
+        """
+        The time [s] a ping takes with the current settings: the pulse, then all the samples
+        """
+        return self.settings["transmit_duration"] * 1e-6 + self.settings["number_of_samples"] * self.settings["sample_period"] * 25e-9
+
+    def slew_time(self, angle: int):
+        """
+        The time [s] the head takes to turn to 'angle'
+        """
+        return head_travel(self.head_angle, angle) / self.head_speed
+
+    def device_data(self, message_id: int=definitions.PING360_DEVICE_DATA, transmit: bool=False, **auto_settings):
+        """
+        Returns a device_data (or auto_device_data) message with the current settings, with a profile at the head angle if 'transmit'
+        """
+        _message = PingMessage(message_id)
+        for field, value in {**self.settings, **auto_settings}.items():
+            setattr(_message, field, value)
+        _message.angle = self.head_angle
+        if transmit:
+            _meters_per_sample = self.v_sound * self.settings["sample_period"] * 12.5e-9
+            _message.data = bytearray(self.scene.profile(self.head_angle, self.settings["number_of_samples"], _meters_per_sample,
+                                                         self.settings["transmit_duration"], self.settings["gain_setting"]).tobytes())
+            self.pings += 1
+        _message.data_length = len(_message.data)
+        return _message
+
+    def nack(self, message_id: int, text: str):
+        _message = PingMessage(definitions.COMMON_NACK)
+        _message.nacked_id = message_id
+        _message.nack_message = text.encode()
+        self.nacks += 1
+        return _message
+
+    def stop_auto_transmit(self):
+        if self._auto_transmit is not None:
+            self._auto_transmit.cancel()
+            self._auto_transmit = None
+
+    async def _handle_commands(self):
+        while True:
+            _message, _addr = await self._commands.get()
+            self.commands += 1
+            try:
+                _reply = await self.handle_command(_message, _addr)
+            except Exception as e:
+                _reply = self.nack(_message.message_id, str(e) or type(e).__name__)
+            if _reply is not None:
+                self.send(_reply, _addr)
+
+    async def handle_command(self, message: PingMessage, addr):
+        """
+        Applies a command and returns the reply to send, if any
+        """
+        if message.message_id == definitions.COMMON_GENERAL_REQUEST:
+            await self._delay()
+            if message.requested_id == definitions.COMMON_PROTOCOL_VERSION:
+                _reply = PingMessage(definitions.COMMON_PROTOCOL_VERSION)
+                _reply.version_major, _reply.version_minor, _reply.version_patch = PROTOCOL_VERSION
+                return _reply
+            if message.requested_id == definitions.COMMON_DEVICE_INFORMATION:
+                _reply = PingMessage(definitions.COMMON_DEVICE_INFORMATION)
+                _reply.device_type = DEVICE_TYPE_PING360
+                _reply.firmware_version_major, _reply.firmware_version_minor, _reply.firmware_version_patch = FIRMWARE_VERSION
+                return _reply
+            if message.requested_id == definitions.PING360_DEVICE_DATA:
+                return self.device_data()
+            return self.nack(message.message_id, "Unsupported request {}".format(message.requested_id))
+
+        if message.message_id == definitions.PING360_TRANSDUCER:
+            self.stop_auto_transmit()
+            if not MIN_SAMPLES <= message.number_of_samples <= MAX_SAMPLES:
+                await self._delay()
+                return self.nack(message.message_id, "Number of samples out of range")
+            for field in self.settings:
+                self.settings[field] = getattr(message, field)
+            _angle = message.angle % 400
+            await self._delay(self.slew_time(_angle) + (self.ping_time() if message.transmit else 0))
+            self.head_angle = _angle
+            return self.device_data(transmit=bool(message.transmit))
+
+        if message.message_id == definitions.PING360_AUTO_TRANSMIT:
+            self.stop_auto_transmit()
+            for field in ("mode", "gain_setting", "transmit_duration", "sample_period", "transmit_frequency", "number_of_samples"):
+                self.settings[field] = getattr(message, field)
+            self._auto_transmit = asyncio.ensure_future(self.auto_transmit(
+                message.start_angle % 400, message.stop_angle % 400, max(message.num_steps, 1), message.delay, addr))
+            return None
+
+        if message.message_id == definitions.PING360_MOTOR_OFF:
+            self.stop_auto_transmit()
+            return None
+
+        await self._delay()
+        return self.nack(message.message_id, "Unsupported message {}".format(message.message_id))
+
+    async def auto_transmit(self, start_angle: int, stop_angle: int, num_steps: int, delay: int, addr):
+        """
+        Sweeps from 'start_angle' to 'stop_angle' clockwise, 'num_steps' gradians at a time, sending an auto_device_data message per ping until stopped. A full circle keeps turning the same way; a sector is swept back and forth.
+        """
+        _auto_settings = {"start_angle": start_angle, "stop_angle": stop_angle, "num_steps": num_steps, "delay": delay}
+        _sector = (stop_angle - start_angle) % 400 + 1
+        _full_circle = _sector + num_steps > 400
+        _offset, _direction = 0, 1
+        await self._delay(self.slew_time(start_angle))
+        self.head_angle = start_angle
+        while True:
+            _angle = (start_angle + _offset) % 400
+            await asyncio.sleep(head_travel(self.head_angle, _angle) / self.head_speed + self.ping_time() + delay * 1e-3)
+            self.head_angle = _angle
+            _message = self.device_data(definitions.PING360_AUTO_DEVICE_DATA, transmit=True, **_auto_settings)
+            if self.latency or self.jitter:
+                asyncio.get_running_loop().call_later(self.latency + random.uniform(0, self.jitter), self.send, _message, addr)
+            else:
+                self.send(_message, addr)
+
+            if _full_circle:
+                _offset = (_offset + num_steps) % 400
+            elif not 0 <= _offset + _direction * num_steps < _sector:
+                _direction = -_direction
+                _offset = min(max(_offset + _direction * num_steps, 0), _sector - 1)
+            else:
+                _offset += _direction * num_steps
+
+    def __str__(self):
+        return "Ping360Emulator: {} commands, {} pings, {} nacks, head at {} grad".format(self.commands, self.pings, self.nacks, self.head_angle)
+
+
+async def serve_emulator(emulator: Ping360Emulator, address: tuple):
+    """
+    Runs the emulator on a UDP address until cancelled
+    """
+    _loop = asyncio.get_running_loop()
+    _transport, _ = await _loop.create_datagram_endpoint(lambda: emulator, local_addr=address)
+    print("Ping360 emulator listening on {}:{}".format(*_transport.get_extra_info("sockname")))
+    try:
+        await asyncio.Future()
+    finally:
+        emulator.stop_auto_transmit()
+        _transport.close()
+        print(emulator)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Ping360 emulator for running the service off the vehicle")
+    parser.add_argument("--host", default="127.0.0.1", help="Address the emulator listens on")
+    parser.add_argument("--port", type=int, default=12345, help="UDP port the emulator listens on")
+    parser.add_argument("--replay", default=None, metavar="DIR", help="Replay the .pk logs of this directory (e.g. data/102122) instead of the synthetic scene")
+    parser.add_argument("--latency", type=float, default=0.0, help="Time [s] added to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random time [s] added to the latency")
+    parser.add_argument("--head-speed", type=float, default=100, help="Head slew rate [grad/s]")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the synthetic scene noise")
+    args = parser.parse_args()
+
+    scene = ReplayScene.from_dir(args.replay) if args.replay is not None else Scene(seed=args.seed)
+    emulator = Ping360Emulator(scene, args.latency, args.jitter, args.head_speed)
+    try:
+        asyncio.run(serve_emulator(emulator, (args.host, args.port)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,305 @@
+"""
+Log writers for the Ping360 service.
+
+SegmentLogWriter keeps one append-only log segment open at a time, named Ping360_data_{i}.pk inside a MMDDYY directory of the data directory. The segment index comes from a sequence counter stored next to the segments, so allocating a new segment never has to probe the file system for a free name. Segments are rotated once they reach a size or an age limit, and when the date changes.
+
+AsyncLogWriter moves the disk I/O of any such writer to a background thread behind a bounded queue, so that SD card latency on the Raspberry Pi never reaches the acquisition or the client replies. The records are written in batches with one flush per batch and a configurable fsync policy. Code running on an asyncio event loop queues its records with write_async(), which waits for room in the queue without blocking the loop.
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Added the AsyncLogWriter background writer thread
+ - Version 1.1.1: The spill buffer keeps the records as they are, so that it also works for writers that do not pickle (e.g. SonarSegmentLogWriter)
+ - Version 1.2.0: Added write_async(), so that the "block" policy never blocks the event loop
+ - Version 1.3.0: The spill buffer is bounded by 'max_spill'; the records that do not fit are counted as dropped
+ - Version 1.3.1: The spill buffer is drained without waiting on the empty queue; write_async() waits on its own thread instead of the loop's default executor
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.3.1"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import asyncio
+import os
+import pickle as pk
+import queue
+import re
+import threading
+import time
+
+
+class SegmentLogWriter:
+    """
+    Appends records to rotating log segments.
+
+    Arguments:
+        data_dir_path: the data directory; segments are written to its MMDDYY subdirectory, which is created if needed
+        prefix: the segment file name prefix (default: "Ping360_data")
+        extension: the segment file extension (default: ".pk")
+        max_bytes: rotate once a segment reaches this size in bytes, None for no limit (default: 64 MiB)
+        max_age: rotate once a segment is this old in seconds, None for no limit (default: None)
+    """
+
+    SEQUENCE_FILENAME = ".{prefix}_sequence"
+
+    def __init__(self, data_dir_path: str, prefix: str="Ping360_data", extension: str=".pk", max_bytes: int=64 << 20, max_age: float=None):
+        self.data_dir_path = data_dir_path
+        self.prefix = prefix
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.log_dir_path = None    # MMDDYY directory of the open segment
+        self.log_filename = None    # path of the open segment
+        self.sequence = None        # index of the open segment
+        self._file = None
+        self._opened_at = None
+        self._date = None
+
+    def _next_sequence(self):
+        """
+        Returns the index of the next segment in the current log directory and persists the counter
+        """
+        _counter_path = os.path.join(self.log_dir_path, self.SEQUENCE_FILENAME.format(prefix=self.prefix))
+        try:
+            with open(_counter_path) as counter:
+                _sequence = int(counter.read())
+        except (OSError, ValueError):
+            # No (valid) counter yet: scan the directory once, e.g. for logs written by an older service
+            _pattern = re.compile(re.escape(self.prefix) + r"_(\d+)" + re.escape(self.extension) + "$")
+            _indices = [int(match.group(1)) for match in map(_pattern.match, os.listdir(self.log_dir_path)) if match]
+            _sequence = max(_indices, default=-1) + 1
+
+        with open(_counter_path, 'w') as counter:
+            counter.write(str(_sequence + 1))
+        return _sequence
+
+    def _open(self):
+        """
+        Opens a new segment in the log directory of today
+        """
+        self._date = date.today()
+        self.log_dir_path = os.path.join(self.data_dir_path, self._date.strftime("%m%d%y")) # MMDDYY format e.g. 102122
+        os.makedirs(self.log_dir_path, exist_ok=True)
+
+        self.sequence = self._next_sequence()
+        self.log_filename = os.path.join(self.log_dir_path, "{}_{}{}".format(self.prefix, self.sequence, self.extension))
+        self._file = open(self.log_filename, 'ab')
+        self._opened_at = time.monotonic()
+
+    def _needs_rotation(self):
+        if self._file is None:
+            return True
+        if self.max_bytes is not None and self._file.tell() >= self.max_bytes:
+            return True
+        if self.max_age is not None and time.monotonic() - self._opened_at >= self.max_age:
+            return True
+        return date.today() != self._date
+
+    def rotate(self):
+        """
+        Closes the open segment; the next write opens a new one
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, record, flush: bool=True):
+        """
+        Appends a pickled record to the open segment, rotating it first if needed.
+        'record' may also be an already pickled record (bytes).
+        """
+        if self._needs_rotation():
+            self.rotate()
+            self._open()
+        if isinstance(record, bytes):
+            self._file.write(record)
+        else:
+            pk.dump(record, self._file, protocol=pk.HIGHEST_PROTOCOL)
+        if flush:
+            self._file.flush()
+
+    def flush(self, fsync: bool=False):
+        """
+        Flushes the open segment to the operating system, and to the disk if 'fsync' is set
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self.rotate()
+
+
+class AsyncLogWriter(threading.Thread):
+    """
+    Writes records through 'writer' on a background thread. write() only queues the record and never touches the disk.
+
+    Arguments:
+        writer: the writer doing the disk I/O (e.g. a SegmentLogWriter or SonarSegmentLogWriter); only this thread uses it
+        max_queue: the maximum number of records waiting to be written (default: 64)
+        policy: what write() does when the queue is full (default: "drop_oldest")
+            "drop_oldest": discard the oldest queued record to make room
+            "block": wait until the writer thread makes room (write_async() waits without blocking the event loop)
+            "spill": keep the record in a memory buffer of up to 'max_spill' records and write it once the queue has drained; the records that arrive while the buffer is full are dropped
+        max_spill: the maximum number of records in the spill buffer of the "spill" policy (default: 1024)
+        batch_size: the maximum number of records written between two flushes (default: 16)
+        fsync: when the segment is fsync'ed to the disk (default: "interval")
+            "never": leave it to the operating system
+            "batch": after every batch
+            "interval": after a batch, if the last fsync is older than 'fsync_interval'
+        fsync_interval: the minimum time [s] between two fsyncs with the "interval" policy (default: 5.0)
+    """
+
+    POLICIES = ("drop_oldest", "block", "spill")
+    FSYNC_POLICIES = ("never", "batch", "interval")
+
+    def __init__(self, writer: SegmentLogWriter, max_queue: int=64, policy: str="drop_oldest", max_spill: int=1024, batch_size: int=16,
+                 fsync: str="interval", fsync_interval: float=5.0):
+        super().__init__(name="ping360-log-writer", daemon=True)
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown back-pressure policy '{}' (one of {})".format(policy, self.POLICIES))
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy '{}' (one of {})".format(fsync, self.FSYNC_POLICIES))
+
+        self.writer = writer
+        self.policy = policy
+        self.max_spill = max_spill
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+
+        self._queue = queue.Queue(max_queue)
+        self._spill = deque()
+        self._closed = threading.Event()
+        self._last_fsync = time.monotonic()
+        # write_async() waits for room here, not in the loop's default executor, which the continuous mode reads run in
+        self._put_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ping360-log-put") if policy == "block" else None
+
+        # Metrics
+        self.written = 0            # records written
+        self.dropped = 0            # records discarded by the "drop_oldest" policy, or because the spill buffer was full
+        self.spilled = 0            # records that went through the spill buffer
+        self.max_queue_depth = 0    # deepest the queue has been
+        self.last_write_latency = 0.0   # [s] time spent writing the last batch
+        self.max_write_latency = 0.0    # [s] longest time spent writing a batch
+        self.total_write_latency = 0.0  # [s] time spent writing all batches
+        self.batches = 0
+
+    def write(self, record):
+        """
+        Queues a record to be written, applying the back-pressure policy if the queue is full. With the "block" policy this blocks the calling thread; use write_async() on an event loop.
+        """
+        if self._closed.is_set():
+            raise ValueError("write to a closed AsyncLogWriter")
+        if self.policy == "block":
+            self._queue.put(record)
+        elif self.policy == "spill" and (self._spill or self._queue.full()):
+            # Keep the order: once spilling, everything goes through the spill buffer until it drained
+            if len(self._spill) >= self.max_spill:
+                self.dropped += 1
+            else:
+                self._spill.append(record)
+                self.spilled += 1
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(record)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    async def write_async(self, record):
+        """
+        Queues a record from the asyncio event loop. With the "block" policy a full queue is waited on in the writer's own put thread, so the loop keeps serving the other clients; the other policies never wait.
+        """
+        if self.policy != "block":
+            self.write(record)
+            return
+        if self._closed.is_set():
+            raise ValueError("write to a closed AsyncLogWriter")
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(self._put_executor, self._queue.put, record)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _next_batch(self):
+        """
+        Takes up to 'batch_size' records: the queued ones first, then the spilled ones. Only waits for a record when both are empty.
+        """
+        _batch = []
+        try:
+            if not self._spill:
+                _batch.append(self._queue.get(timeout=0.5))
+            while len(_batch) < self.batch_size:
+                _batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        while self._spill and len(_batch) < self.batch_size and self._queue.empty():
+            _batch.append(self._spill.popleft())
+        return _batch
+
+    def _write_batch(self, batch):
+        _start = time.perf_counter()
+        for record in batch:
+            self.writer.write(record, flush=False)
+
+        _fsync = self.fsync == "batch" or (self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval)
+        self.writer.flush(fsync=_fsync)
+        if _fsync:
+            self._last_fsync = time.monotonic()
+
+        self.last_write_latency = time.perf_counter() - _start
+        self.max_write_latency = max(self.max_write_latency, self.last_write_latency)
+        self.total_write_latency += self.last_write_latency
+        self.batches += 1
+        self.written += len(batch)
+
+    def run(self):
+        while not (self._closed.is_set() and self._queue.empty() and not self._spill):
+            _batch = self._next_batch()
+            if _batch:
+                self._write_batch(_batch)
+        self.writer.flush(fsync=self.fsync != "never")
+        self.writer.close()
+
+    def close(self, timeout: float=None):
+        """
+        Writes every queued record, then closes the writer
+        """
+        if self._put_executor is not None and self.is_alive():
+            self._put_executor.shutdown(wait=True) # the records still waiting for room are queued first
+        self._closed.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        """
+        Returns the writer metrics as a dictionary
+        """
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "spill_depth": len(self._spill),
+            "written": self.written,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "last_write_latency": self.last_write_latency,
+            "max_write_latency": self.max_write_latency,
+            "mean_write_latency": self.total_write_latency / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,185 @@
+"""
+Lightweight latency instrumentation and logging for the Ping360 service.
+
+StageStats keeps one RollingHistogram per stage of the request path (device configuration, every transmitAngle, processing, logging, reply send, the whole request). A histogram has log-spaced bins, so recording a duration is a single bin increment and the memory used is fixed, whatever the number of requests. It is split into a few time windows that are recycled in turn, so the statistics cover the last 'window * n_windows' seconds rather than the whole run.
+
+RateLimitFilter is a logging filter that lets through at most 'rate' messages per second (with bursts of 'burst') of each kind, so that a failing client or device cannot flood the Raspberry Pi console; the number of suppressed messages is reported with the next message of the same kind that gets through.
+
+Example:
+    stats = StageStats(("transmit", "processing"))
+    with stats.timer("transmit"):
+        ping360.transmitAngle(300)
+    stats.snapshot()    # [("transmit", count, mean, p50, p95, p99, max), ...] [s]
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from contextlib import contextmanager
+import logging
+import numpy as np
+import threading
+import time
+
+
+class RollingHistogram:
+    """
+    Fixed-memory histogram of durations over a rolling time span. Not thread-safe; StageStats serializes the access.
+
+    Arguments:
+        min_value: the lower edge [s] of the first bin; shorter durations are counted in it (default: 1e-6)
+        max_value: the upper edge [s] of the last bin; longer durations are counted in it (default: 100.0)
+        bins_per_decade: the resolution of the bins; 20 bins per decade are ~12% wide (default: 20)
+        window: the time span [s] of each window (default: 10.0)
+        n_windows: the number of windows kept; the histogram covers the last window * n_windows seconds (default: 6)
+    """
+
+    def __init__(self, min_value: float=1e-6, max_value: float=100.0, bins_per_decade: int=20, window: float=10.0, n_windows: int=6):
+        self.window = window
+        self._log_min = np.log10(min_value)
+        self._bins_per_decade = bins_per_decade
+        self.n_bins = int(np.ceil((np.log10(max_value) - self._log_min) * bins_per_decade))
+        self.edges = 10 ** (self._log_min + np.arange(self.n_bins + 1) / bins_per_decade)
+
+        self.counts = np.zeros((n_windows, self.n_bins), dtype=np.int64)
+        self.sums = np.zeros(n_windows)     # [s] sum of the durations of each window, for the mean
+        self.maxima = np.zeros(n_windows)   # [s] longest duration of each window
+        self._window_index = 0
+        self._window_end = time.monotonic() + window
+
+    def _rotate(self, now: float):
+        """
+        Moves on to the window holding 'now', clearing the windows that expired
+        """
+        _n_windows = len(self.counts)
+        _elapsed = int((now - self._window_end) // self.window) + 1
+        for _ in range(min(_elapsed, _n_windows)):
+            self._window_index = (self._window_index + 1) % _n_windows
+            self.counts[self._window_index] = 0
+            self.sums[self._window_index] = 0
+            self.maxima[self._window_index] = 0
+        self._window_end += _elapsed * self.window
+
+    def record(self, value: float, now: float=None):
+        now = time.monotonic() if now is None else now
+        if now >= self._window_end:
+            self._rotate(now)
+        _bin = int((np.log10(max(value, 1e-12)) - self._log_min) * self._bins_per_decade)
+        self.counts[self._window_index, min(max(_bin, 0), self.n_bins - 1)] += 1
+        self.sums[self._window_index] += value
+        self.maxima[self._window_index] = max(self.maxima[self._window_index], value)
+
+    def summary(self, quantiles=(0.5, 0.95, 0.99), now: float=None):
+        """
+        Returns (count, mean, quantiles..., max) [s] over the windows kept. The quantiles are interpolated within their bin.
+        """
+        now = time.monotonic() if now is None else now
+        if now >= self._window_end:
+            self._rotate(now)
+        _counts = self.counts.sum(axis=0)
+        _count = int(_counts.sum())
+        if not _count:
+            return (0, np.nan) + (np.nan,) * len(quantiles) + (np.nan,)
+
+        _cumulative = np.cumsum(_counts)
+        _quantiles = []
+        for quantile in quantiles:
+            _rank = quantile * _count
+            _bin = int(np.searchsorted(_cumulative, _rank))
+            _below = _cumulative[_bin - 1] if _bin else 0
+            _fraction = (_rank - _below) / _counts[_bin]
+            # Geometric interpolation, the bins are log-spaced
+            _quantiles.append(float(self.edges[_bin] * (self.edges[_bin + 1] / self.edges[_bin]) ** _fraction))
+        _max = float(self.maxima.max())
+        return (_count, float(self.sums.sum() / _count)) + tuple(min(value, _max) for value in _quantiles) + (_max,)
+
+
+class StageStats:
+    """
+    Thread-safe rolling latency histograms of named stages, recorded from the event loop and the device thread alike.
+
+    Arguments:
+        stages: the names of the stages, in reporting order
+        histogram_settings: the settings of every RollingHistogram (e.g. window=10.0, n_windows=6)
+    """
+
+    def __init__(self, stages, **histogram_settings):
+        self._lock = threading.Lock()
+        self.histograms = {stage: RollingHistogram(**histogram_settings) for stage in stages}
+
+    @property
+    def time_span(self):
+        """
+        The time span [s] the statistics cover
+        """
+        _histogram = next(iter(self.histograms.values()))
+        return _histogram.window * len(_histogram.counts)
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.histograms[stage].record(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Records the duration of the 'with' block, including when it raises
+        """
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - _start)
+
+    def snapshot(self):
+        """
+        Returns the [(stage, count, mean, p50, p95, p99, max), ...] statistics [s] of every stage
+        """
+        _now = time.monotonic()
+        with self._lock:
+            return [(stage, *histogram.summary(now=_now)) for stage, histogram in self.histograms.items()]
+
+    def __str__(self):
+        return "\n".join("{:>10}: {:6d} in the last {:.0f} s, mean {:8.2f} ms, p50 {:8.2f} ms, p95 {:8.2f} ms, p99 {:8.2f} ms, max {:8.2f} ms".format(
+            stage, count, self.time_span, *(value * 1e3 for value in values)) for stage, count, *values in self.snapshot())
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per kind of message (logger, level and format string). Suppressed messages are counted and reported with the next message of their kind.
+
+    Arguments:
+        rate: the number of messages of each kind let through per second (default: 1.0)
+        burst: the number of messages of each kind let through at once (default: 5)
+    """
+
+    def __init__(self, rate: float=1.0, burst: int=5):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {} # (logger, level, msg) -> [tokens, last update time, messages suppressed]
+
+    def filter(self, record: logging.LogRecord):
+        _key = (record.name, record.levelno, record.msg)
+        _now = time.monotonic()
+        with self._lock:
+            _bucket = self._buckets.setdefault(_key, [self.burst, _now, 0])
+            _bucket[0] = min(self.burst, _bucket[0] + (_now - _bucket[1]) * self.rate)
+            _bucket[1] = _now
+            if _bucket[0] < 1:
+                _bucket[2] += 1
+                return False
+            _bucket[0] -= 1
+            _suppressed, _bucket[2] = _bucket[2], 0
+        if _suppressed:
+            record.msg = "{} ({} similar messages suppressed)".format(record.msg, _suppressed)
+        return True
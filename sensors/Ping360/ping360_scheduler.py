@@ -0,0 +1,106 @@
+"""
+Head-travel-aware scheduling of the Ping360 service acquisitions.
+
+The transducer head has to slew to the angle of every acquisition, and slewing takes longer than the pings themselves (e.g. port and starboard are 200 gradians apart). AngleScheduler holds the acquisitions waiting for the device and always starts the one closest to the current head position, so the angles of concurrent clients and of multi-angle requests are interleaved along the way instead of served in arrival order. A request that waited longer than 'max_wait' is served first regardless, so no client starves.
+
+The scheduler reports the head travel it saved compared with serving the oldest waiting acquisition next, in gradians and as an estimated time from the head slew rate.
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+import time
+
+
+def head_travel(from_angle: int, to_angle: int):
+    """
+    Returns the number of gradians the head turns to go from one angle to another, the short way around
+    """
+    _travel = abs(to_angle - from_angle) % 400
+    return min(_travel, 400 - _travel)
+
+
+class AngleScheduler:
+    """
+    Queue of acquisitions waiting for the Ping 360, ordered by head travel. Not thread-safe: only used from the service's event loop.
+
+    Arguments:
+        head_angle: the current head angle [grad], None if unknown (default: None)
+        head_speed: the head slew rate [grad/s] used to estimate the travel time saved (default: 100)
+        max_wait: the time [s] after which a waiting acquisition is served next, whatever the head travel (default: 1.0)
+    """
+
+    def __init__(self, head_angle: int=None, head_speed: float=100, max_wait: float=1.0):
+        self.head_angle = head_angle
+        self.head_speed = head_speed
+        self.max_wait = max_wait
+
+        self._waiting = {} # request -> time [s] it was added, in arrival order
+
+        # Metrics
+        self.scheduled = 0      # acquisitions started
+        self.travel = 0         # [grad] head travel of the scheduled acquisitions
+        self.travel_saved = 0   # [grad] head travel saved compared with serving the oldest acquisition next
+        self.expired = 0        # acquisitions served first because they waited longer than 'max_wait'
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, request):
+        return request in self._waiting
+
+    def add(self, request):
+        """
+        Adds an acquisition; 'request' needs an 'angle' attribute [grad]. Adding a request that is already waiting has no effect.
+        """
+        self._waiting.setdefault(request, time.monotonic())
+
+    def pop(self):
+        """
+        Removes and returns the acquisition to start next, and moves the head to its angle
+
+        Raises:
+            KeyError: if no acquisition is waiting
+        """
+        if not self._waiting:
+            raise KeyError("No acquisition is waiting")
+
+        _oldest, _added = next(iter(self._waiting.items()))
+        if self.head_angle is None:
+            _next = _oldest
+        elif time.monotonic() - _added >= self.max_wait:
+            _next = _oldest
+            self.expired += 1
+        else:
+            # min() keeps the oldest of equally close acquisitions
+            _next = min(self._waiting, key=lambda request: head_travel(self.head_angle, request.angle))
+
+        if self.head_angle is not None:
+            _travel = head_travel(self.head_angle, _next.angle)
+            self.travel += _travel
+            self.travel_saved += head_travel(self.head_angle, _oldest.angle) - _travel
+
+        del self._waiting[_next]
+        self.head_angle = _next.angle
+        self.scheduled += 1
+        return _next
+
+    @property
+    def travel_time_saved(self):
+        """
+        The estimated head travel time [s] saved
+        """
+        return self.travel_saved / self.head_speed
+
+    def __str__(self):
+        return "AngleScheduler: {} acquisitions, {} grad travelled, {} grad ({:.2f} s) saved, {} served for waiting too long".format(
+            self.scheduled, self.travel, self.travel_saved, self.travel_time_saved, self.expired)
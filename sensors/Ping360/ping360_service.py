@@ -1,188 +1,523 @@
-#!/usr/bin/env python
-
-"""
-ping360_service.py: This script starts a local server that connects to the Ping360 on the AUV and handles gathering data from it.
-This script is intended to run locally on the Raspberry Pi onboard the AUV and access the Ping 360 over a UDP connection.
-
-Client scripts can open a UDP connection to this service's port and the server will command the Ping 360 to begin gathering data along a heading. This service will then filter and parse the data such that the strongest return signal and distance from the AUV is returned to the client. The client may re-connect to the server as many times as desired and receive data.
-
-Note: On start-up there may be a slight delay between client connection and server data sent as the Ping360 SONAR head has to rotated around to the specified bearing. This delay will also be present if different services are trying to work with the Ping 360 such as Ping Viewer. Therefore, it is **not** advised that this service runs consecutively with the Blue Robotics Ping Viewer application.
-
-CHANGELOG:
- - Version 1.0.0: Initial release
-
-TODO:
- - Remove CSV logging features
- - Figure out how to properly filter max intensity accounting for reverb in signal
- - All client to configure certain parameters
-    - Angle of scanning
-    - Any Ping 360 parameters (e.g. range)
-    - If it wants the max intensity+location, min intensity+location, or all intensities+locations
-    - Minimum and maximum read distances
- - Add CLI argument parser for Ping 360 Serial (with port) or UDP (with IP address and port)
- -  
-"""
-
-__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene Castros"
-__copyright__   = "Copyright 2022"
-__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene Castros"]
-__license__     = "MIT"
-__version__     = "1.0.0"
-__maintainer__  = "Braidan Duffy"
-__email__       = "bduffy2018@my.fit.edu"
-__status__      = "Development"
-
-from brping import Ping360
-import numpy as np
-import socket
-import pickle as pk
-from datetime import date
-from os.path import exists
-
-# Ping initialization
-ping360 = Ping360()
-#myPing.connect_serial("COM4", 115200)
-# For UDP
-
-ping360.connect_udp("192.168.2.182", 12345)
-
-if ping360.initialize() is False:
-    print("Failed to initialize Ping!")
-    exit(1)
-
-# Server intialization
-localIP = "0.0.0.0"
-localPort = 42069
-bufferSize = 1024
-log_dir_path = "/home/pi/Koda-AUV/Koda-AUV/data/" + date.today().strftime("%m%d%y") # Create string for log directory in MMDDYY format e.g. 102122
-log_filename = ""
-
-udp_server_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM) # Create datagram socket
-udp_server_socket.bind((localIP, localPort)) # Bind to address and port
-
-# =========================
-# === SERVICE FUNCTIONS ===
-# =========================
-
-
-def set_ping360_range(range=2, v_sound=1480):
-    """
-    """
-    _sample_period = int(range/(v_sound * ping360.get_device_data()["number_of_samples"] * 12.5e-9))
-    return ping360.set_sample_period(_sample_period)
-
-
-def meters_per_sample(ping_message, v_sound=1480):
-    """
-    Returns the target distance per sample, in meters. 
-    
-    Arguments:
-        'ping_message' is the message being analysed.
-        'v_sound' is the operating speed of sound [m/s]. Default 1500.
-    """
-    # sample_period is in 25ns increments
-    # time of flight includes there and back, so divide by 2
-    return v_sound * ping_message.sample_period * 12.5e-9
-
-
-# ====================
-# === SERVICE LOOP ===
-# ====================
-
-
-while True:
-    # Listen for incoming datagrams from clients
-    message_address_pair = udp_server_socket.recvfrom(bufferSize)
-    client_message = pk.loads(message_address_pair[0])
-    client_address = message_address_pair[1]
-
-    # Reading the dictionary sent by the client
-    N_samples = client_message.get("Number of samples")
-    Angle = client_message.get("Angle")
-    logging = client_message.get("Enable Logging")
-    ping360_range = client_message.get("Range")
-    readings = client_message.get("Readings")
-
-    # Configure Ping360
-    ping360.set_number_of_samples(int(readings))
-    set_ping360_range(ping360_range)
-
-    # Get data from the Ping 360
-    # Transmission angle is in Gradians with 0 being forward (direction of penetrator) and increasing to 399 clockwise
-    # In the current AUV configuration (penetrator facing aft)
-    # 0     -> Aft
-    # 100   -> Port
-    # 200   -> Forward
-    # 300   -> Starboard
-    ping_data = ping360.transmitAngle(Angle)
-    # distance per sample
-    mps = meters_per_sample(ping_data)
-
-    # Initializing numpy arrays
-    Array_Distances = np.zeros((N_samples, len(ping_data.msg_data)))
-    Array_Intensity = np.zeros((N_samples, len(ping_data.msg_data)))
-    index_max = np.zeros(N_samples)
-    Intensity_max_return = np.zeros(N_samples)
-    Distance_max_return = np.zeros(N_samples)
-
-    for n in range(N_samples):
-        ping_data = ping360.transmitAngle(Angle)
-
-        # Compute distances and intensities of the different samples
-        for i in range(len(ping_data.msg_data)):
-            Array_Distances[n, i] = i * mps
-            Array_Intensity[n, i] = ping_data.msg_data[i]
-
-        # Reject all samples below 0.8 meters
-        limit_low = 0.8
-        limit_high = 5.0
-
-        # # # Calculate the difference array
-        # difference_array_low = np.absolute(Array_Distances[n, :] - limit_low)
-        # difference_array_high = np.absolute(Array_Distances[n, :] - limit_high)
-
-        # # Find the index of minimum element from the array
-        # limit_low_idx = difference_array_low.argmin()
-        # limit_high_idx = difference_array_high.argmin()
-
-        low_cutoff_index = int(limit_low/mps)
-        high_cutoff_index = int(limit_high/mps)
-
-        # Set all intensity values at a distance below 0.75m to zero
-        Array_int = Array_Intensity[n, :]
-        for i in range(low_cutoff_index):
-            Array_int[i] = 0.0
-
-        # Set all intensity values at a distance beyond 5m to zero
-        for i in range(len(Array_int) - high_cutoff_index):
-            Array_int[high_cutoff_index + i] = 0.0
-
-        # Find index of the true maximum return
-        index_max[n] = Array_int.argmax()
-
-        # Finding max intensity and distance where it was measured
-        Intensity_max_return[n] = Array_Intensity[n, int(index_max[n])]
-        Distance_max_return[n] = Array_Distances[n, int(index_max[n])]
-
-        # Create a dictionary of objects to send to client
-    to_client = {
-        'dimensions': Array_Distances,
-        'intensities' : Array_Intensity,
-        'likely_max_index' : index_max,
-        'likely_distance' : Distance_max_return,
-        'intensity_likely_distance' : Intensity_max_return
-    }
-
-    for i in range(0,9999):
-        log_filename = "{}/Ping360_data_{}.pk".format(log_dir_path, i)
-        # print(log_filename) # DEBUG
-        if not exists(log_filename):
-            break
-
-    with open(log_filename, 'ab') as workspace:
-        pk.dump(to_client, workspace, protocol=pk.HIGHEST_PROTOCOL)
-    
-    print(to_client["likely_distance"])
-    print(to_client["dimensions"])
-    udp_server_socket.sendto(pk.dumps((to_client["likely_distance"], to_client["intensity_likely_distance"])), client_address)
-
+#!/usr/bin/env python
+
+"""
+ping360_service.py: This script starts a local server that connects to the Ping360 on the AUV and handles gathering data from it.
+This script is intended to run locally on the Raspberry Pi onboard the AUV and access the Ping 360 over a UDP connection.
+
+Client scripts can open a UDP connection to this service's port and the server will command the Ping 360 to begin gathering data along a heading. This service will then filter and parse the data such that the strongest return signal and distance from the AUV is returned to the client. The client may re-connect to the server as many times as desired and receive data.
+
+The service is built on asyncio so that many clients (e.g. a topside viewer, the mission script and a logger) can be connected at once. All access to the Ping 360 is serialized through a single device owner task. Identical requests (same angle, range, number of samples and readings) that arrive while an acquisition for them is still waiting for the device are merged into that acquisition, and its result is sent to every requester. A merged acquisition is logged (once) if any of its requests set FLAG_LOGGING. The waiting acquisitions are started in the order that minimizes the travel of the transducer head (see ping360_scheduler.py), which interleaves the angles of concurrent clients.
+
+A request can list several angles or sectors (e.g. port and starboard); its angles are scheduled like separate requests and answered together in one multi-angle response.
+
+In continuous mode (--continuous), a producer thread pings the configured angles forever into a ring buffer (see ping360_acquisition.py) and requests are answered immediately with the freshest pings of their angle. A client can add a "Newer than" timestamp to its request to only receive pings taken after it; the reply then also carries the timestamp of every ping. The pings served to a request that sets FLAG_LOGGING are logged, each ping only once even if several requests are served it.
+
+In sweep mode (--sweep), the Ping 360 sweeps a sector on its own in auto-transmit mode (see SweepAcquisition). Requests are answered from the ring buffer as in continuous mode, and clients that set FLAG_SUBSCRIBE in a request are pushed a sector update every few pings for as long as they keep renewing the subscription. Every ping of the sweep is logged with its sector, so requests do not log anything in sweep mode.
+
+Every stage of the request path (device configuration, each transmitAngle, processing, logging, reply send and the whole request) is timed into rolling fixed-memory histograms (see ping360_metrics.py). A client can query their percentiles at any time with a stats request on the service port (see request_ping360_stats() in util/tasks/ping_handlers.py). Diagnostics go through a leveled, rate-limited logger instead of the console; --log-level debug shows the result of every request.
+
+Clients talk to the service with the binary protocol in util/comms/ping360_protocol.py. Legacy clients that still send pickled request dictionaries are answered with the pickled (likely_distance, intensity_likely_distance) tuple they expect, a single NaN reading if the request failed. Binary clients can also ask for the full intensity profiles, which are streamed after the response in MTU-sized chunks.
+
+Note: On start-up there may be a slight delay between client connection and server data sent as the Ping360 SONAR head has to rotated around to the specified bearing. This delay will also be present if different services are trying to work with the Ping 360 such as Ping Viewer. The scheduler reduces the delay between the acquisitions of the service itself. Therefore, it is **not** advised that this service runs consecutively with the Blue Robotics Ping Viewer application.
+
+Run from the root of the repository:
+    python3 -m sensors.Ping360.ping360_service --udp 192.168.2.182:12345
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Replaced the per-sample processing loops with the vectorized engine in ping_processing.py
+ - Version 1.2.0: Rewrote the service loop with asyncio to serve concurrent clients and coalesce identical requests; added CLI arguments
+ - Version 1.3.0: Added the continuous background acquisition mode with latest-value reads
+ - Version 1.4.0: Replaced pickle with the binary wire protocol; pickle clients are still served through a restricted unpickler
+ - Version 1.5.0: Added chunked streaming of the full intensity profiles
+ - Version 1.6.0: Only send the Ping 360 settings that changed since the last request (Ping360Config)
+ - Version 1.7.0: Log to rotating segments with a persistent sequence counter instead of probing for a free file name
+ - Version 1.8.0: Log on a background writer thread, only after the reply has been sent
+ - Version 1.9.0: Log to the columnar .sonar format (sonar_log.py) by default, with the time of every ping; --log-format pk keeps the pickle logs
+ - Version 1.10.0: Added the auto-transmit sweep mode with sector updates pushed to subscribed clients
+ - Version 1.11.0: Added multi-angle requests and the head-travel-aware acquisition scheduler
+ - Version 1.12.0: Added the per-request CFAR echo detector (ping_processing.py), returning the top-k echoes of every ping with their SNR
+ - Version 1.13.0: Added the multi-ping integration modes and the early exit of acquisitions once the range estimate is good enough
+ - Version 1.14.0: Added the per-stage latency histograms and the stats request; replaced the debug prints with a rate-limited logger
+ - Version 1.14.1: A full log queue with the "block" policy no longer blocks the event loop
+ - Version 1.14.2: Added --log-spill to bound the spill buffer of the "spill" log policy
+ - Version 1.14.3: Log the pings served to FLAG_LOGGING requests in continuous mode
+ - Version 1.14.4: Log every sector of the sweep mode
+ - Version 1.14.5: Log a merged acquisition if any of its requests set FLAG_LOGGING, not only the one that started it
+ - Version 1.14.6: Size the ring buffer of a sweep sector that wraps through 0 from its angles
+ - Version 1.14.7: Legacy clients get a NaN reply when their request fails instead of no reply
+
+TODO:
+ - Remove CSV logging features
+ - All client to configure certain parameters
+    - Angle of scanning
+    - Any Ping 360 parameters (e.g. range)
+    - If it wants the max intensity+location, min intensity+location, or all intensities+locations
+    - Minimum and maximum read distances
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene Castros"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene Castros"]
+__license__     = "MIT"
+__version__     = "1.14.7"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Development"
+
+from brping import Ping360
+from concurrent.futures import ThreadPoolExecutor
+from sensors.Ping360.ping360_acquisition import ContinuousAcquisition, SweepAcquisition
+from sensors.Ping360.ping360_config import Ping360Config
+from sensors.Ping360.ping360_log_writer import AsyncLogWriter, SegmentLogWriter
+from sensors.Ping360.ping360_metrics import RateLimitFilter, StageStats
+from sensors.Ping360.ping360_scheduler import AngleScheduler
+from sensors.Ping360.ping_processing import PingProcessor, INTEGRATION_MODES, range_standard_error
+from sensors.Ping360.sonar_log import SonarLogSettings, SonarPings, SonarSegmentLogWriter
+from util.comms.ping360_protocol import Ping360Request, Ping360Response, SectorUpdate, ProtocolError, message_type, pack_profile_chunks, \
+    loads_legacy_request, dumps_legacy_response, ServiceStats, MSG_REQUEST, MSG_STATS_REQUEST, FLAG_LOGGING, FLAG_PROFILES, FLAG_SUBSCRIBE, \
+    STATUS_OK, MAX_DATAGRAM_SIZE, expand_angles
+import asyncio
+import logging
+import numpy as np
+import time
+
+logger = logging.getLogger("ping360_service")
+logger.addFilter(RateLimitFilter(rate=1.0, burst=5))
+
+# Server defaults
+localIP = "0.0.0.0"
+localPort = 42069
+data_dir_path = "/home/pi/Koda-AUV/Koda-AUV/data/" # Logs go to its MMDDYY subdirectory e.g. 102122
+
+# =========================
+# === SERVICE FUNCTIONS ===
+# =========================
+
+
+class Ping360Service:
+    """
+    Serves Ping360 acquisitions to any number of concurrent clients.
+
+    Arguments:
+        ping360: an initialized Ping360 object. Only the device owner task uses it.
+        processor: the processing engine used for every acquisition
+        log_writer: the started AsyncLogWriter acquisitions are logged with
+        coalesce_window: how long [s] the device owner waits before starting an acquisition so that identical requests can be merged into it (default: 0.02)
+        continuous: if given, the continuous acquisition (or SweepAcquisition) that owns the Ping 360 and answers all requests (default: None, on-demand acquisitions)
+        newer_than_timeout: the maximum time [s] a continuous mode request waits for pings newer than its "Newer than" timestamp (default: 5.0)
+        max_datagram_size: the largest profile chunk datagram to send, in bytes (default: MAX_DATAGRAM_SIZE)
+        config: the configuration cache of 'ping360', shared with the continuous acquisition (default: a new Ping360Config)
+        log_format: "sonar" to log SonarPings records for a SonarSegmentLogWriter, "pk" to log the legacy result dictionaries (default: "sonar")
+        subscription_lease: sweep mode: how long [s] a FLAG_SUBSCRIBE request keeps its client subscribed to the sector updates (default: 10.0)
+        scheduler: the scheduler ordering the waiting acquisitions (default: a new AngleScheduler starting at the last reported head angle)
+        stats: the latency histograms of the request path stages (default: a new StageStats of STAGES)
+    """
+
+    LOG_FORMATS = ("sonar", "pk")
+    STAGES = ("configure", "transmit", "processing", "logging", "reply", "request")
+
+    def __init__(self, ping360: Ping360, processor: PingProcessor, log_writer: AsyncLogWriter, coalesce_window: float=0.02,
+                 continuous: ContinuousAcquisition=None, newer_than_timeout: float=5.0, max_datagram_size: int=MAX_DATAGRAM_SIZE,
+                 config: Ping360Config=None, log_format: str="sonar", subscription_lease: float=10.0,
+                 scheduler: AngleScheduler=None, stats: StageStats=None):
+        if log_format not in self.LOG_FORMATS:
+            raise ValueError("Unknown log format '{}' (one of {})".format(log_format, self.LOG_FORMATS))
+        self.ping360 = ping360
+        self.processor = processor
+        self.log_writer = log_writer
+        self.coalesce_window = coalesce_window
+        self.continuous = continuous
+        self.newer_than_timeout = newer_than_timeout
+        self.max_datagram_size = max_datagram_size
+        self.config = config or Ping360Config(ping360, processor.v_sound)
+        self.log_format = log_format
+        self.subscription_lease = subscription_lease
+        self.scheduler = scheduler or AngleScheduler(getattr(ping360, "_angle", None))
+        self.stats = stats or StageStats(self.STAGES)
+
+        self._waiting = None    # set while acquisitions are waiting in the scheduler
+        self._pending = {}      # Ping360Request -> future of an acquisition that has not started yet
+        self._pending_logging = set() # pending acquisitions that a FLAG_LOGGING request was merged into
+        self._stream_id = 0     # id of the last profile stream, 0 is never used
+        self._subscribers = {}  # client address -> end of its sector update subscription [loop time]
+        self._sector_sequence = 0
+        self._logged_until = {} # continuous mode: angle -> timestamp of the newest ping logged
+        self._transport = None
+        self._device_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ping360")
+
+    def acquire(self, request: Ping360Request):
+        """
+        Commands the Ping 360 and processes the returns for a request. Blocking; only ever runs on the device thread.
+
+        Returns:
+            (PingBatchResult, log record) of the acquisition
+        """
+        # Configure Ping360, only sending the settings that changed
+        with self.stats.timer("configure"):
+            self.config.apply(number_of_samples=request.readings, range=request.range)
+
+        # Get data from the Ping 360
+        # Transmission angle is in Gradians with 0 being forward (direction of penetrator) and increasing to 399 clockwise
+        # In the current AUV configuration (penetrator facing aft)
+        # 0     -> Aft
+        # 100   -> Port
+        # 200   -> Forward
+        # 300   -> Starboard
+        with self.stats.timer("transmit"):
+            ping_data = self.ping360.transmitAngle(request.angle)
+        self.processor.configure_from_message(ping_data)
+
+        # Decode the profile of every ping straight into the batch array
+        intensities = self.processor.allocate(request.n_samples)
+        timestamps = np.empty(request.n_samples)
+        distances = np.empty(request.n_samples) # per-ping ranges, for the early exit
+        for n in range(request.n_samples):
+            with self.stats.timer("transmit"):
+                _ping = self.ping360.transmitAngle(request.angle)
+            intensities[n] = self.processor.decode(_ping)
+            timestamps[n] = time.time()
+
+            # Stop as soon as the range estimate is good enough
+            if request.max_std is not None:
+                with self.stats.timer("processing"):
+                    distances[n] = self.processor.process(intensities[n], request.echoes).likely_distance[0]
+                if n + 1 >= request.min_pings and \
+                        range_standard_error(distances[:n + 1], INTEGRATION_MODES[request.integration]) <= request.max_std:
+                    intensities, timestamps = intensities[:n + 1], timestamps[:n + 1]
+                    break
+
+        # Reject all returns closer than 0.8 meters and beyond 5.0 meters, then find the strongest return of each ping
+        with self.stats.timer("processing"):
+            result = self.processor.process(intensities)
+        return result, self.log_record(request, ping_data, timestamps, result)
+
+    def log_record(self, request: Ping360Request, ping_data, timestamps: np.ndarray, result):
+        """
+        Returns the record logged for an acquisition. Built on the device thread, while 'ping_data' still holds the settings the pings were taken with.
+        """
+        if self.log_format == "pk":
+            return result.to_dict()
+        return SonarPings(SonarLogSettings.from_message(ping_data, self.processor.v_sound), timestamps, request.angle, result.intensities)
+
+    def continuous_log_record(self, request: Ping360Request, timestamps: np.ndarray, result):
+        """
+        Returns the record logged for the pings served to a request in continuous mode, or None if they were all logged already
+        """
+        _new = timestamps > self._logged_until.get(request.angle, -np.inf)
+        if self.continuous.last_message is None or not _new.any():
+            return None
+        self._logged_until[request.angle] = timestamps[_new].max()
+        if self.log_format == "pk":
+            return {name: value[_new] for name, value in result.to_dict().items()}
+        return SonarPings(SonarLogSettings.from_message(self.continuous.last_message, self.processor.v_sound), timestamps[_new],
+                          request.angle, result.intensities[_new])
+
+    async def read_continuous(self, request: Ping360Request):
+        """
+        Returns the freshest 'n_samples' processed pings of the request's angle from the continuous acquisition
+
+        Returns:
+            (timestamps, PingBatchResult)
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.continuous.read, request.angle, request.n_samples, request.newer_than, self.newer_than_timeout)
+
+    async def request(self, request: Ping360Request):
+        """
+        Returns the processed data for a request, merging it with an identical request that is still waiting for the device.
+        The acquisition is logged if any of the merged requests set FLAG_LOGGING.
+
+        Returns:
+            (PingBatchResult, log record or None if no merged request set FLAG_LOGGING, True if this request started the acquisition)
+        """
+        if request.flags & FLAG_LOGGING:
+            self._pending_logging.add(request)
+        if request in self._pending:
+            return (*await asyncio.shield(self._pending[request]), False)
+
+        _future = asyncio.get_running_loop().create_future()
+        self._pending[request] = _future
+        self.scheduler.add(request)
+        self._waiting.set()
+        return (*await asyncio.shield(_future), True)
+
+    async def device_owner(self):
+        """
+        The only task that accesses the Ping 360. Runs the scheduled acquisitions one at a time on the device thread.
+        """
+        _loop = asyncio.get_running_loop()
+        while True:
+            await self._waiting.wait()
+            await asyncio.sleep(self.coalesce_window) # Let identical requests join this acquisition
+            request = self.scheduler.pop()
+            if not self.scheduler:
+                self._waiting.clear()
+
+            # Requests arriving from now on need newer data than this acquisition will provide
+            _future = self._pending.pop(request)
+            _logging = request in self._pending_logging
+            self._pending_logging.discard(request)
+            try:
+                result, log_record = await _loop.run_in_executor(self._device_executor, self.acquire, request)
+                _future.set_result((result, log_record if _logging else None))
+            except Exception as e:
+                _future.set_exception(e)
+
+    def log_sector(self, timestamps: np.ndarray, angles: np.ndarray, result):
+        """
+        Logs the pings of a sector of the sweep. Runs on the sweep thread.
+        """
+        if self.log_format == "pk":
+            _record = result.to_dict()
+        else:
+            _record = SonarPings(SonarLogSettings.from_message(self.continuous.last_message, self.processor.v_sound), timestamps, angles,
+                                 result.intensities)
+        with self.stats.timer("logging"):
+            self.log_writer.write(_record)
+
+    def publish_sector(self, timestamps: np.ndarray, angles: np.ndarray, result):
+        """
+        Pushes a sector update of the sweep to every subscribed client. Runs on the event loop.
+        """
+        _now = asyncio.get_running_loop().time()
+        self._subscribers = {address: until for address, until in self._subscribers.items() if until > _now}
+        if not self._subscribers or self._transport is None:
+            return
+
+        self._sector_sequence += 1
+        _update = SectorUpdate.from_result(result, self.processor.meters_per_sample, timestamps, angles, self._sector_sequence)
+        for datagram in _update.pack(self.max_datagram_size):
+            for address in self._subscribers:
+                self._transport.sendto(datagram, address)
+
+    async def serve_request(self, request: Ping360Request):
+        """
+        Serves a single-angle request from the continuous acquisition, or through the device owner.
+        If the request asks for echoes or an integration mode, the pings are processed again for it alone; the shared acquisition is not changed.
+
+        Returns:
+            (Ping360Response, PingBatchResult, log record or None if there is nothing for this request to log)
+        """
+        timestamps = None
+        log_record = None
+        if self.continuous is not None:
+            timestamps, result = await self.read_continuous(request)
+            if request.flags & FLAG_LOGGING and not isinstance(self.continuous, SweepAcquisition): # the sweep logs its sectors
+                log_record = self.continuous_log_record(request, timestamps, result)
+        else:
+            result, log_record, owner = await self.request(request)
+            if not owner:
+                log_record = None
+
+        if request.echoes or request.integration:
+            result = await asyncio.get_running_loop().run_in_executor(None, self.process, result.intensities, request)
+        return Ping360Response.from_result(result, self.processor.meters_per_sample, timestamps), result, log_record
+
+    def process(self, intensities: np.ndarray, request: Ping360Request):
+        """
+        Processes pings again with the echo detector and integration mode of a request. Runs on a worker thread.
+        """
+        with self.stats.timer("processing"):
+            return self.processor.process(intensities, request.echoes, INTEGRATION_MODES[request.integration])
+
+    async def handle_datagram(self, transport: asyncio.DatagramTransport, data: bytes, client_address):
+        """
+        Serves one client datagram and replies to the client
+        """
+        _received = time.perf_counter()
+        legacy = False
+        log_records = []
+        try:
+            _type = message_type(data)
+            if _type == MSG_STATS_REQUEST:
+                transport.sendto(ServiceStats.from_snapshot(self.stats.snapshot(), self.stats.time_span).pack(), client_address)
+                return
+            if _type is None:
+                legacy = True
+                request = Ping360Request.from_client_message(loads_legacy_request(data))
+            elif _type == MSG_REQUEST:
+                request = Ping360Request.unpack(data)
+            else:
+                raise ProtocolError("Unexpected message type {}".format(_type))
+
+            if request.flags & FLAG_SUBSCRIBE:
+                self._subscribers[client_address] = asyncio.get_running_loop().time() + self.subscription_lease
+
+            if request.angles:
+                # Every angle is scheduled on its own; the scheduler picks the order
+                _served = await asyncio.gather(*map(self.serve_request, request.split()))
+                response = SectorUpdate.from_responses([response for response, _, _ in _served], request.angles)
+                log_records = [log_record for _, _, log_record in _served]
+            else:
+                response, result, log_record = await self.serve_request(request)
+                log_records = [log_record]
+        except Exception as e:
+            logger.warning("Failed to serve %s: %s", client_address, e)
+            response = Ping360Response.error() # a single NaN reading for legacy clients, which wait for a reply
+
+        logger.debug("%s: %s", client_address, response.likely_distance)
+        _reply_start = time.perf_counter()
+        if legacy:
+            transport.sendto(dumps_legacy_response(response), client_address)
+        elif isinstance(response, SectorUpdate):
+            # Multi-angle responses carry no profiles
+            for datagram in response.pack(self.max_datagram_size):
+                transport.sendto(datagram, client_address)
+        else:
+            if response.status == STATUS_OK and request.flags & FLAG_PROFILES:
+                self._stream_id = self._stream_id % 0xFFFF + 1
+                response.stream_id = self._stream_id
+
+            transport.sendto(response.pack(), client_address)
+
+            # Stream the full profiles after the response that announces them
+            if response.stream_id:
+                for chunk in pack_profile_chunks(response.stream_id, result.intensities, self.max_datagram_size):
+                    transport.sendto(chunk, client_address)
+
+        _replied = time.perf_counter()
+        self.stats.record("reply", _replied - _reply_start)
+        self.stats.record("request", _replied - _received)
+
+        # The client has its reply: hand the acquisitions to the writer thread (once, by the request that started them)
+        for log_record in log_records:
+            if log_record is not None:
+                with self.stats.timer("logging"):
+                    await self.log_writer.write_async(log_record)
+
+    async def serve(self, local_address=(localIP, localPort)):
+        """
+        Listens for client datagrams on 'local_address' forever
+        """
+        _loop = asyncio.get_running_loop()
+        self._waiting = asyncio.Event()
+        transport, _ = await _loop.create_datagram_endpoint(lambda: Ping360ServiceProtocol(self), local_addr=local_address)
+        self._transport = transport
+        try:
+            if isinstance(self.continuous, SweepAcquisition):
+                # Sectors are processed and logged on the sweep thread, and published from the event loop
+                def _on_sector(*sector):
+                    self.log_sector(*sector)
+                    _loop.call_soon_threadsafe(self.publish_sector, *sector)
+                self.continuous.on_sector = _on_sector
+            if self.continuous is not None:
+                # The producer thread owns the Ping 360; the device owner task is not needed
+                self.continuous.start()
+                await _loop.create_future()
+            else:
+                await self.device_owner()
+        finally:
+            if self.continuous is not None:
+                self.continuous.stop()
+            transport.close()
+            self._device_executor.shutdown(wait=True)
+            self.log_writer.close()
+            logger.info("%s", self.config)
+            logger.info("%s", self.scheduler)
+            if isinstance(self.continuous, SweepAcquisition):
+                logger.info("%s", self.continuous)
+            logger.info("Log writer: %s", self.log_writer.stats())
+            logger.info("Request path latency:\n%s", self.stats)
+
+
+class Ping360ServiceProtocol(asyncio.DatagramProtocol):
+    """
+    Hands every received datagram to the service as its own task so that clients never wait on each other
+    """
+
+    def __init__(self, service: Ping360Service):
+        self.service = service
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self.service.handle_datagram(self.transport, data, addr))
+
+
+# ====================
+# === SERVICE LOOP ===
+# ====================
+
+
+def connect_ping360(udp: str=None, serial: str=None, baudrate: int=115200):
+    """
+    Connects to and initializes the Ping 360 over UDP ("host:port") or a serial port. Exits if the device does not respond.
+    """
+    ping360 = Ping360()
+    if serial is not None:
+        ping360.connect_serial(serial, baudrate)
+    else:
+        (host, port) = udp.split(':')
+        ping360.connect_udp(host, int(port))
+
+    if ping360.initialize() is False:
+        logger.critical("Failed to initialize Ping!")
+        exit(1)
+    return ping360
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Ping360 UDP service")
+    parser.add_argument("--udp", default="192.168.2.182:12345", help="Ping360 UDP address. E.g: 192.168.2.182:12345")
+    parser.add_argument("--serial", default=None, help="Ping360 serial port, used instead of UDP. E.g: /dev/ttyUSB0")
+    parser.add_argument("--baudrate", type=int, default=115200, help="Ping360 serial baudrate")
+    parser.add_argument("--port", type=int, default=localPort, help="UDP port the service listens on")
+    parser.add_argument("--data-dir", default=data_dir_path, help="Data directory; acquisitions are logged to its MMDDYY subdirectory")
+    parser.add_argument("--log-format", choices=Ping360Service.LOG_FORMATS, default="sonar", help="Log segment format (see sonar_log.py)")
+    parser.add_argument("--log-max-bytes", type=int, default=64 << 20, help="pk logs: size [bytes] at which a log segment is rotated")
+    parser.add_argument("--log-capacity", type=int, default=4096, help="sonar logs: number of pings per log segment")
+    parser.add_argument("--log-max-age", type=float, default=None, help="Age [s] at which a log segment is rotated")
+    parser.add_argument("--log-queue", type=int, default=64, help="Maximum number of acquisitions waiting to be logged")
+    parser.add_argument("--log-policy", choices=AsyncLogWriter.POLICIES, default="drop_oldest", help="What to do when the log queue is full")
+    parser.add_argument("--log-spill", type=int, default=1024, help="spill policy: maximum number of acquisitions held in memory")
+    parser.add_argument("--fsync", choices=AsyncLogWriter.FSYNC_POLICIES, default="interval", help="When log segments are fsync'ed to the SD card")
+    parser.add_argument("--coalesce-window", type=float, default=0.02, help="Time [s] to wait for identical requests before an acquisition")
+    parser.add_argument("--continuous", type=int, nargs="+", default=None, metavar="ANGLE", help="Ping these angles [grad] continuously and serve the latest pings")
+    parser.add_argument("--sweep", type=int, nargs=2, default=None, metavar=("START", "STOP"), help="Sweep these angles [grad] clockwise (e.g. 350 50 wraps through 0) in auto-transmit mode and serve the latest pings")
+    parser.add_argument("--sweep-step", type=int, default=1, help="Sweep mode: gradians between two pings")
+    parser.add_argument("--sector-size", type=int, default=10, help="Sweep mode: number of pings per sector update")
+    parser.add_argument("--range", type=float, default=5, help="Continuous and sweep modes: range [m] the SONAR should scan")
+    parser.add_argument("--readings", type=int, default=1200, help="Continuous and sweep modes: number of samples per ping")
+    parser.add_argument("--buffer-size", type=int, default=256, help="Continuous and sweep modes: number of pings kept in the ring buffer")
+    parser.add_argument("--cfar-threshold", type=float, default=9.5, help="SNR [dB] above which the CFAR detector reports an echo")
+    parser.add_argument("--mtu", type=int, default=1500, help="MTU [bytes] of the link to the clients; profile chunks are sized to fit in it")
+    parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="info", help="Level of the service's console messages")
+    parser.add_argument("--log-rate", type=float, default=1.0, help="Console messages of each kind allowed per second")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    for _filter in logger.filters:
+        _filter.rate = args.log_rate
+
+    # Ping initialization
+    ping360 = connect_ping360(args.udp, args.serial, args.baudrate)
+
+    # Processing engine initialization
+    processor = PingProcessor(v_sound=1480, limit_low=0.8, limit_high=5.0, cfar_threshold=args.cfar_threshold)
+
+    config = Ping360Config(ping360, processor.v_sound)
+
+    continuous = None
+    if args.continuous is not None:
+        continuous = ContinuousAcquisition(ping360, processor, args.continuous, args.range, args.readings, args.buffer_size, config)
+    elif args.sweep is not None:
+        continuous = SweepAcquisition(ping360, processor, *args.sweep, args.sweep_step, args.range, args.readings,
+                                      max(args.buffer_size, 2 * len(expand_angles((*args.sweep, args.sweep_step)))),
+                                      config, args.sector_size)
+
+    if args.log_format == "sonar":
+        segment_writer = SonarSegmentLogWriter(args.data_dir, capacity=args.log_capacity, max_age=args.log_max_age)
+    else:
+        segment_writer = SegmentLogWriter(args.data_dir, max_bytes=args.log_max_bytes, max_age=args.log_max_age)
+    log_writer = AsyncLogWriter(segment_writer, max_queue=args.log_queue, policy=args.log_policy, max_spill=args.log_spill, fsync=args.fsync)
+    log_writer.start()
+
+    service = Ping360Service(ping360, processor, log_writer, args.coalesce_window, continuous,
+                             max_datagram_size=args.mtu - 28, # IP (20 bytes) and UDP (8 bytes) headers
+                             config=config, log_format=args.log_format)
+    asyncio.run(service.serve((localIP, args.port)))
@@ -0,0 +1,362 @@
+"""
+Vectorized processing engine for Ping360 profiles.
+
+The engine decodes the profile samples of Ping360 `device_data` messages directly from the received message buffer into NumPy (no per-sample Python loop), computes the distance axis once per device configuration, and performs the range gating and strongest-return detection on a whole batch of pings at once.
+
+Example:
+    processor = PingProcessor(v_sound=1480, limit_low=0.8, limit_high=5.0)
+    intensities = processor.allocate(N_samples)
+    for n in range(N_samples):
+        intensities[n] = processor.decode(ping360.transmitAngle(Angle))
+    result = processor.process(intensities)
+
+The default detector takes the strongest sample inside the range gate. The reverb-aware detector (process(intensities, echoes=k)) runs a cell-averaging CFAR over the whole batch instead: the mean of a short cell under test starting at every sample is compared with the mean of the training cells on its near-range side only (skipping the guard cells next to it), so an echo has to stand out of the background in front of it (e.g. the ringdown of the transducer) rather than just be bright. The far-range side is not trained on: behind a wall it holds the wall's own reverb, which would hide the leading edge of the wall. Samples that read 0 (the blanked near range of the .pk logs, the end of a profile) are left out of the training cells, and a sample with fewer than half of its training cells valid is never an echo. Of the samples above the threshold, the k strongest, at least 'echo_separation' apart, are returned for every ping; the strongest one becomes the likely distance.
+
+A batch can also be integrated into a single range estimate (process(intensities, integration=mode)), so that one multipath ping does not drag the estimate off the wall:
+    "average": incoherent averaging of the raw profiles, then a single detection on the mean profile
+    "median": median of the per-ping ranges
+    "trimmed": mean of the per-ping ranges without the 'trim' shortest and longest ones
+    "mean": plain mean of the per-ping ranges, what the clients used to compute themselves
+The estimate comes with its standard error, which the service uses to stop pinging early once the estimate is good enough (see range_standard_error()).
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Added the CFAR echo detector with top-k returns
+ - Version 1.2.0: Added the multi-ping integration modes
+ - Version 1.2.1: An empty batch integrates into an invalid estimate; process() passes 'trim' on to integrate()
+ - Version 1.3.0: The CFAR detector trains on the near-range side only, averages its cell under test over 'cfar_cell' and ranks the echoes by strength, so a wall followed by reverb is detected
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.3.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from dataclasses import dataclass
+from brping import PingMessage, definitions
+import numpy as np
+
+
+def profile_view(ping_message: PingMessage):
+    """
+    Returns the profile samples of a Ping message as a read-only uint8 NumPy view of the received message buffer. No bytes are copied.
+
+    Arguments:
+        ping_message: a decoded profile message (e.g. Ping360 device_data or auto_device_data)
+
+    Returns:
+        A 1D uint8 array of length `data_length` that shares memory with `ping_message.msg_data`
+    """
+    # Profile samples follow the 8 byte header and the fixed-size part of the payload
+    _offset = PingMessage.headerLength + definitions.payload_dict_all[ping_message.message_id]["payload_length"]
+    _view = np.frombuffer(ping_message.msg_data, dtype=np.uint8, count=ping_message.data_length, offset=_offset)
+    _view.flags.writeable = False
+    return _view
+
+
+# Multi-ping integration modes, in the order of the INTEGRATION_* codes of the wire protocol ("none" makes no estimate)
+INTEGRATION_MODES = ("none", "average", "median", "trimmed", "mean")
+
+
+def range_standard_error(distances: np.ndarray, mode: str="median", trim: float=0.2):
+    """
+    Returns the standard error [m] of the range estimate that 'mode' makes from the per-ping ranges 'distances'.
+    The median and trimmed mean use a robust spread (the median absolute deviation), so a few outliers do not hold off an early exit.
+    """
+    _n = len(distances)
+    if _n < 2:
+        return np.inf
+    if mode in ("median", "trimmed"):
+        _spread = 1.4826 * np.median(np.abs(distances - np.median(distances))) # MAD, scaled to a standard deviation
+        if mode == "median":
+            _spread *= 1.2533 # the median of a normal sample is ~25% noisier than its mean
+    else:
+        _spread = np.std(distances, ddof=1)
+    return float(_spread / np.sqrt(_n))
+
+
+@dataclass
+class RangeEstimate:
+    """
+    A single range estimate integrated from a batch of pings
+    """
+    distance  : float # [m] estimated range of the target
+    std       : float # [m] standard error of the estimate
+    intensity : float # [ADC counts] intensity at the estimated range
+    n_pings   : int   # number of pings the estimate is made of (after trimming)
+    mode      : str   # integration mode, one of INTEGRATION_MODES
+
+
+@dataclass
+class EchoDetections:
+    """
+    The k strongest separated echoes of each of N pings, strongest (highest mean intensity over the CFAR cell under test) first. Missing echoes have index -1.
+    """
+    index     : np.ndarray # (N, k) sample index of the echo, -1 if none
+    distance  : np.ndarray # [m] (N, k) distance of the echo, NaN if none
+    intensity : np.ndarray # [ADC counts] (N, k) intensity of the echo, 0 if none
+    snr       : np.ndarray # [dB] (N, k) ratio of the mean of the cell under test to the mean of its CFAR training cells, NaN if none
+
+    @property
+    def count(self):
+        """
+        The number of echoes detected in each ping (N,)
+        """
+        return (self.index >= 0).sum(axis=1)
+
+
+@dataclass
+class PingBatchResult:
+    """
+    Result of processing a batch of N pings of `number_of_samples` samples each
+    """
+    distances                 : np.ndarray # [m] (number_of_samples,) distance of each sample bin
+    intensities               : np.ndarray # [ADC counts] (N, number_of_samples) uint8 raw returns
+    likely_max_index          : np.ndarray # (N,) sample index of the strongest in-range return
+    likely_distance           : np.ndarray # [m] (N,) distance of the strongest in-range return
+    intensity_likely_distance : np.ndarray # [ADC counts] (N,) intensity of the strongest in-range return
+    echoes                    : EchoDetections = None # CFAR detections, if requested
+    estimate                  : RangeEstimate = None  # integrated range estimate, if requested
+
+    def to_dict(self):
+        """
+        Returns the result in the dictionary layout used by the service logs and clients
+        """
+        return {
+            'dimensions': np.broadcast_to(self.distances, self.intensities.shape),
+            'intensities': self.intensities,
+            'likely_max_index': self.likely_max_index,
+            'likely_distance': self.likely_distance,
+            'intensity_likely_distance': self.intensity_likely_distance
+        }
+
+
+class PingProcessor:
+    """
+    Reusable processing engine for batches of Ping360 profiles.
+
+    Arguments:
+        v_sound: the operating speed of sound [m/s] (default: 1480)
+        limit_low: returns closer than this distance [m] are rejected (default: 0.8)
+        limit_high: returns at or beyond this distance [m] are rejected (default: 5.0)
+        cfar_guard: CFAR detector: the distance [m] in front of a sample left out of its noise estimate (default: 0.03)
+        cfar_train: CFAR detector: the distance [m] in front of the guard cells averaged into the noise estimate (default: 0.25)
+        cfar_threshold: CFAR detector: how far [dB] above the noise estimate the cell under test must be to be an echo (default: 9.5)
+        echo_separation: CFAR detector: the minimum distance [m] between two echoes of a ping (default: 0.2)
+        cfar_cell: CFAR detector: the distance [m] from a sample averaged into its cell under test, about one pulse length, so that a lone speckle sample is not an echo (default: 0.03)
+    """
+
+    def __init__(self, v_sound: float=1480, limit_low: float=0.8, limit_high: float=5.0, cfar_guard: float=0.03, cfar_train: float=0.25,
+                 cfar_threshold: float=9.5, echo_separation: float=0.2, cfar_cell: float=0.03):
+        self.v_sound = v_sound
+        self.limit_low = limit_low
+        self.limit_high = limit_high
+        self.cfar_guard = cfar_guard
+        self.cfar_train = cfar_train
+        self.cfar_threshold = cfar_threshold
+        self.echo_separation = echo_separation
+        self.cfar_cell = cfar_cell
+
+        self.sample_period = None
+        self.number_of_samples = None
+        self.meters_per_sample = None
+        self.distances = None
+        self.low_cutoff_index = None
+        self.high_cutoff_index = None
+        self._cfar_windows = None # (training start, training stop, cell under test stop) indices of every sample
+        self._cfar_cells = None   # number of training cells of every sample
+        self._separation = None   # echo_separation in samples
+
+    def configure(self, sample_period: int, number_of_samples: int):
+        """
+        Computes the distance axis and the range gate indices for a device configuration.
+        Nothing is recomputed if the configuration has not changed since the last call.
+
+        Arguments:
+            sample_period: the Ping360 sample period in 25 ns increments
+            number_of_samples: the number of samples per ping
+        """
+        if (sample_period, number_of_samples) == (self.sample_period, self.number_of_samples):
+            return
+
+        self.sample_period = sample_period
+        self.number_of_samples = number_of_samples
+
+        # sample_period is in 25ns increments
+        # time of flight includes there and back, so divide by 2
+        self.meters_per_sample = self.v_sound * sample_period * 12.5e-9
+        self.distances = np.arange(number_of_samples) * self.meters_per_sample
+        self.distances.flags.writeable = False
+
+        self.low_cutoff_index = min(int(self.limit_low / self.meters_per_sample), number_of_samples)
+        self.high_cutoff_index = min(int(self.limit_high / self.meters_per_sample), number_of_samples)
+
+        # CFAR windows: training cells in front of the guard cells, cell under test from the sample on; clipped at both ends of the profile
+        _guard = max(int(round(self.cfar_guard / self.meters_per_sample)), 0)
+        _train = max(int(round(self.cfar_train / self.meters_per_sample)), 1)
+        _cell = max(int(round(self.cfar_cell / self.meters_per_sample)), 1)
+        _index = np.arange(number_of_samples)
+        self._cfar_windows = tuple(np.clip(_bound, 0, number_of_samples) for _bound in (_index - _guard - _train, _index - _guard, _index + _cell))
+        self._cfar_cells = _train
+        self._separation = max(int(round(self.echo_separation / self.meters_per_sample)), 1)
+
+    def configure_from_message(self, ping_message: PingMessage):
+        """
+        Configures the engine from the settings reported in a Ping360 device_data message
+        """
+        self.configure(ping_message.sample_period, ping_message.number_of_samples)
+
+    def allocate(self, n_pings: int):
+        """
+        Returns an uninitialized (n_pings, number_of_samples) uint8 array to decode a batch into
+        """
+        return np.empty((n_pings, self.number_of_samples), dtype=np.uint8)
+
+    def decode(self, ping_message: PingMessage):
+        """
+        Returns the profile samples of a ping as a zero-copy uint8 view.
+        The engine is (re)configured from the message if its settings differ from the current ones.
+        """
+        self.configure_from_message(ping_message)
+        return profile_view(ping_message)
+
+    def detect(self, intensities: np.ndarray, k: int=3):
+        """
+        Runs the near-range cell-averaging CFAR detector on a batch and returns the 'k' strongest in-range echoes of every ping.
+
+        Arguments:
+            intensities: an (N, number_of_samples) array of raw returns, one row per ping
+            k: the maximum number of echoes per ping
+
+        Returns:
+            The EchoDetections of the batch
+        """
+        intensities = np.atleast_2d(intensities)
+        _n_pings, _n = intensities.shape
+        _rows = np.arange(_n_pings)
+
+        # Sums of the training cells and of the cells under test of every sample from the running sums of each ping
+        _cumulative = np.zeros((_n_pings, _n + 1))
+        np.cumsum(intensities, axis=1, out=_cumulative[:, 1:])
+        _valid = np.zeros((_n_pings, _n + 1))
+        np.cumsum(intensities > 0, axis=1, out=_valid[:, 1:])
+        _train_start, _train_stop, _cell_stop = self._cfar_windows
+        _cells = _valid[:, _train_stop] - _valid[:, _train_start] # blanked (0) samples are not background
+        _noise = (_cumulative[:, _train_stop] - _cumulative[:, _train_start]) / np.maximum(_cells, 1)
+        np.maximum(_noise, 1.0, out=_noise) # 1 ADC count is the quantization floor
+        _noise[_cells < self._cfar_cells / 2] = np.inf # Not enough background in front of the sample to tell
+        _cell = (_cumulative[:, _cell_stop] - _cumulative[:, :-1]) / (_cell_stop - np.arange(_n))
+
+        _snr = 20 * np.log10(np.maximum(_cell, 1.0) / _noise)
+        _score = np.full_like(_snr, -np.inf)
+        _low, _high = self.low_cutoff_index, self.high_cutoff_index
+        _score[:, _low:_high] = np.where(_snr[:, _low:_high] > self.cfar_threshold, _cell[:, _low:_high], -np.inf)
+
+        # Take the best remaining echo of every ping k times, blanking the samples around each one
+        _index = np.full((_n_pings, k), -1, dtype=np.intp)
+        _samples = np.arange(_n)
+        for _j in range(k):
+            _best = _score.argmax(axis=1)
+            _found = np.isfinite(_score[_rows, _best])
+            if not _found.any():
+                break
+            _index[_found, _j] = _best[_found]
+            _score[np.abs(_samples - _best[:, None]) <= self._separation] = -np.inf
+
+        _detected = _index >= 0
+        _safe = np.where(_detected, _index, 0)
+        return EchoDetections(
+            index=_index,
+            distance=np.where(_detected, self.distances[_safe], np.nan),
+            intensity=np.where(_detected, intensities[_rows[:, None], _safe], 0).astype(np.uint8),
+            snr=np.where(_detected, _snr[_rows[:, None], _safe], np.nan).astype(np.float32)
+        )
+
+    def integrate(self, result, mode: str="median", trim: float=0.2):
+        """
+        Integrates the pings of a processed batch into a single range estimate.
+
+        Arguments:
+            result: the PingBatchResult of the batch
+            mode: one of INTEGRATION_MODES other than "none" (default: "median")
+            trim: "trimmed" mode: the fraction of the per-ping ranges dropped at each end (default: 0.2)
+
+        Returns:
+            A RangeEstimate. An empty batch (e.g. no ping in a continuous mode read) has a NaN distance, an infinite standard error and no pings.
+        """
+        _distances = result.likely_distance
+        _n = len(_distances)
+        if mode not in INTEGRATION_MODES[1:]:
+            raise ValueError("Unknown integration mode '{}' (one of {})".format(mode, INTEGRATION_MODES[1:]))
+        if _n == 0:
+            return RangeEstimate(np.nan, np.inf, 0.0, 0, mode)
+
+        if mode == "average":
+            # Incoherent averaging: uncorrelated noise averages out, the target echo does not
+            _profile = result.intensities.mean(axis=0, dtype=np.float32)[None]
+            _echoes = 0 if result.echoes is None else result.echoes.index.shape[1]
+            _averaged = self.process(_profile, _echoes)
+            return RangeEstimate(float(_averaged.likely_distance[0]), range_standard_error(_distances, mode),
+                                 float(_averaged.intensity_likely_distance[0]), _n, mode)
+
+        if mode == "median":
+            _distance = np.median(_distances)
+            _kept = _n
+        elif mode == "trimmed":
+            _cut = int(trim * _n)
+            _sorted = np.sort(_distances)[_cut:_n - _cut]
+            _distance = _sorted.mean()
+            _kept = len(_sorted)
+        else:
+            _distance = _distances.mean()
+            _kept = _n
+
+        # Intensity of the ping closest to the estimate
+        _closest = np.argmin(np.abs(_distances - _distance))
+        return RangeEstimate(float(_distance), range_standard_error(_distances, mode, trim),
+                             float(result.intensity_likely_distance[_closest]), _kept, mode)
+
+    def process(self, intensities: np.ndarray, echoes: int=0, integration: str="none", trim: float=0.2):
+        """
+        Finds the strongest in-range return of every ping in a batch.
+
+        Arguments:
+            intensities: an (N, number_of_samples) array of raw returns, one row per ping
+            echoes: if non-zero, also run the CFAR detector for this many echoes per ping; the likely distance of a ping is then its strongest echo, or its strongest return if no echo was detected (default: 0)
+            integration: if not "none", also integrate the batch into a single range estimate with this mode (default: "none")
+            trim: "trimmed" integration: the fraction of the per-ping ranges dropped at each end (default: 0.2)
+
+        Returns:
+            A PingBatchResult for the batch
+        """
+        intensities = np.atleast_2d(intensities)
+        _low, _high = self.low_cutoff_index, self.high_cutoff_index
+        _rows = np.arange(intensities.shape[0])
+
+        if _high > _low:
+            # Only search inside the range gate instead of zeroing the rejected samples
+            _index_max = intensities[:, _low:_high].argmax(axis=1) + _low
+        else:
+            # Empty range gate -> every sample is rejected, as in the original service loop
+            _index_max = np.zeros(intensities.shape[0], dtype=np.intp)
+
+        _echoes = None
+        if echoes:
+            _echoes = self.detect(intensities, echoes)
+            _index_max = np.where(_echoes.index[:, 0] >= 0, _echoes.index[:, 0], _index_max)
+
+        _result = PingBatchResult(
+            distances=self.distances,
+            intensities=intensities,
+            likely_max_index=_index_max,
+            likely_distance=self.distances[_index_max],
+            intensity_likely_distance=intensities[_rows, _index_max],
+            echoes=_echoes
+        )
+        if integration != "none":
+            _result.estimate = self.integrate(_result, integration, trim)
+        return _result
@@ -0,0 +1,220 @@
+"""
+Batch converter from Ping Viewer sensor logs (.bin) to compact NumPy archives (.npz).
+
+Every log of a directory is decoded with the bulk decoder of examples/Binary_log.py (PingViewerLogReader.profiles()), in a process pool, one log per worker, and written as an uncompressed .npz archive holding one array per column:
+
+    ping360_timestamps  float64 (N,)                [s] since midnight of the log's first day
+    ping360_angles      uint16 (N,)                 [grad]
+    ping360_samples     uint8 (N, max samples)      [ADC counts], zero-padded past number_of_samples
+    ping360_settings    (N,) Ping360Settings fields (mode, gain_setting, transmit_duration, sample_period, transmit_frequency, number_of_samples)
+    ping1d_timestamps   float64 (M,)                [s] since midnight of the log's first day
+    ping1d_distance     uint32 (M,)                 [mm]
+    ping1d_confidence   uint16 (M,)                 [%]
+    ping1d_samples      uint8 (M, max samples)      zero-padded past the profile_data_length
+    ping1d_settings     (M,) Ping1DSettings fields (transmit_duration, scan_start, scan_length, gain_setting)
+    source              int64 (3,)                  ARCHIVE_VERSION, size and mtime [ns] of the log it was converted from
+
+Ping360 device_data (2300) and auto_device_data (2301) messages are merged in log order. A log whose archive already records its current size and modification time is skipped, so re-running the command after a pool session only decodes the new logs. Archives are written to a temporary file and renamed, so an interrupted run never leaves a truncated archive behind.
+
+Example:
+    python3 -m sensors.Ping360.ping_viewer_archive ~/pingviewer/logs --output data/110422 --jobs 4
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from brping import definitions
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from examples.Binary_log import PingViewerLogReader, ProfileArrays, Ping1DSettings, Ping360Settings, parse_timestamp, payload_dtype
+import glob
+import numpy as np
+import os
+
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = ".npz"
+LOG_PATTERN = "*.bin" # Ping Viewer sensor logs
+
+PING360_IDS = (definitions.PING360_DEVICE_DATA, definitions.PING360_AUTO_DEVICE_DATA)
+PING1D_IDS = (definitions.PING1D_PROFILE,)
+
+
+def archive_path(log_path: str, output_dir: str=None):
+    """
+    Returns the archive of a log: same name with ARCHIVE_SUFFIX, in 'output_dir' (default: next to the log)
+    """
+    _name = os.path.splitext(os.path.basename(log_path))[0] + ARCHIVE_SUFFIX
+    return os.path.join(output_dir or os.path.dirname(log_path), _name)
+
+
+def source_stamp(log_path: str):
+    """
+    Returns the [ARCHIVE_VERSION, size, mtime_ns] an up-to-date archive of a log records
+    """
+    _stat = os.stat(log_path)
+    return np.array([ARCHIVE_VERSION, _stat.st_size, _stat.st_mtime_ns], dtype=np.int64)
+
+
+def is_up_to_date(log_path: str, npz_path: str):
+    """
+    Whether 'npz_path' was converted from the current version of 'log_path' by this version of the converter
+    """
+    try:
+        with np.load(npz_path) as archive:
+            return np.array_equal(archive['source'], source_stamp(log_path))
+    except (OSError, KeyError, ValueError):
+        return False # missing, truncated or not an archive
+
+
+def _unwrap_days(seconds: np.ndarray):
+    """
+    Adds a day to the timestamps after every jump back of more than 12 h (the log went past midnight)
+    """
+    _wraps = np.concatenate(([0], np.cumsum(np.diff(seconds) < -12 * 3600))) if len(seconds) else 0
+    return seconds + _wraps * 24 * 3600.0
+
+
+def _stack_samples(data: list):
+    """
+    Returns the profiles as one (N, longest) uint8 array, zero-padded
+    """
+    _samples = np.zeros((len(data), max((len(profile) for profile in data), default=0)), dtype=np.uint8)
+    for row, profile in zip(_samples, data):
+        row[:len(profile)] = profile
+    return _samples
+
+
+def _columns(profiles: dict, message_ids: tuple, settings_class):
+    """
+    Merges the ProfileArrays of 'message_ids' in log order. Returns (timestamps, fields, samples, settings).
+    """
+    _decoded = [profiles[message_id] for message_id in message_ids if message_id in profiles]
+    _names = list(settings_class.__annotations__)
+    if not _decoded: # none in the log, still written with their dtype
+        _decoded = [ProfileArrays(message_ids[0], fields=np.empty(0, dtype=payload_dtype(message_ids[0])))]
+
+    # Only the fields every merged message id has, e.g. device_data's in auto_device_data
+    _common = [name for name in _decoded[0].fields.dtype.names if all(name in arrays.fields.dtype.names for arrays in _decoded)]
+    # Each id's timestamps are in log order, unwrapped before the ids are merged
+    _timestamps = np.concatenate([_unwrap_days(np.array([parse_timestamp(timestamp) for timestamp in arrays.timestamps], dtype=np.float64))
+                                  for arrays in _decoded])
+    _fields = np.concatenate([arrays.fields[_common] for arrays in _decoded]) if len(_decoded) > 1 else _decoded[0].fields
+    _data = [profile for arrays in _decoded for profile in arrays.data]
+
+    _order = np.argsort(_timestamps, kind="stable") if len(_decoded) > 1 else np.arange(len(_timestamps))
+    _samples = _stack_samples([_data[i] for i in _order])
+    _fields = np.ascontiguousarray(_fields[_order])
+    _settings = np.empty(len(_fields), dtype=[(name, _fields.dtype[name]) for name in _names])
+    for name in _names:
+        _settings[name] = _fields[name]
+    return _timestamps[_order], _fields, _samples, _settings
+
+
+def convert_log(log_path: str, npz_path: str=None, force: bool=False):
+    """
+    Converts a Ping Viewer log into a NumPy archive, unless the archive is up to date.
+
+    Arguments:
+        log_path: the Ping Viewer log
+        npz_path: the archive to write (default: archive_path(log_path))
+        force: convert even if the archive is up to date (default: False)
+
+    Returns:
+        (npz_path, number of Ping360 pings, number of Ping1D profiles, frame errors), the counts being None if the log was skipped
+    """
+    npz_path = npz_path or archive_path(log_path)
+    if not force and is_up_to_date(log_path, npz_path):
+        return npz_path, None, None, 0
+
+    _stamp = source_stamp(log_path) # before reading, a log still being written is converted again next time
+    _reader = PingViewerLogReader(log_path)
+    try:
+        _profiles = _reader.profiles(set(PING360_IDS + PING1D_IDS))
+        _ping360 = _columns(_profiles, PING360_IDS, Ping360Settings)
+        _ping1d = _columns(_profiles, PING1D_IDS, Ping1DSettings)
+        _arrays = {
+            "ping360_timestamps": _ping360[0],
+            "ping360_angles": _ping360[1]['angle'].astype(np.uint16),
+            "ping360_samples": _ping360[2],
+            "ping360_settings": _ping360[3],
+            "ping1d_timestamps": _ping1d[0],
+            "ping1d_distance": _ping1d[1]['distance'].astype(np.uint32),
+            "ping1d_confidence": _ping1d[1]['confidence'].astype(np.uint16),
+            "ping1d_samples": _ping1d[2],
+            "ping1d_settings": _ping1d[3],
+            "source": _stamp,
+        }
+    finally:
+        _reader.close()
+
+    _temporary = npz_path + ".part"
+    os.makedirs(os.path.dirname(os.path.abspath(npz_path)), exist_ok=True)
+    with open(_temporary, 'wb') as file: # np.savez would append '.npz' to the name
+        np.savez(file, **_arrays)
+    os.replace(_temporary, npz_path)
+    return npz_path, len(_arrays["ping360_timestamps"]), len(_arrays["ping1d_timestamps"]), _reader.frame_errors
+
+
+def convert_directory(log_dir: str, output_dir: str=None, jobs: int=None, force: bool=False, pattern: str=LOG_PATTERN):
+    """
+    Converts the Ping Viewer logs of a directory in a process pool, the biggest logs first.
+
+    Arguments:
+        log_dir: the directory of the logs
+        output_dir: the directory of the archives (default: 'log_dir')
+        jobs: the number of worker processes (default: the number of CPUs)
+        force: convert the logs with an up-to-date archive too (default: False)
+        pattern: the file name pattern of the logs (default: LOG_PATTERN)
+
+    Yields:
+        (log_path, result of convert_log() or the exception raised), as the conversions complete
+    """
+    _logs = sorted(glob.glob(os.path.join(log_dir, pattern)), key=os.path.getsize, reverse=True)
+    _pending = [log_path for log_path in _logs if force or not is_up_to_date(log_path, archive_path(log_path, output_dir))]
+    for log_path in _logs:
+        if log_path not in _pending:
+            yield log_path, (archive_path(log_path, output_dir), None, None, 0)
+    if not _pending:
+        return
+
+    with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count() or 1, len(_pending))) as executor:
+        _futures = {executor.submit(convert_log, log_path, archive_path(log_path, output_dir), True): log_path for log_path in _pending}
+        for future in as_completed(_futures):
+            try:
+                yield _futures[future], future.result()
+            except Exception as error: # a damaged log must not stop the batch
+                yield _futures[future], error
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Convert a directory of Ping Viewer logs into NumPy archives")
+    parser.add_argument("log_dir", help="Directory of Ping Viewer sensor logs")
+    parser.add_argument("--output", default=None, help="Directory of the archives (default: the log directory)")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes (default: the number of CPUs)")
+    parser.add_argument("--pattern", default=LOG_PATTERN, help="File name pattern of the logs")
+    parser.add_argument("--force", action="store_true", help="Convert the logs with an up-to-date archive too")
+    args = parser.parse_args()
+
+    _failed = 0
+    for log_path, result in convert_directory(args.log_dir, args.output, args.jobs, args.force, args.pattern):
+        if isinstance(result, Exception):
+            _failed += 1
+            print("{}: failed ({}: {})".format(log_path, type(result).__name__, result))
+            continue
+        npz_path, n_ping360, n_ping1d, frame_errors = result
+        if n_ping360 is None:
+            print("{}: up to date".format(npz_path))
+        else:
+            print("{} -> {}: {} Ping360 pings, {} Ping1D profiles, {} bad frames".format(log_path, npz_path, n_ping360, n_ping1d, frame_errors))
+    if _failed:
+        raise SystemExit("{} logs failed to convert".format(_failed))
@@ -0,0 +1,235 @@
+"""
+Unified, cached loader for the sonar recordings of the test sessions in data/.
+
+Two recording formats are read into the same SonarRecording (device settings, angles and uint8 profiles):
+
+    - the Ping Viewer "distance,intensity" CSV exports of data/100622 (Intensities*.csv), one ping per file;
+    - the pickle logs of the service in data/102122 (*.pk). The service opens its logs in append mode, so a .pk file can hold several pickled records; they are streamed one at a time by iter_pings().
+
+Both formats store the whole Ping360 device_data message of every ping (8 frame header and 14 payload bytes before the profile, 2 checksum bytes after). When the header bytes were kept (the CSV exports) the angle and device settings are read from them; otherwise (the .pk logs, whose header bytes are zero) the angle is unknown and the sample period is recovered from the distance step.
+
+Parsed recordings are cached as uncompressed .npz files in a CACHE_DIR directory next to the recordings. A cache entry is used as long as the recording's size and modification time are unchanged; if only the modification time changed (e.g. after a git checkout), the recording's BLAKE2 digest is compared instead, so repeated analysis sessions do not parse anything.
+
+Example:
+    recording = load_recording("data/100622/Intensities1.csv")
+    recording.distances, recording.intensities[0]
+    session = load_session("data/102122")  # {file name: SonarRecording}
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Added file_stamp(), the size and modification time other caches of the recordings are keyed on
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.1.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from dataclasses import dataclass, astuple
+from sensors.Ping360.sonar_log import SonarLogSettings, ANGLE_UNKNOWN, load_pickle_records, pickle_record_arrays
+import glob
+import hashlib
+import numpy as np
+import os
+import re
+
+CACHE_VERSION = 1
+CACHE_DIR = ".sonar_cache"
+RECORDING_PATTERNS = ("Intensities*.csv", "*.pk")
+
+# Bytes of the Ping360 device_data message around the profile
+MESSAGE_HEADER_SIZE = 22
+MESSAGE_CHECKSUM_SIZE = 2
+# Frame header (start, payload_length, message_id, src_device_id, dst_device_id) and the payload fields before the profile
+MESSAGE_HEADER = np.dtype([('start', 'S2'), ('payload_length', '<u2'), ('message_id', '<u2'), ('src_device_id', 'u1'), ('dst_device_id', 'u1'),
+                           ('mode', 'u1'), ('gain_setting', 'u1'), ('angle', '<u2'), ('transmit_duration', '<u2'), ('sample_period', '<u2'),
+                           ('transmit_frequency', '<u2'), ('number_of_samples', '<u2'), ('data_length', '<u2')])
+
+
+@dataclass
+class SonarRecording:
+    """
+    The pings of a recording, all taken with the same device settings
+    """
+    path        : str
+    settings    : SonarLogSettings
+    angles      : np.ndarray # [grad] (N,) uint16, ANGLE_UNKNOWN if unknown
+    intensities : np.ndarray # [ADC counts] (N, number_of_samples) uint8
+
+    def __len__(self):
+        return len(self.intensities)
+
+    @property
+    def distances(self):
+        """
+        The distance [m] of every sample bin
+        """
+        return self.settings.distances
+
+
+def _messages_to_pings(messages: np.ndarray, distance_step: float, v_sound: float):
+    """
+    Returns the (settings, angles, intensities) of whole Ping360 messages, one per row
+    """
+    messages = np.asarray(messages)
+    _intensities = messages[:, MESSAGE_HEADER_SIZE:-MESSAGE_CHECKSUM_SIZE].astype(np.uint8)
+    _headers = np.ascontiguousarray(messages[:, :MESSAGE_HEADER_SIZE], dtype=np.uint8).view(MESSAGE_HEADER)[:, 0]
+    if np.all(_headers['start'] == b'BR'):
+        if any(len(np.unique(_headers[name])) > 1 for name in ('gain_setting', 'transmit_duration', 'sample_period', 'transmit_frequency')):
+            raise ValueError("The pings mix device settings")
+        _header = _headers[0]
+        _settings = SonarLogSettings(_intensities.shape[1], int(_header['sample_period']), int(_header['transmit_duration']),
+                                     int(_header['transmit_frequency']), int(_header['gain_setting']), v_sound)
+        return _settings, _headers['angle'].astype(np.uint16), _intensities
+
+    # Header bytes not kept, only the distances tell the sample period
+    _settings = SonarLogSettings(_intensities.shape[1], int(round(distance_step / (v_sound * 12.5e-9))), v_sound=v_sound)
+    return _settings, np.full(len(_intensities), ANGLE_UNKNOWN, dtype=np.uint16), _intensities
+
+
+def iter_pings(path: str, v_sound: float=1480):
+    """
+    Yields the pings of a recording as (settings, angles, intensities) batches, lazily: one batch per record of a .pk log, one for a CSV export
+    """
+    if path.endswith(".csv"):
+        _csv = np.loadtxt(path, delimiter=",", ndmin=2)
+        yield _messages_to_pings(_csv[:, 1][np.newaxis], _csv[1, 0] - _csv[0, 0], v_sound)
+        return
+    for record in load_pickle_records(path):
+        _distances, _messages = pickle_record_arrays(record)
+        if _messages.dtype == np.uint8:
+            # Profiles only (no message bytes around them)
+            _settings = SonarLogSettings(_messages.shape[1], int(round((_distances[0, 1] - _distances[0, 0]) / (v_sound * 12.5e-9))), v_sound=v_sound)
+            yield _settings, np.full(len(_messages), ANGLE_UNKNOWN, dtype=np.uint16), _messages
+        else:
+            yield _messages_to_pings(_messages, _distances[0, 1] - _distances[0, 0], v_sound)
+
+
+def parse_recording(path: str, v_sound: float=1480):
+    """
+    Reads a whole recording, without the cache.
+
+    Raises:
+        ValueError: if the recording is empty or mixes device settings
+    """
+    _batches = list(iter_pings(path, v_sound))
+    if not _batches:
+        raise ValueError("No pings in {}".format(path))
+    if len({settings for settings, _, _ in _batches}) > 1:
+        raise ValueError("{} mixes device settings".format(path))
+    return SonarRecording(path, _batches[0][0], np.concatenate([angles for _, angles, _ in _batches]),
+                          np.concatenate([intensities for _, _, intensities in _batches]))
+
+
+def file_digest(path: str):
+    """
+    Returns the BLAKE2 digest of a file's content
+    """
+    _hash = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            _hash.update(chunk)
+    return _hash.digest()
+
+
+def cache_path(path: str):
+    """
+    Returns the cache entry of a recording, in CACHE_DIR next to it
+    """
+    return os.path.join(os.path.dirname(path), CACHE_DIR, os.path.basename(path) + ".npz")
+
+
+def file_stamp(path: str):
+    """
+    Returns the [size, mtime_ns] of a file; while it is unchanged, the file's content is assumed unchanged
+    """
+    _stat = os.stat(path)
+    return np.array([_stat.st_size, _stat.st_mtime_ns], dtype=np.int64)
+
+
+def _stamp(path: str, v_sound: float):
+    return np.concatenate(([CACHE_VERSION], file_stamp(path), [np.float64(v_sound).view(np.int64)]))
+
+
+def _write_cache(npz_path: str, recording: SonarRecording, stamp: np.ndarray, digest: bytes):
+    os.makedirs(os.path.dirname(npz_path), exist_ok=True)
+    _temporary = npz_path + ".part"
+    with open(_temporary, 'wb') as file: # np.savez would append '.npz' to the name
+        np.savez(file, settings=np.array(astuple(recording.settings), dtype=np.float64), angles=recording.angles,
+                 intensities=recording.intensities, stamp=stamp, digest=np.frombuffer(digest, dtype=np.uint8))
+    os.replace(_temporary, npz_path)
+
+
+def load_recording(path: str, v_sound: float=1480, cache: bool=True):
+    """
+    Reads a recording, from its cache entry if it is still valid.
+
+    Arguments:
+        path: the CSV export or .pk log
+        v_sound: the speed of sound [m/s] of the distances (default: 1480)
+        cache: use and update the cache (default: True)
+    """
+    if not cache:
+        return parse_recording(path, v_sound)
+
+    _npz_path = cache_path(path)
+    _stamp_now = _stamp(path, v_sound)
+    _digest = None
+    try:
+        with np.load(_npz_path) as entry:
+            _valid = np.array_equal(entry['stamp'], _stamp_now)
+            if not _valid and entry['stamp'][0] == CACHE_VERSION and entry['stamp'][1] == _stamp_now[1] and entry['stamp'][3] == _stamp_now[3]:
+                # Same size, new modification time: compare the content
+                _digest = file_digest(path)
+                _valid = entry['digest'].tobytes() == _digest
+            if _valid:
+                _values = entry['settings'].tolist()
+                _recording = SonarRecording(path, SonarLogSettings(*map(int, _values[:-1]), _values[-1]), entry['angles'], entry['intensities'])
+                if _digest is not None:
+                    _write_cache(_npz_path, _recording, _stamp_now, _digest) # Valid again for the new modification time
+                return _recording
+    except (OSError, KeyError, ValueError):
+        pass # No (readable) cache entry yet
+
+    _recording = parse_recording(path, v_sound)
+    try:
+        _write_cache(_npz_path, _recording, _stamp_now, _digest or file_digest(path))
+    except OSError:
+        pass # Read-only data directory, nothing cached
+    return _recording
+
+
+def session_paths(session_dir: str, patterns=RECORDING_PATTERNS):
+    """
+    Returns the recordings of a session directory, in natural order (Intensities2.csv before Intensities10.csv)
+    """
+    _paths = {path for pattern in patterns for path in glob.glob(os.path.join(session_dir, pattern))}
+    return sorted(_paths, key=lambda path: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', os.path.basename(path))])
+
+
+def load_session(session_dir: str, patterns=RECORDING_PATTERNS, v_sound: float=1480, cache: bool=True):
+    """
+    Reads every recording of a session directory. Returns a {file name: SonarRecording} dictionary, in natural order.
+    """
+    return {os.path.basename(path): load_recording(path, v_sound, cache) for path in session_paths(session_dir, patterns)}
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import time
+
+    parser = ArgumentParser(description="Load (and cache) the sonar recordings of session directories")
+    parser.add_argument("sessions", nargs="+", help="Session directories, e.g. data/100622 data/102122")
+    parser.add_argument("--no-cache", action="store_true", help="Parse the recordings without the cache")
+    args = parser.parse_args()
+
+    for session_dir in args.sessions:
+        _start = time.perf_counter()
+        _session = load_session(session_dir, cache=not args.no_cache)
+        print("{}: {} recordings, {} pings in {:.3f} s".format(session_dir, len(_session), sum(map(len, _session.values())), time.perf_counter() - _start))
+        for name, recording in _session.items():
+            print("  {:<24} {:4d} pings x {:4d} samples, {:.2f} m range".format(name, len(recording), recording.settings.number_of_samples, recording.distances[-1]))
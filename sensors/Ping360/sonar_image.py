@@ -0,0 +1,175 @@
+"""
+Polar-to-Cartesian renderer for Ping360 sweeps.
+
+Every pixel of the square output image falls on one (angle, sample) bin of the sonar. SonarImageLUT computes that mapping once per (range, number_of_samples, image size, heading) configuration and keeps the pixels grouped by angle, so drawing a new ping is a single NumPy gather/scatter over the pixels of its angle; no trigonometry is done per ping or per pixel. The tables are cached, so switching back to a previous configuration costs nothing.
+
+The image is centered on the sonar head. Angles increase clockwise, and 'heading' is the angle [grad] drawn at the top of the image (200 for the current AUV configuration, where 200 is forward).
+
+Example:
+    image = SonarImage(image_size=512, heading=200)
+    image.configure(range=5, number_of_samples=1200)
+    for angle, profile in pings:
+        image.update(angle, profile)    # only the pixels of 'angle' are touched
+    display(image.image)
+
+The module can also be run to render a .sonar log (see sonar_log.py) into a PNG:
+    python3 -m sensors.Ping360.sonar_image data/102122/Ping360_data_0.sonar sweep.png
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from functools import lru_cache
+import numpy as np
+
+N_ANGLES = 400 # [grad] in a full turn of the head
+
+
+class SonarImageLUT:
+    """
+    Lookup table from (angle, sample) bins to the pixels of a square image. Use polar_lut() to get a cached table.
+
+    Arguments:
+        range: the range [m] covered by the samples of a ping; drawn from the center to the edge of the image
+        number_of_samples: the number of samples per ping
+        image_size: the width and height of the image [px]
+        heading: the angle [grad] drawn at the top of the image (default: 0)
+    """
+
+    def __init__(self, range: float, number_of_samples: int, image_size: int, heading: int=0):
+        self.range = range
+        self.number_of_samples = number_of_samples
+        self.image_size = image_size
+        self.heading = heading
+
+        _center = (image_size - 1) / 2
+        _y, _x = np.mgrid[0:image_size, 0:image_size]
+        _right, _up = _x - _center, _center - _y
+
+        # Sample bin of every pixel; the edge of the image is the end of the range
+        _sample = (np.hypot(_right, _up) * (number_of_samples / max(_center, 1))).astype(np.intp)
+        # Nearest angle bin of every pixel, clockwise from the top
+        _angle = np.rint(np.arctan2(_right, _up) * (N_ANGLES / (2 * np.pi)) + heading).astype(np.intp) % N_ANGLES
+
+        _inside = np.flatnonzero(_sample < number_of_samples)
+        _order = np.argsort(_angle.flat[_inside], kind="stable")
+        self.pixels = _inside[_order].astype(np.int32)                  # flat pixel indices, grouped by angle
+        self.samples = _sample.flat[self.pixels].astype(np.int32)       # sample index of every pixel
+        self.starts = np.searchsorted(_angle.flat[self.pixels], np.arange(N_ANGLES + 1)) # pixels of angle a: [starts[a], starts[a + 1])
+
+    def angle_slice(self, angle: int):
+        """
+        Returns the (pixels, samples) of an angle
+        """
+        _start, _stop = self.starts[angle % N_ANGLES], self.starts[angle % N_ANGLES + 1]
+        return self.pixels[_start:_stop], self.samples[_start:_stop]
+
+    def sector_slices(self, angle: int, width: int=1):
+        """
+        Returns the (pixels, samples) of the 'width' angles starting at 'angle', as at most two slices (the sector may wrap around 0)
+        """
+        _first = angle % N_ANGLES
+        _last = _first + min(width, N_ANGLES)
+        if _last <= N_ANGLES:
+            _ranges = [(_first, _last)]
+        else:
+            _ranges = [(_first, N_ANGLES), (0, _last - N_ANGLES)]
+        return [(self.pixels[self.starts[a]:self.starts[b]], self.samples[self.starts[a]:self.starts[b]]) for a, b in _ranges]
+
+
+@lru_cache(maxsize=8)
+def polar_lut(range: float, number_of_samples: int, image_size: int, heading: int=0):
+    """
+    Returns the SonarImageLUT of a configuration, computing it only the first time it is asked for
+    """
+    return SonarImageLUT(range, number_of_samples, image_size, heading)
+
+
+class SonarImage:
+    """
+    A Cartesian sonar image updated one ping at a time.
+
+    Arguments:
+        image_size: the width and height of the image [px] (default: 512)
+        heading: the angle [grad] drawn at the top of the image (default: 0)
+    """
+
+    def __init__(self, image_size: int=512, heading: int=0):
+        self.image_size = image_size
+        self.heading = heading
+        self.image = np.zeros((image_size, image_size), dtype=np.uint8) # [ADC counts]
+        self.lut = None
+
+    def configure(self, range: float, number_of_samples: int):
+        """
+        Selects the lookup table of a device configuration. The image is cleared if the configuration changed.
+        """
+        _lut = polar_lut(float(range), int(number_of_samples), self.image_size, self.heading)
+        if _lut is not self.lut:
+            self.lut = _lut
+            self.image[:] = 0
+
+    def configure_from_processor(self, processor):
+        """
+        Selects the lookup table of the configuration of a PingProcessor
+        """
+        self.configure(processor.number_of_samples * processor.meters_per_sample, processor.number_of_samples)
+
+    def update(self, angle: int, profile: np.ndarray, width: int=1):
+        """
+        Draws a ping over the pixels of its angle.
+
+        Arguments:
+            angle: the angle of the ping [grad]
+            profile: the (number_of_samples,) intensities of the ping
+            width: the number of angles the ping covers, e.g. the step of the sweep, so that no gaps are left between pings (default: 1)
+        """
+        _flat = self.image.reshape(-1)
+        for pixels, samples in self.lut.sector_slices(angle, width):
+            _flat[pixels] = profile[samples]
+
+    def update_batch(self, angles, intensities: np.ndarray, width: int=1):
+        """
+        Draws a batch of pings, in order
+        """
+        for angle, profile in zip(angles, intensities):
+            self.update(int(angle), profile, width)
+
+    def clear(self):
+        self.image[:] = 0
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from sensors.Ping360.sonar_log import SonarLog, ANGLE_UNKNOWN
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    parser = ArgumentParser(description="Render a .sonar log into a sonar image")
+    parser.add_argument("log", help=".sonar log file")
+    parser.add_argument("output", help="Image file to write, e.g. sweep.png")
+    parser.add_argument("--size", type=int, default=512, help="Image width and height [px]")
+    parser.add_argument("--heading", type=int, default=200, help="Angle [grad] drawn at the top of the image")
+    parser.add_argument("--width", type=int, default=1, help="Angles covered by each ping (the sweep step)")
+    args = parser.parse_args()
+
+    log = SonarLog(args.log)
+    _known = log.angles != ANGLE_UNKNOWN
+    if not _known.any():
+        raise SystemExit("{} has no ping angles to draw (e.g. a converted .pk log)".format(args.log))
+
+    image = SonarImage(args.size, args.heading)
+    image.configure(log.settings.number_of_samples * log.settings.meters_per_sample, log.settings.number_of_samples)
+    image.update_batch(log.angles[_known], log.intensities[_known], args.width)
+    plt.imsave(args.output, image.image, cmap="viridis", vmin=0, vmax=255)
+    print("{} pings drawn into {}".format(int(_known.sum()), args.output))
@@ -0,0 +1,372 @@
+"""
+Compact, memory-mappable on-disk format for Ping360 logs (.sonar).
+
+A .sonar file holds the pings of a single device configuration, stored column by column so that any column can be memory-mapped and sliced without reading the rest of the file:
+
+    offset 0                 header (64 bytes, little-endian, see HEADER)
+    offset 64                timestamps : float64[capacity]  [s] since EPOCH (NaN if unknown)
+    then                     angles     : uint16[capacity]   [grad] (ANGLE_UNKNOWN if unknown)
+    then (8-byte aligned)    intensities: uint8[capacity, number_of_samples]  [ADC counts]
+
+The file is created at its full capacity (sparse on the Raspberry Pi's ext4 file system) and pings are appended in place; the header's n_pings tells how many rows are valid. Distances are not stored: they follow from the sample period in the header.
+
+SonarSegmentLogWriter plugs the format into the rotating log segments of the service (Ping360_data_{i}.sonar); a new segment is started whenever the device configuration changes.
+
+The module can also be run to convert the pickle logs of the service (e.g. data/102122/*.pk) into .sonar files:
+    python3 -m sensors.Ping360.sonar_log data/102122/*.pk
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from brping import PingMessage
+from dataclasses import dataclass, astuple
+from sensors.Ping360.ping360_log_writer import SegmentLogWriter
+import numpy as np
+import os
+import pickle as pk
+import struct
+
+SONAR_MAGIC = b'KODASNR\x00'
+SONAR_VERSION = 1
+ANGLE_UNKNOWN = 0xFFFF
+
+# magic, version, header size, capacity, n_pings, number_of_samples, sample_period, transmit_duration, transmit_frequency, gain_setting, v_sound
+HEADER = struct.Struct('<8sHHIIHHHHHf')
+HEADER_SIZE = 64
+N_PINGS_OFFSET = struct.calcsize('<8sHHI')
+
+
+@dataclass(frozen=True)
+class SonarLogSettings:
+    """
+    Device settings shared by every ping of a .sonar file
+    """
+    number_of_samples  : int        # per ping
+    sample_period      : int        # 80-40_000 [25ns]
+    transmit_duration  : int = 0    # 1-1000 [us], 0 if unknown
+    transmit_frequency : int = 0    # [kHz], 0 if unknown
+    gain_setting       : int = 0    # 0-2 (low,normal,high)
+    v_sound            : float = 1480 # [m/s] used for the distances
+
+    @classmethod
+    def from_message(cls, device_data: PingMessage, v_sound: float=1480):
+        """
+        Reads the settings of a Ping360 device_data message
+        """
+        return cls(device_data.number_of_samples, device_data.sample_period, device_data.transmit_duration,
+                   device_data.transmit_frequency, device_data.gain_setting, v_sound)
+
+    @property
+    def meters_per_sample(self):
+        # sample_period is in 25ns increments
+        # time of flight includes there and back, so divide by 2
+        return self.v_sound * self.sample_period * 12.5e-9
+
+    @property
+    def distances(self):
+        """
+        The distance [m] of every sample bin
+        """
+        return np.arange(self.number_of_samples) * self.meters_per_sample
+
+
+@dataclass
+class SonarPings:
+    """
+    A batch of pings to append to a .sonar file
+    """
+    settings    : SonarLogSettings
+    timestamps  : np.ndarray # [s] (N,)
+    angles      : np.ndarray # [grad] (N,)
+    intensities : np.ndarray # [ADC counts] (N, number_of_samples) uint8
+
+
+def _column_offsets(capacity: int, number_of_samples: int):
+    """
+    Returns the byte offsets of the timestamps, angles and intensities columns
+    """
+    _timestamps = HEADER_SIZE
+    _angles = _timestamps + 8 * capacity
+    _intensities = -(-(_angles + 2 * capacity) // 8) * 8
+    return _timestamps, _angles, _intensities
+
+
+class SonarLogWriter:
+    """
+    Creates a .sonar file and appends pings to it.
+
+    Arguments:
+        path: the file to create (overwritten if it exists)
+        settings: the device settings of every ping in the file
+        capacity: the maximum number of pings in the file (default: 4096)
+    """
+
+    def __init__(self, path: str, settings: SonarLogSettings, capacity: int=4096):
+        self.path = path
+        self.settings = settings
+        self.capacity = capacity
+        self.n_pings = 0
+        self._offsets = _column_offsets(capacity, settings.number_of_samples)
+
+        self._file = open(path, 'wb+')
+        self._file.truncate(self._offsets[2] + capacity * settings.number_of_samples)
+        # Pre-fill the metadata columns so unwritten rows read as unknown
+        self._file.seek(self._offsets[0])
+        self._file.write(np.full(capacity, np.nan, dtype='<f8').tobytes())
+        self._file.write(np.full(capacity, ANGLE_UNKNOWN, dtype='<u2').tobytes())
+        self._write_header()
+
+    def _write_header(self):
+        _header = HEADER.pack(SONAR_MAGIC, SONAR_VERSION, HEADER_SIZE, self.capacity, self.n_pings,
+                              *astuple(self.settings))
+        self._file.seek(0)
+        self._file.write(_header.ljust(HEADER_SIZE, b'\x00'))
+
+    @property
+    def free(self):
+        """
+        The number of pings that still fit in the file
+        """
+        return self.capacity - self.n_pings
+
+    def append(self, timestamps, angles, intensities):
+        """
+        Appends pings to the file.
+
+        Arguments:
+            timestamps: [s] (N,) or a scalar for every ping
+            angles: [grad] (N,) or a scalar for every ping
+            intensities: (N, number_of_samples) profiles
+
+        Raises:
+            ValueError: if the pings do not fit or do not have the file's number of samples
+        """
+        intensities = np.atleast_2d(np.asarray(intensities))
+        _n = intensities.shape[0]
+        if intensities.shape[1] != self.settings.number_of_samples:
+            raise ValueError("Pings of {} samples in a log of {} samples".format(intensities.shape[1], self.settings.number_of_samples))
+        if _n > self.free:
+            raise ValueError("{} pings do not fit in the {} free rows of {}".format(_n, self.free, self.path))
+
+        _timestamps = np.broadcast_to(np.asarray(timestamps, dtype='<f8'), (_n,))
+        _angles = np.broadcast_to(np.asarray(angles, dtype='<u2'), (_n,))
+        _timestamps_offset, _angles_offset, _intensities_offset = self._offsets
+
+        self._file.seek(_timestamps_offset + 8 * self.n_pings)
+        self._file.write(_timestamps.tobytes())
+        self._file.seek(_angles_offset + 2 * self.n_pings)
+        self._file.write(_angles.tobytes())
+        self._file.seek(_intensities_offset + self.settings.number_of_samples * self.n_pings)
+        self._file.write(np.ascontiguousarray(intensities, dtype=np.uint8).data)
+
+        # Only count the pings once they are written
+        self.n_pings += _n
+        self._file.seek(N_PINGS_OFFSET)
+        self._file.write(struct.pack('<I', self.n_pings))
+
+    def flush(self, fsync: bool=False):
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class SonarLog:
+    """
+    Read-only, memory-mapped access to a .sonar file. Nothing is read from the disk until a column is sliced.
+
+    Arguments:
+        path: the .sonar file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            _header = HEADER.unpack(file.read(HEADER.size))
+        _magic, _version, _header_size, self.capacity, self.n_pings, *_settings = _header
+        if _magic != SONAR_MAGIC:
+            raise ValueError("{} is not a .sonar file".format(path))
+        if _version != SONAR_VERSION:
+            raise ValueError("Unsupported .sonar version {} in {}".format(_version, path))
+        self.settings = SonarLogSettings(*_settings)
+
+        _timestamps_offset, _angles_offset, _intensities_offset = _column_offsets(self.capacity, self.settings.number_of_samples)
+        _shape = (self.n_pings,)
+        self.timestamps = np.memmap(path, dtype='<f8', mode='r', offset=_timestamps_offset, shape=_shape) if self.n_pings else np.empty(0)
+        self.angles = np.memmap(path, dtype='<u2', mode='r', offset=_angles_offset, shape=_shape) if self.n_pings else np.empty(0, dtype='<u2')
+        self.intensities = np.memmap(path, dtype=np.uint8, mode='r', offset=_intensities_offset,
+                                     shape=(self.n_pings, self.settings.number_of_samples)) if self.n_pings \
+            else np.empty((0, self.settings.number_of_samples), dtype=np.uint8)
+
+    def __len__(self):
+        return self.n_pings
+
+    @property
+    def distances(self):
+        return self.settings.distances
+
+    def ping(self, index: int):
+        """
+        Returns (timestamp, angle, profile) of a single ping; only that ping's profile is read
+        """
+        return self.timestamps[index], self.angles[index], self.intensities[index]
+
+    def angle_indices(self, start: int, stop: int):
+        """
+        Returns the indices of the pings with an angle in the sector [start, stop] gradians.
+        The sector may wrap around 0 (e.g. start=350, stop=50).
+        """
+        if start <= stop:
+            _mask = (self.angles >= start) & (self.angles <= stop)
+        else:
+            _mask = ((self.angles >= start) | (self.angles <= stop)) & (self.angles != ANGLE_UNKNOWN)
+        return np.flatnonzero(_mask)
+
+    def select_angles(self, start: int, stop: int):
+        """
+        Returns (timestamps, angles, intensities) of the pings in the sector [start, stop] gradians; only those profiles are read
+        """
+        _indices = self.angle_indices(start, stop)
+        return self.timestamps[_indices], self.angles[_indices], self.intensities[_indices]
+
+
+class SonarSegmentLogWriter(SegmentLogWriter):
+    """
+    Appends SonarPings records to rotating .sonar log segments. A segment is rotated when it is full, when it reaches the age limit or the date changes, and when the device settings change.
+
+    Arguments:
+        data_dir_path: the data directory; segments are written to its MMDDYY subdirectory, which is created if needed
+        prefix: the segment file name prefix (default: "Ping360_data")
+        capacity: the number of pings per segment (default: 4096, ~5 MB at 1200 samples)
+        max_age: rotate once a segment is this old in seconds, None for no limit (default: None)
+    """
+
+    def __init__(self, data_dir_path: str, prefix: str="Ping360_data", capacity: int=4096, max_age: float=None):
+        super().__init__(data_dir_path, prefix, ".sonar", max_bytes=None, max_age=max_age)
+        self.capacity = capacity
+        self._settings = None
+
+    def _open(self):
+        super()._open()
+        # The segment is created by the SonarLogWriter, with the settings of its first record
+        self._file.close()
+        self._file = SonarLogWriter(self.log_filename, self._settings, self.capacity)
+
+    def write(self, record: SonarPings, flush: bool=True):
+        """
+        Appends a batch of pings, splitting it across segments if it does not fit in the open one
+        """
+        _intensities = np.atleast_2d(record.intensities)
+        _timestamps = np.broadcast_to(np.asarray(record.timestamps, dtype='<f8'), (len(_intensities),))
+        _angles = np.broadcast_to(np.asarray(record.angles, dtype='<u2'), (len(_intensities),))
+        _start = 0
+        while _start < len(_intensities):
+            if self._needs_rotation() or self._file.free == 0 or record.settings != self._settings:
+                self.rotate()
+                self._settings = record.settings
+                self._open()
+            _stop = _start + min(self._file.free, len(_intensities) - _start)
+            self._file.append(_timestamps[_start:_stop], _angles[_start:_stop], _intensities[_start:_stop])
+            _start = _stop
+        if flush:
+            self._file.flush()
+
+    def flush(self, fsync: bool=False):
+        if self._file is not None:
+            self._file.flush(fsync)
+
+
+# =============================
+# === PICKLE LOG CONVERSION ===
+# =============================
+
+
+def load_pickle_records(path: str):
+    """
+    Yields every record pickled in a service .pk log; the service appends several records to a file
+    """
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                yield pk.load(file)
+            except EOFError:
+                return
+
+
+def pickle_record_arrays(record: dict):
+    """
+    Returns the (distances, intensities) arrays of a .pk log record.
+
+    The first logs of 102122 (Ping360_data_0-5) have the 'dimensions' and 'intensities' keys swapped; the distance matrix is the one whose rows increase by a constant step.
+    """
+    _dimensions, _intensities = np.asarray(record['dimensions']), np.asarray(record['intensities'])
+    _step = np.diff(_intensities[0])
+    if _step.size and np.all(_step > 0) and np.allclose(_step, _step[0]):
+        _dimensions, _intensities = _intensities, _dimensions
+    return _dimensions, _intensities
+
+
+def convert_pickle_log(pk_path: str, sonar_path: str=None, angle: int=ANGLE_UNKNOWN, v_sound: float=1480):
+    """
+    Converts a service .pk log into a .sonar file.
+
+    Logs from the service up to version 1.0.0 store the whole Ping message of every ping as float64 'intensities' (8 header and 14 payload bytes before the profile, 2 checksum bytes after); those bytes are dropped. The sample period is recovered from the distance step. The .pk logs have no timestamps or angles; the timestamps are left unknown and every ping gets 'angle'.
+
+    Arguments:
+        pk_path: the .pk log
+        sonar_path: the .sonar file to write (default: 'pk_path' with a .sonar extension)
+        angle: the angle [grad] the pings were taken at, if known (default: ANGLE_UNKNOWN)
+        v_sound: the speed of sound [m/s] the distances were computed with (default: 1480)
+
+    Returns:
+        The path of the .sonar file
+    """
+    sonar_path = sonar_path or os.path.splitext(pk_path)[0] + ".sonar"
+    _batches = []
+    for record in load_pickle_records(pk_path):
+        _distances, _intensities = pickle_record_arrays(record)
+        if _intensities.dtype != np.uint8:
+            # Whole Ping message per ping: drop the header, payload fields and checksum
+            _intensities = _intensities[:, 22:-2]
+        _sample_period = int(round((_distances[0, 1] - _distances[0, 0]) / (v_sound * 12.5e-9)))
+        _batches.append((_sample_period, _intensities.astype(np.uint8)))
+
+    if not _batches:
+        raise ValueError("No records in {}".format(pk_path))
+    if len({(_sample_period, _intensities.shape[1]) for _sample_period, _intensities in _batches}) > 1:
+        raise ValueError("{} mixes device configurations; a .sonar file holds a single one".format(pk_path))
+
+    _sample_period, _ = _batches[0]
+    _intensities = np.concatenate([_intensities for _, _intensities in _batches])
+    _settings = SonarLogSettings(_intensities.shape[1], _sample_period, v_sound=v_sound)
+
+    _writer = SonarLogWriter(sonar_path, _settings, capacity=len(_intensities))
+    _writer.append(np.nan, angle, _intensities)
+    _writer.close()
+    return sonar_path
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Convert Ping360 service .pk logs into .sonar files")
+    parser.add_argument("files", nargs="+", help=".pk log files")
+    parser.add_argument("--angle", type=int, default=ANGLE_UNKNOWN, help="Angle [grad] the pings were taken at, if known")
+    parser.add_argument("--v-sound", type=float, default=1480, help="Speed of sound [m/s] the logs were recorded with")
+    args = parser.parse_args()
+
+    for pk_path in args.files:
+        sonar_path = convert_pickle_log(pk_path, angle=args.angle, v_sound=args.v_sound)
+        print("{} ({} bytes) -> {} ({} bytes)".format(pk_path, os.path.getsize(pk_path), sonar_path, os.path.getsize(sonar_path)))
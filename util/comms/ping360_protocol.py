@@ -0,0 +1,744 @@
+"""
+Binary wire protocol between the Ping360 service and its clients.
+
+Every datagram starts with the same 4 byte header: the magic bytes b'KP', the protocol version and the message type. All fields are little-endian.
+
+Request (MSG_REQUEST, 24 bytes, followed by the angle list with FLAG_ANGLES, then the early exit settings with FLAG_EARLY_EXIT):
+    header, flags: uint16, angle: uint16 [grad], range: float32 [m], n_samples: uint16 (pings), readings: uint16 (samples per ping), newer_than: float64 [s] (only used with FLAG_NEWER_THAN)
+    angle list: n_angles: uint16, angles: uint16[n_angles] [grad]
+    early exit: max_std: float32 [m], min_pings: uint16
+
+Response (MSG_RESPONSE, 16 byte head followed by n_pings PING_RECORDs of 15 bytes, then n_pings * n_echoes ECHO_RECORDs of 11 bytes, then one ESTIMATE_RECORD of 11 bytes if the request asked for an integration mode):
+    header, status: uint8, n_echoes: uint8, n_pings: uint16, number_of_samples: uint16, meters_per_sample: float32 [m], stream_id: uint16
+    record: timestamp: float64 [s] (NaN if unknown), distance: float32 [m], max_index: uint16, intensity: uint8 [ADC counts]
+    echo: index: int16 (-1 if none), distance: float32 [m] (NaN if none), intensity: uint8 [ADC counts], snr: float32 [dB] (NaN if none)
+    estimate: distance: float32 [m], std: float32 [m], intensity: uint8 [ADC counts], n_pings: uint16 (pings the estimate is made of)
+
+Profile chunk (MSG_PROFILE_CHUNK, 20 byte head followed by up to one MTU of uint8 samples):
+    header, stream_id: uint16, sequence: uint32, ping_index: uint16, n_pings: uint16, chunk_index: uint16, n_chunks: uint16 (per ping), sample_offset: uint16
+
+Sector update (MSG_SECTOR, 16 byte head followed by n_pings SECTOR_RECORDs of 17 bytes):
+    header, sequence: uint32, n_pings: uint16, number_of_samples: uint16, meters_per_sample: float32 [m]
+    record: timestamp: float64 [s], angle: uint16 [grad], distance: float32 [m], max_index: uint16, intensity: uint8 [ADC counts]
+
+The top 4 bits of the request flags (ECHOES_MASK) select the echo detector: 0 keeps the strongest return in the range gate, k = 1-15 runs the CFAR detector of ping_processing.py and returns its k best echoes of every ping in the response (ping-major order).
+
+Bits 8-10 of the request flags (INTEGRATION_MASK) ask the service to integrate the pings into a single range estimate (see PingProcessor.integrate()): INTEGRATION_AVERAGE averages the raw profiles before the detection, INTEGRATION_MEDIAN, INTEGRATION_TRIMMED and INTEGRATION_MEAN take the median, the trimmed mean and the mean of the per-ping ranges. With FLAG_EARLY_EXIT the service stops pinging once the standard error of the estimate is below 'max_std' (after at least 'min_pings' pings), so the response may hold fewer than 'n_samples' pings.
+
+Multi-angle response (MSG_ANGLES_RESPONSE): the layout of a sector update; its sequence field holds the total number of records of the response, in every datagram, so a client knows when it has received them all.
+
+Stats request (MSG_STATS_REQUEST, 4 bytes): header only.
+
+Stats (MSG_STATS, 12 byte head followed by n_stages STAGE_STATS_RECORDs of 36 bytes):
+    header, n_stages: uint16, reserved: uint16, time_span: float32 [s] (the statistics cover the last 'time_span' seconds)
+    record: stage: char[12] (NUL-padded name), count: uint32, mean, p50, p95, p99, max: float32 [s] (NaN if count is 0)
+
+A request that sets FLAG_ANGLES asks for 'n_samples' pings at every angle of its list (e.g. port and starboard, or a sector expanded with expand_angles()); 'angle' is then the first angle of the list. The service acquires the angles in the order that minimizes head travel, interleaved with the angles of the other clients, and answers with a multi-angle response whose records carry the angle of every ping. The response is split over several datagrams if its records do not fit in one; FLAG_PROFILES, the echo records and the estimate are not available for multi-angle requests.
+
+If a request sets FLAG_PROFILES, the response carries a non-zero stream_id and is followed by the full intensity profile of every ping, split into datagrams that fit in one MTU. The chunks of a stream are numbered sequence = ping_index * n_chunks + chunk_index, so a ProfileReassembler on the client can rebuild the profiles and tell exactly which chunks were lost.
+
+In sweep mode, a request that sets FLAG_SUBSCRIBE also subscribes its client to the sweep: every few pings the service pushes a sector update with the processed pings of the angles just swept. The subscription lapses unless the client renews it with another request. The sequence number counts the sector updates, so a client can tell when one was lost.
+
+A stats request is answered with the latency statistics of every stage of the service's request path (see ping360_metrics.py), e.g. "transmit" for every transmitAngle or "request" for the whole time a request spent in the service.
+
+The per-ping records are a packed NumPy structured array, so a received response is read with np.frombuffer without copying, and a response is packed by filling a view of the outgoing buffer.
+
+Datagrams that do not start with the magic bytes are treated as legacy pickled request dictionaries during the migration. They are unpickled with a restricted unpickler that refuses to load any global (class or function), so only plain dicts, numbers and strings are accepted.
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+ - Version 1.1.0: Added chunked streaming of full intensity profiles
+ - Version 1.2.0: Added the sweep mode sector updates
+ - Version 1.3.0: Added multi-angle requests
+ - Version 1.4.0: Added the per-request CFAR echo detector and the echo records
+ - Version 1.5.0: Added the multi-ping integration modes, the range estimate and the early exit
+ - Version 1.6.0: Added the stats request and the per-stage latency statistics
+ - Version 1.7.0: The multi-angle response carries its total number of records
+ - Version 1.7.1: Early-exit requests with different echo detectors or integration modes no longer compare equal
+ - Version 1.7.2: Legacy clients get a single NaN reading for an error response
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.7.2"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+from dataclasses import dataclass, field
+import io
+import numpy as np
+import pickle as pk
+import struct
+
+PROTOCOL_MAGIC = b'KP'
+PROTOCOL_VERSION = 1
+
+# Message types
+MSG_REQUEST = 1
+MSG_RESPONSE = 2
+MSG_PROFILE_CHUNK = 3
+MSG_SECTOR = 4
+MSG_ANGLES_RESPONSE = 5
+MSG_STATS_REQUEST = 6
+MSG_STATS = 7
+
+# Request flags
+FLAG_LOGGING = 0x0001       # Log the acquisition on the AUV
+FLAG_NEWER_THAN = 0x0002    # Only return pings newer than 'newer_than' (continuous mode)
+FLAG_PROFILES = 0x0004      # Stream the full intensity profiles after the response
+FLAG_SUBSCRIBE = 0x0008     # Subscribe to (or renew) the sector updates of the sweep mode
+FLAG_ANGLES = 0x0010        # The request is followed by a list of angles to ping
+FLAG_EARLY_EXIT = 0x0020    # The request is followed by the early exit settings
+INTEGRATION_MASK = 0x0700   # Multi-ping integration mode, one of INTEGRATION_*
+INTEGRATION_SHIFT = 8
+ECHOES_MASK = 0xF000        # Number of CFAR echoes per ping, 0 for the strongest-return detector
+ECHOES_SHIFT = 12
+
+# Multi-ping integration modes, in the order of ping_processing.INTEGRATION_MODES
+INTEGRATION_NONE = 0
+INTEGRATION_AVERAGE = 1
+INTEGRATION_MEDIAN = 2
+INTEGRATION_TRIMMED = 3
+INTEGRATION_MEAN = 4
+
+# Response status codes
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# Largest UDP payload that fits in one Ethernet frame (1500 byte MTU - 20 byte IP header - 8 byte UDP header)
+MAX_DATAGRAM_SIZE = 1472
+
+HEADER = struct.Struct('<2sBB')
+REQUEST = struct.Struct('<2sBBHHfHHd')
+ANGLE_LIST = struct.Struct('<H')
+EARLY_EXIT = struct.Struct('<fH')
+RESPONSE = struct.Struct('<2sBBBBHHfH')
+PING_RECORD = np.dtype([
+    ('timestamp', '<f8'),
+    ('distance', '<f4'),
+    ('max_index', '<u2'),
+    ('intensity', 'u1'),
+])
+ECHO_RECORD = np.dtype([
+    ('index', '<i2'),
+    ('distance', '<f4'),
+    ('intensity', 'u1'),
+    ('snr', '<f4'),
+])
+ESTIMATE_RECORD = np.dtype([
+    ('distance', '<f4'),
+    ('std', '<f4'),
+    ('intensity', 'u1'),
+    ('n_pings', '<u2'),
+])
+PROFILE_CHUNK = struct.Struct('<2sBBHIHHHHH')
+SECTOR = struct.Struct('<2sBBIHHf')
+SECTOR_RECORD = np.dtype([
+    ('timestamp', '<f8'),
+    ('angle', '<u2'),
+    ('distance', '<f4'),
+    ('max_index', '<u2'),
+    ('intensity', 'u1'),
+])
+STATS = struct.Struct('<2sBBHHf')
+STAGE_STATS_RECORD = np.dtype([
+    ('stage', 'S12'),
+    ('count', '<u4'),
+    ('mean', '<f4'),
+    ('p50', '<f4'),
+    ('p95', '<f4'),
+    ('p99', '<f4'),
+    ('max', '<f4'),
+])
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when a datagram is not a valid message of this protocol
+    """
+
+
+def message_type(datagram: bytes):
+    """
+    Returns the message type of a protocol datagram, or None if it is not one (e.g. a legacy pickled request)
+
+    Raises:
+        ProtocolError: if the datagram is a protocol message of an unsupported version
+    """
+    if len(datagram) < HEADER.size or datagram[:2] != PROTOCOL_MAGIC:
+        return None
+    _magic, _version, _type = HEADER.unpack_from(datagram)
+    if _version != PROTOCOL_VERSION:
+        raise ProtocolError("Unsupported protocol version {} (expected {})".format(_version, PROTOCOL_VERSION))
+    return _type
+
+
+def expand_angles(*angles):
+    """
+    Returns the angle list of a multi-angle request. Each item is either an angle [grad] or a (start, stop[, step]) sector, stop included.
+
+    Example:
+        expand_angles(100, 300)          -> (100, 300)
+        expand_angles((350, 50, 10))     -> (350, 360, 370, 380, 390, 0, 10, 20, 30, 40, 50)
+    """
+    _angles = []
+    for item in angles:
+        if np.isscalar(item):
+            _angles.append(int(item) % 400)
+            continue
+        _start, _stop, _step = (tuple(item) + (1,))[:3]
+        _span = (_stop - _start) % 400 # sectors may wrap around 0
+        _angles.extend(int(angle) % 400 for angle in range(_start, _start + _span + 1, _step))
+    return tuple(_angles)
+
+
+@dataclass(frozen=True)
+class Ping360Request:
+    """
+    The acquisition parameters of a client request. Requests that compare equal are served by the same acquisition.
+    The echo detector and integration mode only change how the pings are processed, except for early-exit requests, where they decide when pinging stops; 'exit_rule' makes them part of the comparison then.
+    """
+    n_samples : int   # Number of pings to take
+    angle     : int   # [grad] Transmission angle
+    range     : float # [m] Range the SONAR should scan
+    readings  : int   # Number of samples per ping
+    newer_than: float = field(default=None, compare=False) # [s] Continuous mode only: only return pings taken after this time
+    flags     : int = field(default=0, compare=False)
+    angles    : tuple = field(default=(), compare=False) # [grad] Multi-angle requests only: every angle to ping, 'angle' is the first one
+    echoes    : int = field(default=0, compare=False) # Number of CFAR echoes to return per ping (0-15), 0 for the strongest return only
+    integration: int = field(default=INTEGRATION_NONE, compare=False) # Multi-ping integration mode, one of INTEGRATION_*
+    max_std   : float = None # [m] Stop pinging once the standard error of the range estimate is below this, None to take all the pings
+    min_pings : int = 3      # Early exit: the minimum number of pings to take
+    exit_rule : tuple = field(default=None, init=False, repr=False) # Early exit only: (echoes, integration), which the stop depends on
+
+    def __post_init__(self):
+        if self.max_std is not None:
+            object.__setattr__(self, "exit_rule", (self.echoes, self.integration))
+
+    @classmethod
+    def for_angles(cls, angles, n_samples: int, range: float, readings: int, **settings):
+        """
+        Creates a multi-angle request; 'angles' is a sequence of angles and sectors (see expand_angles()), 'settings' the other fields
+        """
+        _angles = expand_angles(*angles)
+        return cls(n_samples, _angles[0], range, readings, angles=_angles, **settings)
+
+    def split(self):
+        """
+        Returns the single-angle request of every angle of a multi-angle request
+        """
+        return [Ping360Request(self.n_samples, angle, self.range, self.readings, self.newer_than, self.flags, echoes=self.echoes,
+                               integration=self.integration, max_std=self.max_std, min_pings=self.min_pings)
+                for angle in self.angles]
+
+    def pack(self):
+        """
+        Returns the request as a protocol datagram
+        """
+        _flags = self.flags
+        if self.newer_than is not None:
+            _flags |= FLAG_NEWER_THAN
+        if self.angles:
+            _flags |= FLAG_ANGLES
+        if not 0 <= self.echoes <= ECHOES_MASK >> ECHOES_SHIFT:
+            raise ValueError("Up to {} echoes per ping can be requested".format(ECHOES_MASK >> ECHOES_SHIFT))
+        _flags |= self.echoes << ECHOES_SHIFT | self.integration << INTEGRATION_SHIFT
+        if self.max_std is not None:
+            _flags |= FLAG_EARLY_EXIT
+        _datagram = REQUEST.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, MSG_REQUEST, _flags, self.angle, self.range,
+                                 self.n_samples, self.readings, self.newer_than or 0.0)
+        if self.angles:
+            _datagram += ANGLE_LIST.pack(len(self.angles)) + np.asarray(self.angles, dtype='<u2').tobytes()
+        if self.max_std is not None:
+            _datagram += EARLY_EXIT.pack(self.max_std, self.min_pings)
+        return _datagram
+
+    @classmethod
+    def unpack(cls, datagram: bytes):
+        """
+        Reads a request datagram
+
+        Raises:
+            ProtocolError: if the datagram is not a request
+        """
+        if message_type(datagram) != MSG_REQUEST or len(datagram) < REQUEST.size:
+            raise ProtocolError("Not a Ping360 request")
+        _, _, _, _flags, _angle, _range, _n_samples, _readings, _newer_than = REQUEST.unpack_from(datagram)
+
+        _offset = REQUEST.size
+        _angles = ()
+        if _flags & FLAG_ANGLES:
+            if len(datagram) < _offset + ANGLE_LIST.size:
+                raise ProtocolError("Truncated Ping360 request angle list")
+            _n_angles, = ANGLE_LIST.unpack_from(datagram, _offset)
+            if _n_angles == 0 or len(datagram) < _offset + ANGLE_LIST.size + 2 * _n_angles:
+                raise ProtocolError("Truncated Ping360 request angle list: {} bytes for {} angles".format(len(datagram), _n_angles))
+            _angles = tuple(np.frombuffer(datagram, dtype='<u2', count=_n_angles, offset=_offset + ANGLE_LIST.size).tolist())
+            _offset += ANGLE_LIST.size + 2 * _n_angles
+
+        _max_std, _min_pings = None, 3
+        if _flags & FLAG_EARLY_EXIT:
+            if len(datagram) < _offset + EARLY_EXIT.size:
+                raise ProtocolError("Truncated Ping360 request early exit settings")
+            _max_std, _min_pings = EARLY_EXIT.unpack_from(datagram, _offset)
+
+        return cls(
+            n_samples=_n_samples,
+            angle=_angle,
+            range=_range,
+            readings=_readings,
+            newer_than=_newer_than if _flags & FLAG_NEWER_THAN else None,
+            flags=_flags & ~(FLAG_NEWER_THAN | FLAG_ANGLES | FLAG_EARLY_EXIT | ECHOES_MASK | INTEGRATION_MASK),
+            angles=_angles,
+            echoes=(_flags & ECHOES_MASK) >> ECHOES_SHIFT,
+            integration=(_flags & INTEGRATION_MASK) >> INTEGRATION_SHIFT,
+            max_std=_max_std,
+            min_pings=_min_pings
+        )
+
+    @classmethod
+    def from_client_message(cls, client_message: dict):
+        """
+        Reads the dictionary sent by a legacy (pickle) client
+        """
+        return cls(
+            n_samples=int(client_message.get("Number of samples")),
+            angle=int(client_message.get("Angle")),
+            range=client_message.get("Range"),
+            readings=int(client_message.get("Readings")),
+            newer_than=client_message.get("Newer than"),
+            flags=FLAG_LOGGING # The pickle service logged every acquisition, whatever "Enable Logging" said
+        )
+
+
+@dataclass
+class Ping360Response:
+    """
+    The processed pings sent back to a client. 'records' is a PING_RECORD array, one record per ping.
+    'echoes' is an (n_pings, n_echoes) ECHO_RECORD array if the client asked for CFAR echoes, otherwise None.
+    'estimate' is an ESTIMATE_RECORD if the client asked for an integration mode, otherwise None.
+    """
+    records           : np.ndarray
+    number_of_samples : int = 0
+    meters_per_sample : float = 0.0
+    status            : int = STATUS_OK
+    stream_id         : int = 0 # Non-zero if the full profiles follow in MSG_PROFILE_CHUNK datagrams
+    echoes            : np.ndarray = None
+    estimate          : np.void = None
+
+    @property
+    def likely_distance(self):
+        return self.records['distance']
+
+    @property
+    def intensity_likely_distance(self):
+        return self.records['intensity']
+
+    @property
+    def likely_max_index(self):
+        return self.records['max_index']
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    @classmethod
+    def from_result(cls, result, meters_per_sample: float, timestamps: np.ndarray=None):
+        """
+        Creates a response from a PingBatchResult of the processing engine
+        """
+        _records = np.empty(len(result.likely_distance), dtype=PING_RECORD)
+        _records['timestamp'] = np.nan if timestamps is None else timestamps
+        _records['distance'] = result.likely_distance
+        _records['max_index'] = result.likely_max_index
+        _records['intensity'] = result.intensity_likely_distance
+
+        _echoes = None
+        if result.echoes is not None:
+            _echoes = np.empty(result.echoes.index.shape, dtype=ECHO_RECORD)
+            for name in ECHO_RECORD.names:
+                _echoes[name] = getattr(result.echoes, name)
+
+        _estimate = None
+        if result.estimate is not None:
+            _estimate = np.zeros((), dtype=ESTIMATE_RECORD)[()]
+            for name in ESTIMATE_RECORD.names:
+                _estimate[name] = getattr(result.estimate, name)
+        return cls(_records, result.intensities.shape[-1], meters_per_sample, echoes=_echoes, estimate=_estimate)
+
+    @classmethod
+    def error(cls):
+        """
+        Creates the response sent when a request could not be served
+        """
+        return cls(np.empty(0, dtype=PING_RECORD), status=STATUS_ERROR)
+
+    def pack(self):
+        """
+        Returns the response as a protocol datagram. The records are written straight into the datagram buffer.
+        """
+        _n_echoes = 0 if self.echoes is None else self.echoes.shape[1]
+        _echoes_offset = RESPONSE.size + len(self.records) * PING_RECORD.itemsize
+        _estimate_offset = _echoes_offset + len(self.records) * _n_echoes * ECHO_RECORD.itemsize
+        _datagram = bytearray(_estimate_offset + (0 if self.estimate is None else ESTIMATE_RECORD.itemsize))
+        RESPONSE.pack_into(_datagram, 0, PROTOCOL_MAGIC, PROTOCOL_VERSION, MSG_RESPONSE, self.status, _n_echoes,
+                           len(self.records), self.number_of_samples, self.meters_per_sample, self.stream_id)
+        np.frombuffer(_datagram, dtype=PING_RECORD, count=len(self.records), offset=RESPONSE.size)[:] = self.records
+        if _n_echoes:
+            np.frombuffer(_datagram, dtype=ECHO_RECORD, count=self.echoes.size, offset=_echoes_offset)[:] = self.echoes.ravel()
+        if self.estimate is not None:
+            np.frombuffer(_datagram, dtype=ESTIMATE_RECORD, offset=_estimate_offset)[0] = self.estimate
+        return _datagram
+
+    @classmethod
+    def unpack(cls, datagram: bytes):
+        """
+        Reads a response datagram. The records are a read-only view of 'datagram'; nothing is copied.
+
+        Raises:
+            ProtocolError: if the datagram is not a response or is truncated
+        """
+        if message_type(datagram) != MSG_RESPONSE or len(datagram) < RESPONSE.size:
+            raise ProtocolError("Not a Ping360 response")
+        _, _, _, _status, _n_echoes, _n_pings, _number_of_samples, _meters_per_sample, _stream_id = RESPONSE.unpack_from(datagram)
+        _echoes_offset = RESPONSE.size + _n_pings * PING_RECORD.itemsize
+        _estimate_offset = _echoes_offset + _n_pings * _n_echoes * ECHO_RECORD.itemsize
+        if len(datagram) < _estimate_offset:
+            raise ProtocolError("Truncated Ping360 response: {} bytes for {} pings".format(len(datagram), _n_pings))
+        _records = np.frombuffer(datagram, dtype=PING_RECORD, count=_n_pings, offset=RESPONSE.size)
+        _echoes = None
+        if _n_echoes:
+            _echoes = np.frombuffer(datagram, dtype=ECHO_RECORD, count=_n_pings * _n_echoes, offset=_echoes_offset).reshape(_n_pings, _n_echoes)
+        _estimate = None
+        if len(datagram) >= _estimate_offset + ESTIMATE_RECORD.itemsize:
+            _estimate = np.frombuffer(datagram, dtype=ESTIMATE_RECORD, count=1, offset=_estimate_offset)[0]
+        return cls(_records, _number_of_samples, _meters_per_sample, _status, _stream_id, _echoes, _estimate)
+
+
+# =========================
+# === PROFILE STREAMING ===
+# =========================
+
+
+def pack_profile_chunks(stream_id: int, intensities: np.ndarray, max_datagram_size: int=MAX_DATAGRAM_SIZE):
+    """
+    Splits full intensity profiles into MSG_PROFILE_CHUNK datagrams that each fit in 'max_datagram_size' bytes
+
+    Arguments:
+        stream_id: the stream_id of the response the profiles belong to
+        intensities: an (n_pings, number_of_samples) uint8 array of profiles
+        max_datagram_size: the largest datagram to send, in bytes (default: MAX_DATAGRAM_SIZE)
+
+    Yields:
+        The chunk datagrams, in sequence order
+    """
+    _n_pings, _number_of_samples = intensities.shape
+    _chunk_samples = max_datagram_size - PROFILE_CHUNK.size
+    _n_chunks = max(1, -(-_number_of_samples // _chunk_samples))
+    for _ping_index in range(_n_pings):
+        for _chunk_index in range(_n_chunks):
+            _offset = _chunk_index * _chunk_samples
+            _samples = intensities[_ping_index, _offset:_offset + _chunk_samples]
+            _datagram = bytearray(PROFILE_CHUNK.size + len(_samples))
+            PROFILE_CHUNK.pack_into(_datagram, 0, PROTOCOL_MAGIC, PROTOCOL_VERSION, MSG_PROFILE_CHUNK, stream_id,
+                                    _ping_index * _n_chunks + _chunk_index, _ping_index, _n_pings, _chunk_index, _n_chunks, _offset)
+            _datagram[PROFILE_CHUNK.size:] = _samples.data
+            yield _datagram
+
+
+class ProfileReassembler:
+    """
+    Rebuilds the full profiles of a response from its MSG_PROFILE_CHUNK datagrams, in any arrival order, and keeps track of lost chunks.
+
+    Arguments:
+        response: the response announcing the stream (its stream_id must be non-zero)
+    """
+
+    def __init__(self, response: Ping360Response):
+        self.stream_id = response.stream_id
+        self.profiles = np.zeros((len(response.records), response.number_of_samples), dtype=np.uint8)
+        self.received = None # chunk received flags, indexed by sequence number; sized by the first chunk
+        self.n_chunks = None
+
+    def feed(self, datagram: bytes):
+        """
+        Stores one chunk datagram
+
+        Returns:
+            The index of the ping the chunk completed, or None
+
+        Raises:
+            ProtocolError: if the datagram is not a chunk of this stream
+        """
+        if message_type(datagram) != MSG_PROFILE_CHUNK or len(datagram) < PROFILE_CHUNK.size:
+            raise ProtocolError("Not a Ping360 profile chunk")
+        _, _, _, _stream_id, _sequence, _ping_index, _n_pings, _chunk_index, _n_chunks, _offset = PROFILE_CHUNK.unpack_from(datagram)
+        if _stream_id != self.stream_id:
+            raise ProtocolError("Chunk of stream {} while reassembling stream {}".format(_stream_id, self.stream_id))
+
+        if self.received is None:
+            self.n_chunks = _n_chunks
+            self.received = np.zeros(_n_pings * _n_chunks, dtype=bool)
+
+        _samples = np.frombuffer(datagram, dtype=np.uint8, offset=PROFILE_CHUNK.size)
+        self.profiles[_ping_index, _offset:_offset + len(_samples)] = _samples
+        self.received[_sequence] = True
+
+        if self.received[_ping_index * _n_chunks:(_ping_index + 1) * _n_chunks].all():
+            return _ping_index
+        return None
+
+    @property
+    def complete(self):
+        return self.received is not None and bool(self.received.all())
+
+    @property
+    def complete_pings(self):
+        """
+        Boolean mask of the pings whose profile was fully received
+        """
+        if self.received is None:
+            return np.zeros(len(self.profiles), dtype=bool)
+        return self.received.reshape(-1, self.n_chunks).all(axis=1)
+
+    def missing(self):
+        """
+        Returns the sequence numbers of the chunks not received (yet). Before any chunk arrived, the count is unknown and None is returned.
+        """
+        if self.received is None:
+            return None
+        return np.flatnonzero(~self.received)
+
+
+def receive_profiles(udp_socket, response: Ping360Response, timeout: float=1.0, buffer_size: int=MAX_DATAGRAM_SIZE):
+    """
+    Receives the profile stream announced by 'response' on 'udp_socket'
+
+    Arguments:
+        udp_socket: the client socket the request was sent from
+        response: the response announcing the stream
+        timeout: the maximum time [s] to wait for the next chunk before giving up on the missing ones (default: 1.0)
+        buffer_size: the size of the datagram buffer, in bytes (default: MAX_DATAGRAM_SIZE)
+
+    Returns:
+        The ProfileReassembler holding the profiles and the record of lost chunks
+    """
+    _reassembler = ProfileReassembler(response)
+    _previous_timeout = udp_socket.gettimeout()
+    udp_socket.settimeout(timeout)
+    try:
+        while not _reassembler.complete:
+            _datagram = udp_socket.recv(buffer_size)
+            try:
+                _reassembler.feed(_datagram)
+            except ProtocolError:
+                continue # A stray datagram, e.g. from an older stream
+    except OSError: # socket.timeout
+        pass
+    finally:
+        udp_socket.settimeout(_previous_timeout)
+    return _reassembler
+
+
+# ============================
+# === SWEEP SECTOR UPDATES ===
+# ============================
+
+
+@dataclass
+class SectorUpdate:
+    """
+    The processed pings of a sector of the sweep, pushed to the subscribed clients. 'records' is a SECTOR_RECORD array, one record per ping.
+    Also the reply to a multi-angle request (message MSG_ANGLES_RESPONSE), whose sequence is the total number of records of the response.
+    """
+    records           : np.ndarray
+    number_of_samples : int = 0
+    meters_per_sample : float = 0.0
+    sequence          : int = 0 # Number of the update, incremented for every sector; total number of records of a multi-angle response
+    message           : int = MSG_SECTOR
+
+    @property
+    def angles(self):
+        return self.records['angle']
+
+    @property
+    def likely_distance(self):
+        return self.records['distance']
+
+    @property
+    def intensity_likely_distance(self):
+        return self.records['intensity']
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    @classmethod
+    def from_result(cls, result, meters_per_sample: float, timestamps: np.ndarray, angles: np.ndarray, sequence: int=0):
+        """
+        Creates a sector update from a PingBatchResult of the processing engine and the time and angle of every ping
+        """
+        _records = np.empty(len(result.likely_distance), dtype=SECTOR_RECORD)
+        _records['timestamp'] = timestamps
+        _records['angle'] = angles
+        _records['distance'] = result.likely_distance
+        _records['max_index'] = result.likely_max_index
+        _records['intensity'] = result.intensity_likely_distance
+        return cls(_records, result.intensities.shape[-1], meters_per_sample, sequence)
+
+    @classmethod
+    def from_responses(cls, responses, angles):
+        """
+        Creates the multi-angle response from the Ping360Response of every angle
+        """
+        _records = np.empty(sum(len(response.records) for response in responses), dtype=SECTOR_RECORD)
+        _start = 0
+        for response, angle in zip(responses, angles):
+            _stop = _start + len(response.records)
+            _records['angle'][_start:_stop] = angle
+            for name in PING_RECORD.names:
+                _records[name][_start:_stop] = response.records[name]
+            _start = _stop
+        return cls(_records, responses[0].number_of_samples, responses[0].meters_per_sample, len(_records), MSG_ANGLES_RESPONSE)
+
+    def pack(self, max_datagram_size: int=MAX_DATAGRAM_SIZE):
+        """
+        Returns the sector update as a list of protocol datagrams of at most 'max_datagram_size' bytes, all with the same sequence number
+        """
+        _per_datagram = (max_datagram_size - SECTOR.size) // SECTOR_RECORD.itemsize
+        _datagrams = []
+        for _start in range(0, max(len(self.records), 1), _per_datagram):
+            _records = self.records[_start:_start + _per_datagram]
+            _datagram = bytearray(SECTOR.size + len(_records) * SECTOR_RECORD.itemsize)
+            SECTOR.pack_into(_datagram, 0, PROTOCOL_MAGIC, PROTOCOL_VERSION, self.message, self.sequence,
+                             len(_records), self.number_of_samples, self.meters_per_sample)
+            np.frombuffer(_datagram, dtype=SECTOR_RECORD, offset=SECTOR.size)[:] = _records
+            _datagrams.append(_datagram)
+        return _datagrams
+
+    @classmethod
+    def unpack(cls, datagram: bytes):
+        """
+        Reads a sector update or multi-angle response datagram. The records are a read-only view of 'datagram'; nothing is copied.
+
+        Raises:
+            ProtocolError: if the datagram is not a sector update or is truncated
+        """
+        _type = message_type(datagram)
+        if _type not in (MSG_SECTOR, MSG_ANGLES_RESPONSE) or len(datagram) < SECTOR.size:
+            raise ProtocolError("Not a Ping360 sector update")
+        _, _, _, _sequence, _n_pings, _number_of_samples, _meters_per_sample = SECTOR.unpack_from(datagram)
+        if len(datagram) < SECTOR.size + _n_pings * SECTOR_RECORD.itemsize:
+            raise ProtocolError("Truncated Ping360 sector update: {} bytes for {} pings".format(len(datagram), _n_pings))
+        _records = np.frombuffer(datagram, dtype=SECTOR_RECORD, count=_n_pings, offset=SECTOR.size)
+        return cls(_records, _number_of_samples, _meters_per_sample, _sequence, _type)
+
+
+# =============
+# === STATS ===
+# =============
+
+
+def pack_stats_request():
+    """
+    Returns a stats request datagram
+    """
+    return HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, MSG_STATS_REQUEST)
+
+
+@dataclass
+class ServiceStats:
+    """
+    The latency statistics of the service's request path. 'records' is a STAGE_STATS_RECORD array, one record per stage.
+    """
+    records   : np.ndarray
+    time_span : float = 0.0 # [s] The statistics cover the last 'time_span' seconds
+
+    @classmethod
+    def from_snapshot(cls, snapshot, time_span: float):
+        """
+        Creates the stats from a StageStats snapshot: [(stage, count, mean, p50, p95, p99, max), ...]
+        """
+        _records = np.empty(len(snapshot), dtype=STAGE_STATS_RECORD)
+        for index, (stage, *values) in enumerate(snapshot):
+            _records[index] = (stage.encode(), *values)
+        return cls(_records, time_span)
+
+    def stage(self, name: str):
+        """
+        Returns the record of a stage as a dictionary
+        """
+        _record = self.records[self.records['stage'] == name.encode()][0]
+        return {field: _record[field].decode() if field == 'stage' else _record[field].item() for field in STAGE_STATS_RECORD.names}
+
+    def pack(self):
+        _datagram = bytearray(STATS.size + len(self.records) * STAGE_STATS_RECORD.itemsize)
+        STATS.pack_into(_datagram, 0, PROTOCOL_MAGIC, PROTOCOL_VERSION, MSG_STATS, len(self.records), 0, self.time_span)
+        np.frombuffer(_datagram, dtype=STAGE_STATS_RECORD, offset=STATS.size)[:] = self.records
+        return _datagram
+
+    @classmethod
+    def unpack(cls, datagram: bytes):
+        """
+        Reads a stats datagram. The records are a read-only view of 'datagram'.
+
+        Raises:
+            ProtocolError: if the datagram is not a stats message or is truncated
+        """
+        if message_type(datagram) != MSG_STATS or len(datagram) < STATS.size:
+            raise ProtocolError("Not Ping360 service stats")
+        _, _, _, _n_stages, _, _time_span = STATS.unpack_from(datagram)
+        if len(datagram) < STATS.size + _n_stages * STAGE_STATS_RECORD.itemsize:
+            raise ProtocolError("Truncated Ping360 service stats: {} bytes for {} stages".format(len(datagram), _n_stages))
+        return cls(np.frombuffer(datagram, dtype=STAGE_STATS_RECORD, count=_n_stages, offset=STATS.size), _time_span)
+
+    def __str__(self):
+        return "\n".join("{:>12}: {:6d} in the last {:.0f} s, mean {:8.2f} ms, p50 {:8.2f} ms, p95 {:8.2f} ms, p99 {:8.2f} ms, max {:8.2f} ms".format(
+            record['stage'].decode(), record['count'], self.time_span, *(record[field] * 1e3 for field in ('mean', 'p50', 'p95', 'p99', 'max')))
+            for record in self.records)
+
+
+# =============================
+# === LEGACY PICKLE CLIENTS ===
+# =============================
+
+
+class _RestrictedUnpickler(pk.Unpickler):
+    """
+    Unpickler that refuses to load any global, so only builtin containers, numbers and strings can be decoded
+    """
+
+    def find_class(self, module, name):
+        raise pk.UnpicklingError("Refusing to load {}.{} from a network datagram".format(module, name))
+
+
+def loads_legacy_request(datagram: bytes):
+    """
+    Safely reads the pickled request dictionary sent by a legacy client
+
+    Raises:
+        ProtocolError: if the datagram is not a pickled dictionary of plain values
+    """
+    try:
+        _client_message = _RestrictedUnpickler(io.BytesIO(datagram)).load()
+    except Exception as e:
+        raise ProtocolError("Invalid legacy request: {}".format(e))
+    if not isinstance(_client_message, dict):
+        raise ProtocolError("Invalid legacy request: expected a dict, got {}".format(type(_client_message).__name__))
+    return _client_message
+
+
+def dumps_legacy_response(response: Ping360Response):
+    """
+    Returns the pickled (likely_distance, intensity_likely_distance[, timestamps]) tuple expected by legacy clients.
+    Legacy clients have no status: an error response is a single NaN reading.
+    """
+    if response.status != STATUS_OK:
+        return pk.dumps((np.array([np.nan]), np.array([np.nan])))
+    _reply = (np.array(response.likely_distance, dtype=np.float64), np.array(response.intensity_likely_distance, dtype=np.float64))
+    if not np.all(np.isnan(response.timestamps)):
+        _reply += (np.array(response.timestamps),)
+    return pk.dumps(_reply)
@@ -0,0 +1,178 @@
+"""
+Sparse, tiled log-odds occupancy grid built from the Ping360 returns of a mission.
+
+The map is split into square tiles of 'tile_size' x 'tile_size' cells that are only allocated once a beam touches them, so the memory used grows with the area explored, not with the length of the mission. Every cell holds the log-odds of being occupied, clamped so that a cell can always change its mind.
+
+Each ping is fused as a single vectorized update: the beam is fanned out over its width into rays sampled every half cell, every sample is converted to a cell in the local NED frame (x north, y east [m]) from the vehicle pose and the head angle, and the cells in front of the echo are marked free while the cells at the echo are marked occupied. A cell is updated at most once per ping.
+
+Example:
+    grid = OccupancyGrid(resolution=0.05)
+    grid.update(x, y, yaw, angle, response.likely_distance[0])
+    grid.save("data/102122/map.npz")
+
+CHANGELOG:
+ - Version 1.0.0: Initial release
+"""
+
+__author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erbene de Castro Maia Junior"
+__copyright__   = "Copyright 2022"
+__credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
+__license__     = "MIT"
+__version__     = "1.0.0"
+__maintainer__  = "Braidan Duffy"
+__email__       = "bduffy2018@my.fit.edu"
+__status__      = "Prototype"
+
+import numpy as np
+
+GRAD_TO_RAD = np.pi / 200
+
+
+class OccupancyGrid:
+    """
+    Sparse tiled log-odds occupancy grid.
+
+    Arguments:
+        resolution: the size of a cell [m] (default: 0.05)
+        tile_size: the number of cells along each side of a tile (default: 64)
+        l_occupied: the log-odds added to a cell at an echo (default: 0.85)
+        l_free: the log-odds added to a cell in front of an echo (default: -0.4)
+        l_min: the lowest log-odds of a cell (default: -4.0)
+        l_max: the highest log-odds of a cell (default: 4.0)
+        beam_width: the horizontal beam width of the SONAR [rad] (default: 2 degrees for the Ping360)
+        min_range: the range [m] closer than which nothing is known, e.g. because of the transducer ringdown (default: 0.8)
+        mount_offset: the head angle [grad] that points forward on the vehicle (default: 200, the current AUV configuration)
+    """
+
+    def __init__(self, resolution: float=0.05, tile_size: int=64, l_occupied: float=0.85, l_free: float=-0.4, l_min: float=-4.0,
+                 l_max: float=4.0, beam_width: float=np.radians(2), min_range: float=0.8, mount_offset: int=200):
+        self.resolution = resolution
+        self.tile_size = tile_size
+        self.l_occupied = l_occupied
+        self.l_free = l_free
+        self.l_min = l_min
+        self.l_max = l_max
+        self.beam_width = beam_width
+        self.min_range = min_range
+        self.mount_offset = mount_offset
+
+        self.tiles = {} # (tile row, tile column) -> (tile_size, tile_size) float32 log-odds
+        self.pings = 0
+
+    def _beam_cells(self, x: float, y: float, bearing: float, start: float, stop: float):
+        """
+        Returns the unique (row, column) cells covered by the beam between two ranges [m]
+        """
+        if stop <= start:
+            return np.empty((0, 2), dtype=np.int64)
+        _ranges = np.arange(start, stop, self.resolution / 2)
+        # Enough rays that neighbouring rays are at most half a cell apart at the far end
+        _n_rays = max(1, int(np.ceil(self.beam_width * stop / (self.resolution / 2))))
+        _bearings = bearing + np.linspace(-self.beam_width / 2, self.beam_width / 2, _n_rays)
+        _north = x + np.outer(np.cos(_bearings), _ranges)
+        _east = y + np.outer(np.sin(_bearings), _ranges)
+        _cells = np.stack((np.floor(_north / self.resolution), np.floor(_east / self.resolution)), axis=-1).reshape(-1, 2).astype(np.int64)
+        return np.unique(_cells, axis=0)
+
+    def _apply(self, cells: np.ndarray, delta: float):
+        """
+        Adds 'delta' to the log-odds of unique cells, allocating the tiles they fall in
+        """
+        if not len(cells):
+            return
+        _tiles, _local = np.divmod(cells, self.tile_size)
+        _keys, _inverse = np.unique(_tiles, axis=0, return_inverse=True)
+        _inverse = _inverse.reshape(-1)
+        for index, key in enumerate(map(tuple, _keys)):
+            _tile = self.tiles.get(key)
+            if _tile is None:
+                _tile = self.tiles[key] = np.zeros((self.tile_size, self.tile_size), dtype=np.float32)
+            _rows, _columns = _local[_inverse == index].T
+            _tile[_rows, _columns] = np.clip(_tile[_rows, _columns] + delta, self.l_min, self.l_max)
+
+    def update(self, x: float, y: float, yaw: float, angle: int, distance: float, max_range: float=5.0):
+        """
+        Fuses one ping into the grid.
+
+        Arguments:
+            x, y: the position of the SONAR head in the local NED frame, north and east [m]
+            yaw: the heading of the vehicle, clockwise from north [rad] (MAVLink ATTITUDE yaw)
+            angle: the head angle of the ping [grad]
+            distance: the range of the echo [m], e.g. the likely distance of the ping; NaN if nothing was detected
+            max_range: the range [m] of the ping; without an echo the whole beam up to it is free (default: 5.0)
+        """
+        _bearing = yaw + (angle - self.mount_offset) * GRAD_TO_RAD
+        _hit = np.isfinite(distance) and self.min_range <= distance < max_range
+        _free = self._beam_cells(x, y, _bearing, self.min_range, distance - self.resolution if _hit else max_range)
+        if _hit:
+            _occupied = self._beam_cells(x, y, _bearing, distance - self.resolution / 2, distance + self.resolution)
+            # A cell at the echo is not freed by the same ping
+            _free = _free[~(_free[:, None, :] == _occupied[None, :, :]).all(axis=-1).any(axis=1)] if len(_free) and len(_occupied) else _free
+            self._apply(_occupied, self.l_occupied)
+        self._apply(_free, self.l_free)
+        self.pings += 1
+
+    def update_batch(self, x: float, y: float, yaw: float, angles, distances, max_range: float=5.0):
+        """
+        Fuses the pings of a response taken from a single pose, e.g. update_batch(x, y, yaw, [300] * n, response.likely_distance)
+        """
+        for angle, distance in zip(angles, distances):
+            self.update(x, y, yaw, angle, float(distance), max_range)
+
+    def log_odds(self, north: float, east: float):
+        """
+        Returns the log-odds of the cell at a position [m], 0 (unknown) if its tile was never allocated
+        """
+        _row, _column = int(np.floor(north / self.resolution)), int(np.floor(east / self.resolution))
+        _tile = self.tiles.get((_row // self.tile_size, _column // self.tile_size))
+        return 0.0 if _tile is None else float(_tile[_row % self.tile_size, _column % self.tile_size])
+
+    def to_dense(self):
+        """
+        Returns the occupancy probability of the allocated area as one dense array, for display
+
+        Returns:
+            (probabilities, (north, east) [m] of the corner of cell [0, 0]); unknown cells are 0.5
+        """
+        if not self.tiles:
+            return np.full((0, 0), 0.5), (0.0, 0.0)
+        _keys = np.array(list(self.tiles))
+        _first = _keys.min(axis=0)
+        _shape = (_keys.max(axis=0) - _first + 1) * self.tile_size
+        _log_odds = np.zeros(_shape, dtype=np.float32)
+        for (row, column), tile in self.tiles.items():
+            _r, _c = (row - _first[0]) * self.tile_size, (column - _first[1]) * self.tile_size
+            _log_odds[_r:_r + self.tile_size, _c:_c + self.tile_size] = tile
+        return 1 / (1 + np.exp(-_log_odds)), tuple(_first * self.tile_size * self.resolution)
+
+    @property
+    def nbytes(self):
+        """
+        The memory [bytes] used by the allocated tiles
+        """
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def save(self, path: str):
+        """
+        Writes the grid to a compressed NumPy archive
+        """
+        _keys = np.array(list(self.tiles), dtype=np.int64).reshape(-1, 2)
+        _tiles = np.array(list(self.tiles.values()), dtype=np.float32).reshape(-1, self.tile_size, self.tile_size)
+        np.savez_compressed(path, keys=_keys, tiles=_tiles, pings=self.pings, settings=np.array([
+            self.resolution, self.tile_size, self.l_occupied, self.l_free, self.l_min, self.l_max, self.beam_width, self.min_range,
+            self.mount_offset]))
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Reads a grid written by save()
+        """
+        with np.load(path) as archive:
+            _resolution, _tile_size, *_settings = archive["settings"].tolist()
+            _grid = cls(_resolution, int(_tile_size), *_settings[:-1], mount_offset=int(_settings[-1]))
+            _grid.tiles = {tuple(key): tile for key, tile in zip(archive["keys"].tolist(), archive["tiles"])}
+            _grid.pings = int(archive["pings"])
+        return _grid
+
+    def __str__(self):
+        return "OccupancyGrid: {} pings, {} tiles ({:.1f} kB)".format(self.pings, len(self.tiles), self.nbytes / 1024)
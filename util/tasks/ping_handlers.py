@@ -3,6 +3,14 @@ Functions for handling interactions with the Ping sensors on the AUV
 
 CHANGELOG:
  - Version 1.0.0: Initial release
+ - Version 1.1.0: Switched to the binary Ping360 wire protocol
+ - Version 1.2.0: Added the option to stream the full Ping360 intensity profiles
+ - Version 1.3.0: Added the Ping360 sweep mode sector update subscription
+ - Version 1.4.0: Added multi-angle Ping360 requests
+ - Version 1.5.0: Added the option to use the CFAR echo detector of the Ping360 service
+ - Version 1.6.0: Added the Ping360 service's multi-ping integration and early exit options
+ - Version 1.7.0: Added the Ping360 service stats query
+ - Version 1.8.0: The multi-angle response is read up to its record count, with a timeout
 
 TODO:
  - Enable the Ping360 client script to configure Ping360 server parameters such as target angle, intensities returns, and other specifications
@@ -12,33 +20,185 @@ __author__      = "Braidan Duffy, Humberto Lebron-Rivera, Omar Jebari, and Erben
 __copyright__   = "Copyright 2022"
 __credits__     = ["Braidan Duffy", "Humberto Lebron-Rivera", "Omar Jebari", "Erbene de Castro Maia Junior"]
 __license__     = "MIT"
-__version__     = "1.0.0"
+__version__     = "1.8.0"
 __maintainer__  = "Braidan Duffy"
 __email__       = "bduffy2018@my.fit.edu"
 __status__      = "Prototype"
 
+from util.comms.ping360_protocol import Ping360Request, Ping360Response, SectorUpdate, ServiceStats, ProtocolError, message_type, \
+    receive_profiles, pack_stats_request, expand_angles, FLAG_LOGGING, FLAG_PROFILES, FLAG_SUBSCRIBE, MSG_RESPONSE, MSG_SECTOR, \
+    MSG_ANGLES_RESPONSE, INTEGRATION_NONE, MAX_DATAGRAM_SIZE
+import dataclasses
+import numpy as np
 import socket
+import time
 
 
-def run_ping360_service(address: str="192.168.2.2", port: int=42069, buffer_size: int=1024, **args):
+def run_ping360_service(address: str="192.168.2.2", port: int=42069, buffer_size: int=2048, **args):
     """
     Opens a UDP connection to the AUV Ping360 service. This connection starts the Ping360 service's routine for collecting and reporting data. This client script will send configuration data to the server, which will then return the appropriate data from the Ping360
 
     Arguments:
         address: the IP address of the AUV computer running the Ping360 service (default: 192.168.2.2)
         port: the port used by the Ping360 service (default: 42069)
-        buffer_size: the size of the datagram buffer, in bytes (default: 1024)
-        args: various configuration parameters for the Ping360 service and client script
-            e.g. speed of sound, target angle/sweeps, parse data, log data, etc.
+        buffer_size: the size of the datagram buffer, in bytes (default: 2048)
+        args: configuration parameters for the Ping360 service
+            angle: the transmission angle in gradians, 100 is port and 300 is starboard (default: 300)
+            angles: ping several angles and (start, stop[, step]) sectors at once instead of 'angle', e.g. [100, 300] (default: None)
+            range: the range the SONAR should scan in meters (default: 5)
+            n_samples: the number of pings to take (default: 10)
+            readings: the number of samples per ping (default: 1200)
+            logging: log the acquisition on the AUV (default: True)
+            newer_than: continuous mode only, only return pings taken after this timestamp (default: None)
+            profiles: also stream the full intensity profile of every ping (default: False)
+            echoes: run the service's CFAR echo detector and return this many echoes per ping (0-15) in the response's 'echoes' (default: 0, strongest return only)
+            integration: integrate the pings into a single range estimate, returned in the response's 'estimate'; one of the INTEGRATION_* modes of util/comms/ping360_protocol.py (default: INTEGRATION_NONE)
+            max_std: stop pinging once the standard error [m] of the range estimate is below this (default: None, take all the pings)
+            min_pings: take at least this many pings before stopping early (default: 3)
+            profile_timeout: the maximum time [s] to wait for each profile chunk (default: 1.0)
+            angles_timeout: the maximum time [s] to wait for each datagram of a multi-angle response (default: 10.0)
 
     Returns:
-        The raw, packed datagram from the Ping360 service. This will need to be unpacked and parsed
+        The decoded Ping360Response from the service (see util/comms/ping360_protocol.py).
+        If 'profiles' is set, a (Ping360Response, ProfileReassembler) tuple; the reassembler holds the profiles and the record of lost chunks.
+        If 'angles' is set, the SectorUpdate holding the pings of every angle (see receive_angles_response()).
     """
     _server_address_port = (address, port) 
     _udp_client_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-    
-    _udp_client_socket.sendto(b'0', _server_address_port)
-    _msg_from_server = _udp_client_socket.recvfrom(buffer_size)
-    print("Message from server: ", _msg_from_server)
+    _profiles = args.get("profiles", False)
+    if _profiles:
+        # Leave room for a whole burst of profile chunks in the kernel buffer
+        _udp_client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        buffer_size = max(buffer_size, MAX_DATAGRAM_SIZE)
 
-    return _msg_from_server
\ No newline at end of file
+    _request = Ping360Request(
+        n_samples=args.get("n_samples", 10),
+        angle=args.get("angle", 300),
+        range=args.get("range", 5),
+        readings=args.get("readings", 1200),
+        newer_than=args.get("newer_than"),
+        flags=(FLAG_LOGGING if args.get("logging", True) else 0) | (FLAG_PROFILES if _profiles else 0),
+        echoes=args.get("echoes", 0),
+        integration=args.get("integration", INTEGRATION_NONE),
+        max_std=args.get("max_std"),
+        min_pings=args.get("min_pings", 3)
+    )
+    if args.get("angles") is not None:
+        _angles = expand_angles(*args["angles"])
+        _request = dataclasses.replace(_request, angle=_angles[0], angles=_angles)
+        _udp_client_socket.sendto(_request.pack(), _server_address_port)
+        _msg_from_server = receive_angles_response(_udp_client_socket, _request, max(buffer_size, MAX_DATAGRAM_SIZE),
+                                                   args.get("angles_timeout", 10.0))
+        print("Message from server: ", _msg_from_server.angles, _msg_from_server.likely_distance)
+        _udp_client_socket.close()
+        return _msg_from_server
+
+    _udp_client_socket.sendto(_request.pack(), _server_address_port)
+    _msg_from_server = Ping360Response.unpack(_udp_client_socket.recv(buffer_size))
+    print("Message from server: ", _msg_from_server.likely_distance)
+    if _msg_from_server.estimate is not None:
+        print("Range estimate: {distance:.3f} m +/- {std:.3f} m from {n_pings} pings".format(**dict(zip(_msg_from_server.estimate.dtype.names, _msg_from_server.estimate.item()))))
+
+    if _profiles and _msg_from_server.stream_id:
+        _profile_stream = receive_profiles(_udp_client_socket, _msg_from_server, args.get("profile_timeout", 1.0), buffer_size)
+        _udp_client_socket.close()
+        return _msg_from_server, _profile_stream
+
+    _udp_client_socket.close()
+    return _msg_from_server
+
+
+def request_ping360_stats(address: str="192.168.2.2", port: int=42069, timeout: float=1.0):
+    """
+    Asks the AUV Ping360 service for the latency statistics of its request path
+
+    Returns:
+        The ServiceStats of the service (see util/comms/ping360_protocol.py); print() it for a table of every stage
+    """
+    with socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM) as _udp_client_socket:
+        _udp_client_socket.settimeout(timeout)
+        _udp_client_socket.sendto(pack_stats_request(), (address, port))
+        return ServiceStats.unpack(_udp_client_socket.recv(MAX_DATAGRAM_SIZE))
+
+
+def receive_angles_response(udp_socket, request: Ping360Request, buffer_size: int=MAX_DATAGRAM_SIZE, timeout: float=10.0):
+    """
+    Receives the (possibly multi-datagram) response to a multi-angle request. Every datagram carries the total number of records of the response, so reading stops as soon as all of them arrived; the response may hold fewer than n_samples pings per angle (continuous mode, early exit).
+
+    Arguments:
+        udp_socket: the socket the request was sent from
+        request: the multi-angle request
+        buffer_size: the size of the datagram buffer, in bytes (default: MAX_DATAGRAM_SIZE)
+        timeout: the maximum time [s] to wait for each datagram, the first one included (default: 10.0)
+
+    Returns:
+        A SectorUpdate holding the pings of every angle, in the order of the request's angles. Its 'sequence' is the total number of records the service sent; if datagrams were lost, the records received are returned once 'timeout' runs out, and there are fewer of them.
+
+    Raises:
+        ProtocolError: if the service answered with an error
+        socket.timeout: if no datagram of the response arrived within 'timeout'
+    """
+    udp_socket.settimeout(timeout)
+    _updates = []
+    _received = 0
+    while not _updates or _received < _updates[0].sequence:
+        try:
+            _datagram = udp_socket.recv(buffer_size)
+        except socket.timeout:
+            if not _updates:
+                raise
+            break # The rest of the response was lost
+        if message_type(_datagram) == MSG_RESPONSE:
+            raise ProtocolError("The Ping360 service could not serve the request (status {})".format(Ping360Response.unpack(_datagram).status))
+        _update = SectorUpdate.unpack(_datagram)
+        if _update.message != MSG_ANGLES_RESPONSE:
+            continue # A stray sector update
+        _updates.append(_update)
+        _received += len(_update.records)
+    return SectorUpdate(np.concatenate([update.records for update in _updates]), _updates[0].number_of_samples,
+                        _updates[0].meters_per_sample, _updates[0].sequence, _updates[0].message)
+
+
+def ping360_sector_updates(address: str="192.168.2.2", port: int=42069, renew_interval: float=5.0, timeout: float=2.0, **args):
+    """
+    Subscribes to the sector updates of the Ping360 service in sweep mode and yields them as they arrive. The subscription is renewed every 'renew_interval' seconds for as long as the generator is iterated.
+
+    Arguments:
+        address: the IP address of the AUV computer running the Ping360 service (default: 192.168.2.2)
+        port: the port used by the Ping360 service (default: 42069)
+        renew_interval: the time [s] between two subscription renewals; must be shorter than the service's lease (default: 5.0)
+        timeout: the maximum time [s] to wait for an update before renewing the subscription (default: 2.0)
+        args: the parameters of the subscribing request (see run_ping360_service); 'angle' must be one of the swept angles (default: 0)
+
+    Yields:
+        SectorUpdate objects (see util/comms/ping360_protocol.py), in arrival order. A gap in their sequence numbers means an update was lost.
+    """
+    _server_address_port = (address, port)
+    _udp_client_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    _udp_client_socket.settimeout(timeout)
+    _request = Ping360Request(
+        n_samples=args.get("n_samples", 1),
+        angle=args.get("angle", 0),
+        range=args.get("range", 5),
+        readings=args.get("readings", 1200),
+        flags=FLAG_SUBSCRIBE
+    ).pack()
+
+    try:
+        _renewed_at = None
+        while True:
+            if _renewed_at is None or time.monotonic() - _renewed_at >= renew_interval:
+                _udp_client_socket.sendto(_request, _server_address_port)
+                _renewed_at = time.monotonic()
+            try:
+                _datagram = _udp_client_socket.recv(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                _renewed_at = None
+                continue
+            try:
+                if message_type(_datagram) == MSG_SECTOR:
+                    yield SectorUpdate.unpack(_datagram)
+            except ProtocolError:
+                continue # A stray datagram, e.g. the response to the subscribing request
+    finally:
+        _udp_client_socket.close()